@@ -0,0 +1,178 @@
+"""asyncio front end of RobotController.
+
+AsyncRobotController sends commands from one writer thread and resolves a
+future per command from the responses read by the controller's
+ResponseReceiver, so the event loop never blocks in a driver call and any
+number of commands can be in flight:
+
+    robot = AsyncRobotController(RobotController(), loop)
+    response = await robot.set_pole_length(3, 250, timeout=1)
+    responses = await robot.transfer_to_model(models['12'])
+
+The module only uses futures and callbacks, it runs on asyncio and on
+trollius, its Python 2 backport.
+"""
+import threading
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from CanController import *
+
+
+class AsyncRobotController(object):
+    """Awaitable pole commands on top of a RobotController.
+
+    Args:
+        controller: The RobotController sending the frames, its receiver is started.
+        loop: Event loop the futures belong to, the current one if None.
+        timeout: Default seconds to wait for a response, None waits forever.
+    """
+    def __init__(self, controller, loop=None, timeout=5):
+        self.controller = controller
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.current_model = None
+        self.lock = threading.Lock()
+        self.pending = {}       # (device pole id, command index) -> deque of futures
+        self.receiver = controller.startReceiver()
+        self.receiver.addListener(self._onResponses)
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='AsyncRobotController')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def close(self):
+        """Stop the writer thread and fail every pending future."""
+        self.receiver.removeListener(self._onResponses)
+        self._writes.put(None)
+        self._writer.join()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for futures in pending.values():
+            for future in futures:
+                self.loop.call_soon_threadsafe(self._fail, future, CanError('Controller closed', self))
+
+    def set_pole_length(self, pole_id, length, timeout=None):
+        """Return a future resolved with the pole's ResponseFrame."""
+        device_id = self.controller._toDevice(pole_id)
+        return self.send([SetLengthCommandFrame(device_id, length)], timeout)[0]
+
+    def read_status(self, pole_id, status, timeout=None):
+        """Return a future resolved with the ResponseFrame holding the LENGTH, MAX or ID of a pole."""
+        device_id = self.controller._toDevice(pole_id)
+        return self.send([ReadStatusCommandFrame(device_id, status)], timeout)[0]
+
+    def transfer_to_model(self, model, ignore_previous=False, timeout=None):
+        """Send the lengths of `model` the poles did not confirm, return a future resolved with a ResponseSet of them.
+
+        The delta is computed against the controller's mirror, see
+        RobotController.modelDelta. The model becomes the current model once
+        every pole confirmed.
+        """
+        delta = self.controller.modelDelta(model, ignore_previous)
+        keys = sorted(delta.keys())
+        command_frames = [SetLengthCommandFrame(self.controller._toDevice(key), delta[key]) for key in keys]
+        transfer = asyncio.Future(loop=self.loop)
+        if not command_frames:
+            transfer.set_result(ResponseSet([]))
+            return transfer
+        futures = self.send(command_frames, timeout)
+
+        def done(gathered):
+            if transfer.done():
+                return
+            if gathered.exception() is not None:
+                transfer.set_exception(gathered.exception())
+                return
+            responses = ResponseSet([])
+            for key, response in zip(keys, gathered.result()):
+                responses[key] = response
+            self.current_model = model
+            transfer.set_result(responses)
+        asyncio.gather(*futures).add_done_callback(done)
+        return transfer
+
+    def send(self, command_frames, timeout=None):
+        """Queue command frames for the writer thread, return one future per frame."""
+        if timeout is None:
+            timeout = self.timeout
+        futures = []
+        with self.lock:
+            for command_frame in command_frames:
+                future = asyncio.Future(loop=self.loop)
+                key = (command_frame.id, command_frame.command_index)
+                self.pending.setdefault(key, deque()).append(future)
+                if timeout is not None:
+                    self.loop.call_later(timeout, self._expire, key, future)
+                futures.append(future)
+        self._writes.put((command_frames, futures))
+        return futures
+
+    def _write(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            command_frames, futures = item
+            # Send everything queued meanwhile in the same batch.
+            while not self._writes.empty():
+                item = self._writes.get()
+                if item is None:
+                    self._writes.put(None)
+                    break
+                command_frames = command_frames + item[0]
+                futures = futures + item[1]
+            try:
+                self.controller.transmitBatch(command_frames)
+            except CanError as e:
+                with self.lock:
+                    for command_frame, future in zip(command_frames, futures):
+                        futures_of_pole = self.pending.get((command_frame.id, command_frame.command_index))
+                        if futures_of_pole and future in futures_of_pole:
+                            futures_of_pole.remove(future)
+                for future in futures:
+                    self.loop.call_soon_threadsafe(self._fail, future, e)
+
+    def _onResponses(self, start, stop, decoded):
+        resolved = []
+        with self.lock:
+            for row in zip(decoded.arbitration_id.tolist(), decoded.pole_id.tolist(), decoded.status.tolist(),
+                           decoded.command.tolist(), decoded.data.tolist()):
+                futures = self.pending.get((row[1], row[3]))
+                if futures:
+                    resolved.append((futures.popleft(), row))
+                    if not futures:
+                        del self.pending[(row[1], row[3])]
+        for future, row in resolved:
+            self.loop.call_soon_threadsafe(self._resolve, future, ResponseFrame.fromDecoded(*row))
+
+    def _resolve(self, future, response):
+        if future.done():
+            return
+        if response.status:
+            future.set_result(response)
+        else:
+            future.set_exception(CanError('Pole %s refused command %s' % (response.id, response.command), self))
+
+    def _fail(self, future, error):
+        if not future.done():
+            future.set_exception(error)
+
+    def _expire(self, key, future):
+        with self.lock:
+            futures = self.pending.get(key)
+            if not futures or future not in futures:
+                # Resolved, or a resolution is already scheduled.
+                return
+            futures.remove(future)
+            if not futures:
+                del self.pending[key]
+        self._fail(future, asyncio.TimeoutError())
@@ -1,6 +1,22 @@
+import copy
 import time
 import logging
+import threading
+
+import numpy
+
 from nican import *
+from cancodec import *
+from canreceiver import *
+from txscheduler import *
+from inflight import *
+from metrics import *
+from mirror import PoleMirror
+from acceptance import AcceptanceFilter
+from capture import CaptureWriter, SENT, RECEIVED
+from polemap import PoleMap
+import interfaces
+from writecombine import WriteCombiner
 
 logger = logging.getLogger('shiyijian.robot')
 
@@ -36,12 +52,25 @@ RESPONSE_ERROR = 0
 
 
 class CanError(StandardError):
-    def __init__(self, desc, obj):
+    def __init__(self, desc, obj, cause=None):
         self.desc = desc
+        # The error the transfer failed with, e.g. the NicanError with the driver's status.
+        self.cause = cause
     
     def __str__(self):
         return self.desc
 
+class BatchTransferError(CanError):
+    def __init__(self, desc, obj, batch, chunk, cause=None):
+        super(BatchTransferError, self).__init__(desc, obj, cause)
+        self.batch = batch
+        self.chunk = chunk
+
+class TransferIncompleteError(CanError):
+    def __init__(self, desc, obj, unconfirmed):
+        super(TransferIncompleteError, self).__init__(desc, obj)
+        self.unconfirmed = unconfirmed
+
 def _byte_to_hex_string(num):
     if num < 0:
         num = num + 256
@@ -56,18 +85,7 @@ class CommandFrame(object):
         self.command_data = None
 
     def fillStructure(self, vco):
-        vco.ID = self.id
-        vco.SendType = 0
-        vco.RemoteFlag = 0
-        vco.ExternFlag = 1
-        vco.DataLen = 8
-        data = vco.Data
-        data[0] = self.id
-        data[1] = self.command_type
-        data[2] = self.command_index
-        array = "%010X"%self.command_data
-        for i in range(5):
-            data[i+3] = int(array[i*2:i*2+2], 16)
+        encodeFrame(vco, self.id, self.command_type, self.command_index, self.command_data)
         self.command_buffer = vco
 
     def __repr__(self):
@@ -113,17 +131,122 @@ class ReadStatusCommandFrame(CommandFrame):
         self.command_data = 0
 
 
+class CommandBatch(object):
+    """Command frames packed into one NCTYPE_CAN_STRUCT array.
+
+    The array is written with NC_WriteMult in chunks of `chunk_size` frames,
+    `sent` records which chunks made it to the driver so that a failed
+    transfer can be resumed without sending the other chunks again.
+
+    The commands are kept as the columns `ids`, `command_types`,
+    `command_indexes` and `values`, in the order of the frames.
+
+    A batch packed into a shared FramePool is only valid until the pool
+    encodes again, own() copies its frames out of the pool.
+    """
+    def __init__(self, command_frames, chunk_size, pool=None):
+        command_frames = list(command_frames)
+        self._setCommands([c.id for c in command_frames], [c.command_type for c in command_frames],
+                          [c.command_index for c in command_frames], [c.command_data for c in command_frames],
+                          chunk_size)
+        if pool is None:
+            pool = FramePool(len(command_frames))
+        pool.encodeCommands(self.ids, self.command_types, self.command_indexes, self.values)
+        self.frames = pool.frames
+
+    @classmethod
+    def fromLengths(cls, pole_ids, lengths, chunk_size, pole_map=None, pool=None):
+        """Pack a SetLength command per (pole id, length) pair with FramePool.encodeMany.
+
+        With a PoleMap the pole ids of the packed frames are mapped to device
+        ids in one step, `ids` then holds the device ids.
+        """
+        if pool is None:
+            pool = FramePool(len(pole_ids))
+        frames = pool.encodeMany(pole_ids, lengths)
+        if pole_map is not None:
+            pole_map.mapFrames(frames)
+            pole_ids = (viewFrames(frames)['ArbitrationId'] & ~NC_FL_CAN_ARBID_XTD).tolist()
+        num = len(pole_ids)
+        batch = cls.__new__(cls)
+        batch._setCommands(list(pole_ids), [COMMAND_TYPE_WRITE] * num, [COMMAND_INDEX_LENGTH] * num, list(lengths),
+                           chunk_size)
+        batch.frames = pool.frames
+        return batch
+
+    def _setCommands(self, ids, command_types, command_indexes, values, chunk_size):
+        self.ids = ids
+        self.command_types = command_types
+        self.command_indexes = command_indexes
+        self.values = values
+        self.chunk_size = max(1, chunk_size)
+        self.sent = [False] * ((len(ids) + self.chunk_size - 1) // self.chunk_size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def own(self):
+        """Copy the frames into an array of the batch's own, return the batch."""
+        frames = (NCTYPE_CAN_STRUCT*len(self.ids))()
+        memmove(frames, self.frames, sizeof(frames))
+        self.frames = frames
+        return self
+
+    def chunk(self, i):
+        """Return the NCTYPE_CAN_STRUCT array of chunk `i`, sharing memory with self.frames."""
+        start = i * self.chunk_size
+        num = min(self.chunk_size, len(self.ids) - start)
+        return (NCTYPE_CAN_STRUCT*num).from_buffer(self.frames, start * sizeof(NCTYPE_CAN_STRUCT))
+
+    def chunkColumns(self, i):
+        """Return the (ids, command_types, command_indexes, values) of chunk `i`."""
+        chunk = slice(i * self.chunk_size, (i + 1) * self.chunk_size)
+        return self.ids[chunk], self.command_types[chunk], self.command_indexes[chunk], self.values[chunk]
+
+    def commandFrames(self, rows):
+        """Return CommandFrames of the commands at `rows`, e.g. to send some of them again."""
+        command_frames = []
+        for k in rows:
+            command_frame = CommandFrame(self.ids[k])
+            command_frame.command_type = self.command_types[k]
+            command_frame.command_index = self.command_indexes[k]
+            command_frame.command_data = self.values[k]
+            command_frames.append(command_frame)
+        return command_frames
+
+    @property
+    def pending(self):
+        return [i for i, sent in enumerate(self.sent) if not sent]
+
+    @property
+    def done(self):
+        return all(self.sent)
+
+    def rewind(self):
+        """Mark every chunk as not sent, to send the same frames again."""
+        self.sent = [False] * len(self.sent)
+        return self
+
+
 class ResponseFrame(object):
     def __init__(self, obj):
         self.response_buffer = obj
-        self.frame_id = obj.ID
+        self.frame_id = obj.ArbitrationId & ~NC_FL_CAN_ARBID_XTD
         self.id = obj.Data[0]
         self.status = (obj.Data[1] == RESPONSE_OK)
         self.command = obj.Data[2]
 
+    @classmethod
+    def fromDecoded(cls, frame_id, pole_id, status, command, data):
+        obj = NCTYPE_CAN_STRUCT()
+        encodeFrame(obj, pole_id, status, command, data)
+        obj.ArbitrationId = frame_id | NC_FL_CAN_ARBID_XTD
+        return cls(obj)
+
     @property
     def data(self):
-        return int("".join(_byte_to_hex_string(self.response_buffer.Data[i]) for i in range(3, 8)), 16)
+        d = self.response_buffer.Data
+        return (d[3] << 32) | (d[4] << 24) | (d[5] << 16) | (d[6] << 8) | d[7]
 
     def __repr__(self):
         return "".join(_byte_to_hex_string(self.response_buffer.Data[i]) for i in range(8))
@@ -136,6 +259,16 @@ class ResponseSet(dict):
             response = ResponseFrame(obj)
             self[response.id] = response
 
+    @classmethod
+    def fromDecoded(cls, decoded):
+        """Build a ResponseSet from the DecodedResponses of a read."""
+        responses = cls([])
+        for row in zip(decoded.arbitration_id.tolist(), decoded.pole_id.tolist(), decoded.status.tolist(),
+                       decoded.command.tolist(), decoded.data.tolist()):
+            # Keyed by the decoded id, pole ids mapped from device ids may not fit in Data[0].
+            responses[row[1]] = ResponseFrame.fromDecoded(*row)
+        return responses
+
 class BodyModelData(dict):
     def __init__(self, *args, **kwargs):
         super(BodyModelData, self).__init__(*args, **kwargs)
@@ -186,39 +319,74 @@ class BodyModelData(dict):
 
     @staticmethod
     def parseModelsFromFileLikeObject(obj):
-        return BodyModelData.parseModelsFromString(obj.read())
-
-    @staticmethod
-    def parseModelsFromString(s):
-        s = ''.join([line.strip() for line in s.splitlines() if line.strip() and not line.strip().startswith("#")])
         models = BodyModels()
-        model_lines = [line.strip() for line in s.split(";") if line]
-        for line in model_lines:
-            index, datas = line.split(":")
-            model = BodyModelData.parseString(datas)
-            model.index = unicode(index.strip())
+        for model in BodyModelData.iterModels(obj):
             models[model.index] = model
         return models
-    
+
+    @staticmethod
+    def parseModelsFromString(s):
+        return BodyModelData.parseModelsFromFileLikeObject(s.splitlines())
+
+    @staticmethod
+    def iterModelsFromFile(filename):
+        f = open(filename, 'r')
+        try:
+            for model in BodyModelData.iterModels(f):
+                yield model
+        finally:
+            f.close()
+
+    @staticmethod
+    def iterModels(lines):
+        """Yield the models of the text format one by one, reading `lines` only as far as needed."""
+        pending = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split(";")
+            pending.append(parts[0])
+            for part in parts[1:]:
+                model_line = ''.join(pending)
+                if model_line:
+                    yield BodyModelData._parseModelLine(model_line)
+                pending = [part]
+        model_line = ''.join(pending)
+        if model_line:
+            yield BodyModelData._parseModelLine(model_line)
+
+    @staticmethod
+    def _parseModelLine(line):
+        index, datas = line.split(":")
+        model = BodyModelData.parseString(datas)
+        model.index = unicode(index.strip())
+        return model
+
     @staticmethod
     def serializeModels(models, ordered=True):
         sl = []
+        BodyModelData.writeModels(models, sl.append, ordered)
+        return "".join(sl)
+
+    @staticmethod
+    def writeModels(models, write, ordered=True):
+        """Pass the text format of `models` to `write` model by model."""
         if ordered:
             l = models.ordered
         else:
             l = sorted(models.keys(), cmp=_cmp)
-        sl.append("#   %s\n"%",".join(["%03s"%i for i in range(len(models[l[0]]))]))
+        write("#   %s\n"%",".join(["%03s"%i for i in range(len(models[l[0]]))]))
         for index in l:
             model = models[index]
-            sl.append("%s:\n    "%index)
-            sl.append(",".join(["%03s"%model[i] for i in sorted(model.keys())]))
-            sl.append(";\n")
-        return "".join(sl)
-    
+            write("%s:\n    "%index)
+            write(",".join(["%03s"%model[i] for i in sorted(model.keys())]))
+            write(";\n")
+
     @staticmethod
     def saveModelsToFile(models, filename, ordered=True):
         f = open(filename, 'w')
-        f.write(BodyModelData.serializeModels(models, ordered))
+        BodyModelData.writeModels(models, f.write, ordered)
         f.close()
 
 
@@ -233,39 +401,225 @@ class BodyModelDeltaData(BodyModelData):
     pass
 
 
-class BodyModels(dict):
-    def __init__(self):
-        super(BodyModels, self).__init__()
+class BodyModelRow(BodyModelData):
+    """A model read from BodyModels, writes go through to the library.
+
+    Copies of a row are plain BodyModelData, detached from the library.
+    """
+    def __init__(self, models, *args, **kwargs):
+        super(BodyModelRow, self).__init__(*args, **kwargs)
+        self._models = models
+
+    def __copy__(self):
+        model = BodyModelData(self)
+        model.index = self.index
+        return model
+
+    def __deepcopy__(self, memo):
+        model = BodyModelData((copy.deepcopy(key, memo), copy.deepcopy(value, memo)) for key, value in self.items())
+        model.index = copy.deepcopy(self.index, memo)
+        return model
+
+    def __setitem__(self, key, value):
+        # The library first, a row of a model no longer in it is left unchanged.
+        self._models._setPole(self.index, key, value)
+        super(BodyModelRow, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._models._setPole(self.index, key, BodyModels.MISSING)
+        super(BodyModelRow, self).__delitem__(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._models._setPole(self.index, key, BodyModels.MISSING)
+        return super(BodyModelRow, self).pop(key, *default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def delta(self, data):
+        if isinstance(data, BodyModelRow) and data._models is self._models and data.index in self._models:
+            return self._models.delta(self.index, data.index)
+        return super(BodyModelRow, self).delta(data)
+
+
+class BodyModels(object):
+    """Model library stored as a models x poles int32 matrix.
+
+    It keeps the mapping API of a dict of BodyModelData keyed by model index.
+    Reading a model builds a BodyModelRow from its matrix row, deltas between
+    models of the library are computed on the matrix without building rows.
+    Poles a model does not set hold MISSING.
+    """
+    MISSING = numpy.iinfo(numpy.int32).min
+
+    def __init__(self, capacity=16):
         self.ordered = []
-        
+        self.names = []         # row -> model index
+        self._rows = {}         # model index -> row
+        self.pole_ids = numpy.zeros(0, numpy.int32)
+        self._columns = {}      # pole id -> column
+        self.matrix = numpy.empty((capacity, 0), numpy.int32)
+
+    @classmethod
+    def fromMatrix(cls, names, pole_ids, matrix):
+        """Build a library from model indices, pole ids and a len(names) x len(pole_ids) matrix."""
+        models = cls(capacity=0)
+        models.names = list(names)
+        models.ordered = list(names)
+        models._rows = dict((name, row) for row, name in enumerate(models.names))
+        models.pole_ids = numpy.array(pole_ids, numpy.int32)
+        models._columns = dict((pole, column) for column, pole in enumerate(models.pole_ids.tolist()))
+        models.matrix = numpy.array(matrix, numpy.int32)
+        return models
+
+    @property
+    def nbytes(self):
+        return self.matrix[:len(self.names)].nbytes
+
     def autoSort(self):
         self.ordered.sort(cmp=_cmp)
-    
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, i):
+        return i in self._rows
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(list(self.ordered))
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self.ordered)
+
+    def values(self):
+        return [self[i] for i in self.ordered]
+
+    def items(self):
+        return [(i, self[i]) for i in self.ordered]
+
+    def itervalues(self):
+        for i in list(self.ordered):
+            yield self[i]
+
+    def iteritems(self):
+        for i in list(self.ordered):
+            yield i, self[i]
+
+    def get(self, i, y=None):
+        if i in self._rows:
+            return self[i]
+        return y
+
+    def row(self, i):
+        """Return the matrix row of model `i`, a view aligned with pole_ids."""
+        return self.matrix[self._rows[i]]
+
+    def __getitem__(self, i):
+        values = self.matrix[self._rows[i]].tolist()
+        model = BodyModelRow(self, [(pole, value) for pole, value in zip(self.pole_ids.tolist(), values)
+                                    if value != self.MISSING])
+        model.index = i
+        return model
+
     def __setitem__(self, i, y):
-        if i not in self:
+        columns = self._addPoles(y.keys())
+        row = self._rows.get(i)
+        if row is None:
+            row = len(self.names)
+            if row == len(self.matrix):
+                self._resize(max(16, 2 * row), len(self.pole_ids))
+            self.names.append(i)
+            self._rows[i] = row
             self.ordered.append(i)
-        super(BodyModels, self).__setitem__(i, y)
-        
-    def __delitem(self, i):
-        super(BodyModels, self).__delitem__(i)
+        values = numpy.empty(len(self.pole_ids), numpy.int32)
+        values.fill(self.MISSING)
+        values[[columns[key] for key in y.keys()]] = y.values()
+        self.matrix[row] = values
+
+    def __delitem__(self, i):
+        row = self._rows.pop(i)
+        last = len(self.names) - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.names[row] = self.names[last]
+            self._rows[self.names[row]] = row
+        self.names.pop()
         self.ordered.remove(i)
-        
+
     def update(self, *args, **kwargs):
         raise StandardError("update not support!")
-    
+
     def pop(self, i, y=None):
-        if i in self:
-            self.ordered.remove(i)
-        if y is None:
-            super(BodyModels, self).pop(i)
-        else:
-            super(BodyModels, self).pop(i, y)
+        if i not in self:
+            if y is None:
+                raise KeyError(i)
+            return y
+        model = copy.copy(self[i])
+        del self[i]
+        return model
+
+    def delta(self, index, from_index):
+        """Same as self[index].delta(self[from_index])."""
+        return self.deltas([from_index, index])[0]
+
+    def deltas(self, indices):
+        """Return the BodyModelDeltaData of every transition of a sequence of model indices."""
+        rows = self.matrix[[self._rows[i] for i in indices]]
+        targets = rows[1:]
+        changed = (targets != rows[:-1]) & (targets != self.MISSING)
+        pole_ids = self.pole_ids
+        result = []
+        for k in range(len(targets)):
+            columns = numpy.flatnonzero(changed[k])
+            result.append(BodyModelDeltaData(zip(pole_ids[columns].tolist(), targets[k, columns].tolist())))
+        return result
+
+    def _setPole(self, i, pole, value):
+        row = self._rows[i]
+        columns = self._addPoles([pole])
+        self.matrix[row, columns[pole]] = value
+
+    def _addPoles(self, pole_ids):
+        new = [pole for pole in pole_ids if pole not in self._columns]
+        if new:
+            self._resize(len(self.matrix), len(self.pole_ids) + len(new))
+            for pole in new:
+                self._columns[pole] = len(self._columns)
+            self.pole_ids = numpy.append(self.pole_ids, numpy.array(new, numpy.int32))
+        return self._columns
+
+    def _resize(self, num_rows, num_poles):
+        matrix = numpy.empty((num_rows, num_poles), numpy.int32)
+        matrix.fill(self.MISSING)
+        old = self.matrix[:len(self.names)]
+        matrix[:old.shape[0], :old.shape[1]] = old
+        self.matrix = matrix
 
 class RobotController(object):
-    proxy = None
-    def __init__(self):
+    pole_map = None
+    handle = None
+    acceptance = None
+    pole_ids = None
+
+    def __init__(self, interface="CAN0", registry=None, pole_ids=None):
+        """Open `interface`, or share it with the controllers that opened it.
+
+        Args:
+            interface: Interface name, 'CAN0'.
+            registry: InterfaceRegistry the interface is acquired from.
+            pole_ids: Pole ids on the bus, the interface then only accepts
+                their frames, see configureFilter.
+        """
         self.interface = (c_char*7)()
-        self.interface.value = "CAN0"
+        self.interface.value = interface
         self.AttrIdList = (c_ulong*8)(NC_ATTR_BAUD_RATE, 
                                     NC_ATTR_START_ON_OPEN, 
                                     NC_ATTR_READ_Q_LEN, 
@@ -275,23 +629,235 @@ class RobotController(object):
                                     NC_ATTR_CAN_COMP_XTD,
                                     NC_ATTR_CAN_MASK_XTD
                                     )
-        self.AttrValueList = (c_ulong*8)(125000, NC_TRUE, 0, 1, 0, NC_CAN_MASK_STD_DONTCARE, 0, NC_CAN_MASK_XTD_DONTCARE)
+        # The background reader drains a read queue, a zero length one only keeps the newest frame.
+        self.AttrValueList = (c_ulong*8)(125000, NC_TRUE, default_nican_config[NC_ATTR_READ_Q_LEN], 1, 0,
+                                         NC_CAN_MASK_STD_DONTCARE, 0, NC_CAN_MASK_XTD_DONTCARE)
+        if pole_ids is not None:
+            self.pole_ids = list(pole_ids)
+            self._setAcceptance(AcceptanceFilter.fromPoles(self.pole_ids, self.pole_map))
 
-        self.objHandle = c_ulong()
-        #Configure the CAN Network Interface Object
-        NC_Config(self.interface, 8, self.AttrIdList, self.AttrValueList)
-        
-        #open the CAN Network Interface Object
-        NC_OpenObject(self.interface, byref(self.objHandle))
+        #Configure and open the CAN Network Interface Object, or reuse it if already open
+        self.registry = registry or interfaces.registry
+        self.handle = self.registry.acquire(interface, self.AttrIdList, self.AttrValueList)
+        self.objHandle = self.handle.objHandle
+
+        self.inflight = InFlightTable()
+        self.metrics = ControllerMetrics(self)
+        self.inflight.addListener(self.metrics.onCommand)
+        self.mirror = PoleMirror(self.inflight)
+        self._recovery_lock = threading.RLock()
+        self._recovery_state = threading.local()
+        self._pools = threading.local()
+
+    def close(self):
+        """Stop the receiver and release the interface, the controller can not be used afterwards."""
+        if self.handle is None:
+            return
+        self.disableWriteCombining()
+        self.stopCapture()
+        self.stopReceiver()
+        self.registry.release(self.handle)
+        self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
         
     def transmit(self, command_frame):
-        num = NC_Write(self.devicetype, self.deviceind, self.canind, command_frame)
-        logger.debug(str(command_frame))
-        if not num:
-            logger.error('Failed to transmit command %s to pole %s' % (command_frame.command_index, command_frame.id))
-            raise CanError('Failed to transmit data to can %s!' % self.canind, self)
-        return num
+        if self.write_combiner is not None:
+            # Staged commands go first.
+            self.write_combiner.flush()
+        pool = self._framePool(1)
+        command_frame.command_buffer = pool.encode(command_frame.id, command_frame.command_type,
+                                                   command_frame.command_index, command_frame.command_data)
+        commands = self.inflight.sent([command_frame])
+        try:
+            self._writeFrames(pool.view(1))
+        except Exception as e:
+            self.inflight.discard(commands)
+            self.metrics.transmitError()
+            logger.error('Failed to transmit command %s to pole %s: %s', command_frame.command_index, command_frame.id, e)
+            raise CanError('Failed to transmit data to can %s!' % self.interface.value, self, e)
+        logger.debug('%s', command_frame)
+        return 1
     
+    def _framePool(self, num):
+        # The FramePool of the calling thread, the combiner, async writer and recovery threads transmit concurrently.
+        pool = getattr(self._pools, 'pool', None)
+        if pool is None or pool.size < num:
+            pool = self._pools.pool = FramePool(max(num, 2 * pool.size if pool is not None else 64))
+        return pool
+
+    def getAttribute(self, attr_id):
+        value = c_ulong()
+        NC_GetAttribute(self.objHandle, attr_id, sizeof(value), byref(value))
+        return value.value
+
+    def getWriteQueueLength(self):
+        return self.getAttribute(NC_ATTR_WRITE_Q_LEN)
+
+    @property
+    def _scheduler(self):
+        # The scheduler if created, without creating it.
+        return self.handle._scheduler
+
+    @property
+    def scheduler(self):
+        """TransmitScheduler pacing every write of the interface, shared with its other controllers."""
+        return self.handle.scheduler
+
+    def busUtilisation(self):
+        """Fraction of the bus time used by sent and received frames since scheduler.resetStats."""
+        received = 0
+        if self.receiver is not None:
+            received = self.receiver.head - self._utilisation_head
+        return self.scheduler.utilisation(received)
+
+    def resetBusStats(self):
+        self.scheduler.resetStats()
+        self._utilisation_head = self.receiver.head if self.receiver is not None else 0
+
+    _utilisation_head = 0
+
+    def transmitBatch(self, command_frames, chunk_size=None, timeout=100, supersede=False):
+        """Send command frames with NC_WriteMult, paced by the TransmitScheduler.
+
+        Args:
+            command_frames: List of CommandFrame, or a CommandBatch whose pending
+                chunks are sent again, like the batch of a BatchTransferError.
+            chunk_size: Frames per chunk, defaults to NC_ATTR_WRITE_Q_LEN.
+            timeout: Milliseconds to wait for the write queue to drain when it overflows.
+            supersede: The commands are sent again, they replace the unanswered
+                ones to the same poles in the InFlightTable.
+
+        Returns:
+            The CommandBatch, with all chunks sent. The batch of a list of
+            CommandFrames is packed into the thread's FramePool and only valid
+            until the thread transmits again.
+
+        Raises:
+            BatchTransferError: A chunk could not be written, its index is the
+                error's chunk and the other pending chunks were not sent. The
+                error's cause is the driver's NicanError.
+        """
+        if self.write_combiner is not None:
+            self.write_combiner.flush()
+        pooled = not isinstance(command_frames, CommandBatch)
+        if not pooled:
+            batch = command_frames
+        else:
+            if chunk_size is None:
+                chunk_size = self.getWriteQueueLength()
+            command_frames = list(command_frames)
+            batch = CommandBatch(command_frames, chunk_size, self._framePool(len(command_frames)))
+        for i in batch.pending:
+            columns = batch.chunkColumns(i)
+            commands = self.inflight.sentMany(*columns, supersede=supersede)
+            try:
+                self._writeFrames(batch.chunk(i), timeout)
+            except Exception as e:
+                self.inflight.discard(commands)
+                self.metrics.transmitError()
+                logger.error('Failed to transmit chunk %s to poles %s: %s', i, columns[0], e)
+                if pooled:
+                    # The error's batch may be sent again after the pool was reused.
+                    batch.own()
+                raise BatchTransferError('Failed to transmit chunk %s to can %s!' % (i, self.interface.value), self, batch, i, e)
+            batch.sent[i] = True
+        return batch
+
+    def _writeFrames(self, frames, timeout=None):
+        generation = self.handle.generation
+        try:
+            self.scheduler.write(frames, timeout, self.metrics)
+        except NicanError as e:
+            if not self.auto_recover or self._recovering or not self.handle.needsRecovery(e):
+                raise
+            logger.warning('writing to %s failed, recovering: %s', self.interface.value, e)
+            # The frames are in the InFlightTable, recover() resends them with the other lost ones.
+            # Another thread recovering meanwhile holds the lock, the generation check then skips.
+            self.recover(generation)
+
+    auto_recover = True
+    _resumed_generation = 0
+    _recovery_thread = None
+
+    def recover(self, generation=None):
+        """Restart the interface after a bus-off and resend the commands it lost.
+
+        See InterfaceHandle.recover. Every command not answered yet is sent
+        again, except resets and id changes, which are not safe to repeat;
+        waiters and transfers in progress are satisfied by the new answers.
+
+        Args:
+            generation: The handle generation seen failing, the interface is
+                not recovered again if another controller or thread did since.
+
+        Returns:
+            The number of commands sent again.
+        """
+        with self._recovery_lock:
+            self._recovery_state.active = True
+            try:
+                self.handle.recover(self.handle.generation if generation is None else generation)
+                if self._resumed_generation == self.handle.generation:
+                    return 0
+                self._resumed_generation = self.handle.generation
+                return self._resume()
+            finally:
+                self._recovery_state.active = False
+
+    @property
+    def _recovering(self):
+        # True in the thread running recover(), whose own failed writes must not recover again.
+        return getattr(self._recovery_state, 'active', False)
+
+    def _resume(self):
+        command_frames = []
+        for command in self.inflight.unanswered():
+            if command.command_index in (COMMAND_INDEX_RESET, COMMAND_INDEX_ID):
+                logger.warning('not repeating command %s to pole %s', command.command_index, command.pole_id)
+                self.inflight.discard([command])
+                continue
+            command_frame = CommandFrame(command.pole_id)
+            command_frame.command_type = command.command_type
+            command_frame.command_index = command.command_index
+            command_frame.command_data = command.value
+            command_frames.append(command_frame)
+        if command_frames:
+            logger.info('resending %s commands', len(command_frames))
+            self.frames_retransmitted += len(command_frames)
+            # Not in the thread's FramePool, the batch whose write failed may be in it with chunks left to send.
+            # The commands stay in the table until their chunk is resent, so answers read meanwhile still match.
+            self.transmitBatch(CommandBatch(command_frames, self.scheduler.write_q_len), supersede=True)
+        return len(command_frames)
+
+    def _onBusError(self, kind, count):
+        # ResponseReceiver error listener, in the reader thread: recover in another one.
+        if kind == NC_FRMTYPE_COMM_ERR or not self.auto_recover:
+            return
+        if kind == READ_ERROR:
+            # A read queue overflow is no reason to restart, a stopped or closed interface is.
+            if not self.handle.needsRecovery(self.receiver.last_read_error):
+                return
+        elif not self.handle.state() & NC_ST_ERROR:
+            # The driver reports every bus error, the interface only needs recovery in bus-off.
+            return
+        if self._recovery_thread is not None and self._recovery_thread.is_alive():
+            return
+        self._recovery_thread = threading.Thread(target=self._recoverInBackground, args=(self.handle.generation,),
+                                                 name='Recovery %s' % self.interface.value)
+        self._recovery_thread.daemon = True
+        self._recovery_thread.start()
+
+    def _recoverInBackground(self, generation):
+        try:
+            self.recover(generation)
+        except (CanError, NicanError) as e:
+            logger.error('recovering %s failed: %s', self.interface.value, e)
+
     def readStatus(self, pole_id, status):
         return self.transmit(ReadStatusCommandFrame(pole_id, status))
 
@@ -305,91 +871,396 @@ class RobotController(object):
         #if length > 600:
             #logger.warning('length should be smaller than 50! %s %s' % (id, length))
             #length = 600
-        if self.proxy is not None:
-            pole_id = self.proxy[0][pole_id-1]
-        return self.transmit(SetLengthCommandFrame(pole_id, length))
+        return self._write(SetLengthCommandFrame(self._toDevice(pole_id), length))
         
     def changePoleId(self, pole_id, new_pole_id):
+        self.mirror.invalidate(pole_id)
+        self.mirror.invalidate(new_pole_id)
+        if self.acceptance is not None and not self.acceptance.accepts(new_pole_id):
+            logger.warning('pole %s is filtered out by the interface, call configureFilter', new_pole_id)
         return self.transmit(ChangeIDCommandFrame(pole_id, new_pole_id))
     
     def resetPole(self, pole_id):
+        self.mirror.invalidate(pole_id)
         return self.transmit(ResetCommandFrame(pole_id))
     
     def setPoleMaxLength(self, pole_id, max_length):
-        return self.transmit(SetMaxLengthCommandFrame(pole_id, max_length))
-
-#     def transferToModel(self, model, block=False, timeout=5, force=False, ignore_previous=False, interval=0):
-#         if ignore_previous:
-#             self.current_model = model
-#             self.delta_model = model
-#         else:
-#             if self.current_model is None:
-#                 self.current_model = model
-#                 self.delta_model = model
-#                 logger.info('transfer to model %s' % model.index)
-#             else:
-#                 self.delta_model = model.delta(self.current_model)
-#                 logger.info('transfer from %s to model %s' % (self.current_model.index, model.index))
-#         self.target_model = model
-#         self.transferModelDeltaData(self.delta_model, block=block, timeout=timeout, force=force, interval=interval)
-# 
-#     def transferModelDeltaData(self, delta, block=False, timeout=5, force=False, interval=0):
-#         for key in delta:
-#             self.setPoleLength(key, delta[key])
-#             if interval:
-#                 time.sleep(interval)
-#         if block:
-#             self.waitForModelTransfer(timeout, force=force)
-# 
-#     def waitForModelTransfer(self, timeout=5, force=False):
-#         logger.info('waiting for transfer to model %s' % self.target_model.index)
-#         self.responses = self.receive(len(self.delta_model), timeout=timeout, force=force)
-#         logger.info('transfered to model %s' % self.target_model.index)
-#         self.delta_model = None
-#         self.current_model = self.target_model
-#         self.target_model = None
-
-#     def receive(self, length=100, timeout=0, force=False):
-#         self.received_frames = None
-#         num = self.getReceiveNumber()
-#         t = time.time()
-#         if not timeout:
-#             if num:
-#                 self.received_frames = ResponseSet(VCI_Receive(self.devicetype, self.deviceind, self.canind, num, waittime=self.receive_timeout))
-#             else:
-#                 self.received_frames = ResponseSet([])
-#             logger.debug('received: %s', self.received_frames)
-#             return self.received_frames
-#         while num < length and time.time() - t < timeout:
-#             time.sleep(0.2)
-#             num = self.getReceiveNumber()
-#         if num < length and force:
-#             self.received_frames = ResponseSet(VCI_Receive(self.devicetype, self.deviceind, self.canind, num, waittime=self.receive_timeout))
-#             logger.debug(self.received_frames)
-#             for id in self.received_frames:
-#                 self.delta_model.pop(id)
-#             logger.error("unable to receive %s poles' response" % self.delta_model.keys())
-#             raise CanError('Failed to get receive %s frames in %ss' % (length, timeout), self)
-#         else:
-#             if num:
-#                 self.received_frames = ResponseSet(VCI_Receive(self.devicetype, self.deviceind, self.canind, num, waittime=self.receive_timeout))
-#             else:
-#                 self.received_frames = ResponseSet([])
-#             if self.proxy is not None:
-#                 self.o_received_frames = self.received_frames
-#                 self.received_frames = ResponseSet([])
-#                 for k  in self.o_received_frames.keys():
-#                     o_id = self.proxy[1][k-1]
-#                     self.received_frames[o_id] = self.o_received_frames[k]
-#             logger.debug('received: %s', self.received_frames)
-#             return self.received_frames
-
-
-
-
-
-_preceives = (VCI_CAN_OBJ*100)()
-_psends = VCI_CAN_OBJ()
+        return self._write(SetMaxLengthCommandFrame(pole_id, max_length))
+
+    write_combiner = None
+
+    def enableWriteCombining(self, delay=0.01):
+        """Stage setPoleLength and setPoleMaxLength, the last command per pole winning.
+
+        The stage is sent as one batch `delay` seconds after its first
+        command, on flush(), and before any other command or transfer.
+        """
+        if self.write_combiner is None:
+            self.write_combiner = WriteCombiner(self, delay)
+        return self.write_combiner
+
+    def disableWriteCombining(self):
+        combiner, self.write_combiner = self.write_combiner, None
+        if combiner is not None:
+            combiner.close()
+
+    def flush(self):
+        """Send the staged commands now, return their number."""
+        if self.write_combiner is None:
+            return 0
+        return self.write_combiner.flush()
+
+    def _write(self, command_frame):
+        if self.write_combiner is not None:
+            self.write_combiner.stage(command_frame)
+            return 1
+        return self.transmit(command_frame)
+
+    current_model = None
+    target_model = None
+    delta_model = None
+
+    def transferToModel(self, model, block=False, timeout=5, force=False, ignore_previous=False, chunk_size=None):
+        """Send the lengths of `model` the poles did not confirm already.
+
+        The delta is computed against self.mirror, so poles that missed an
+        earlier transfer, were reset or timed out are sent again. With
+        `ignore_previous` the mirror is cleared and the whole model is sent.
+
+        Returns:
+            With `block`, the sorted ids of the poles that never confirmed.
+            Else the CommandBatch sent, see transferBatch.
+        """
+        self.delta_model = self.modelDelta(model, ignore_previous)
+        if ignore_previous:
+            self.current_model = model
+        elif self.current_model is None:
+            self.current_model = model
+            logger.info('transfer to model %s', model.index)
+        else:
+            logger.info('transfer from %s to model %s', self.current_model.index, model.index)
+        self.target_model = model
+        return self.transferModelDeltaData(self.delta_model, block=block, timeout=timeout, force=force, chunk_size=chunk_size)
+
+    def modelDelta(self, model, ignore_previous=False):
+        """Return the BodyModelDeltaData of the lengths of `model` the poles did not confirm.
+
+        Staged writes are sent first, the delta then covers the poles they
+        move. With `ignore_previous` the mirror is cleared and the delta is
+        the whole model.
+        """
+        self.flush()
+        if ignore_previous:
+            self.mirror.invalidate()
+            return BodyModelDeltaData(model)
+        return BodyModelDeltaData(self.mirror.delta(model, self._toDevice))
+
+    def transferModelDeltaData(self, delta, block=False, timeout=5, force=False, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = self.getWriteQueueLength()
+        return self.transferBatch(self.deltaBatch(delta, chunk_size), block=block, timeout=timeout, force=force)
+
+    def transferTransition(self, transition, block=False, timeout=5, force=False):
+        """Like transferToModel, with the delta and the frames of a precomputed playlist.Transition.
+
+        Poles of the model the mirror has no confirmation for and that are
+        not written by the transition, e.g. poles that stayed unconfirmed
+        after an earlier transfer, are sent along with its frames.
+        """
+        if self.current_model is not None and transition.from_index != self.current_model.index:
+            logger.warning('transition from %s sent while at model %s', transition.from_index, self.current_model.index)
+        logger.info('transfer from %s to model %s', transition.from_index, transition.to_index)
+        self.flush()
+        batch = transition.batch.rewind()
+        delta = transition.delta
+        missed = [(pole_id, length) for pole_id, length in self.mirror.delta(transition.model, self._toDevice, pending=False)
+                  if pole_id not in delta]
+        if missed:
+            logger.info('resending %s unconfirmed poles with transition to model %s', len(missed), transition.to_index)
+            delta = BodyModelDeltaData(delta)
+            delta.update(missed)
+            batch = self.deltaBatch(delta, batch.chunk_size)
+        self.delta_model = delta
+        self.target_model = transition.model
+        return self.transferBatch(batch, block=block, timeout=timeout, force=force)
+
+    def deltaBatch(self, delta, chunk_size, pool=None):
+        """Return the CommandBatch of the SetLength commands of a model delta, in pole order.
+
+        The batch is packed into `pool` if given, a FramePool of the caller's.
+        """
+        pole_ids = sorted(delta.keys())
+        return CommandBatch.fromLengths(pole_ids, [delta[key] for key in pole_ids], chunk_size, self.pole_map, pool)
+
+    def transferBatch(self, batch, block=False, timeout=5, force=False):
+        """Send a CommandBatch of SetLength commands as the current transfer.
+
+        Returns:
+            With `block`, the sorted ids of the poles that never confirmed,
+            see waitForModelTransfer. Else the batch, sent.
+        """
+        if self.transfer_waiter is not None:
+            # Nobody waits for the previous transfer any more.
+            self.transfer_waiter.receiver.cancel(self.transfer_waiter)
+        # Expect the responses before sending, the first ones may arrive before transmitBatch returns.
+        self.transfer_waiter = self.startReceiver().expect(batch.ids, COMMAND_INDEX_LENGTH)
+        self.transfer_batch = batch
+        try:
+            self.transmitBatch(batch)
+        except CanError:
+            self.receiver.cancel(self.transfer_waiter)
+            raise
+        if block:
+            return self.waitForModelTransfer(timeout, force=force)
+        return batch
+
+    def waitForModelTransfer(self, timeout=5, force=False, retries=None):
+        """Wait for the poles of the last transfer to confirm, resending to the silent ones.
+
+        The frames of the poles that did not answer are sent again up to
+        `retries` times, after a delay doubling from `retry_backoff` up to
+        `max_retry_backoff` seconds. The first delay also covers the frames
+        still in the write queue.
+
+        Args:
+            timeout: Seconds the whole transfer, retries included, may take.
+            force: Raise TransferIncompleteError when some poles never confirmed.
+            retries: Overrides self.retries for this transfer.
+
+        Returns:
+            The sorted ids of the poles that never confirmed, empty on success.
+        """
+        if self.target_model is not None:
+            logger.info('waiting for transfer to model %s', self.target_model.index)
+        waiter = self.transfer_waiter
+        if retries is None:
+            retries = self.retries
+        deadline = time.time() + timeout
+        delay = self.retry_backoff
+        if self._scheduler is not None:
+            delay += max(0.0, self._scheduler.queue_empty_at - time.time())
+        positions = []
+        while True:
+            remaining = max(0.0, deadline - time.time())
+            complete = waiter.wait(min(delay, remaining) if retries > 0 else remaining)
+            positions.extend(waiter.positions)
+            if complete or retries <= 0 or time.time() >= deadline:
+                break
+            # An expired waiter is done, expect the silent poles again before resending to them.
+            waiter = self.transfer_waiter = self.receiver.expect(list(waiter.missing), COMMAND_INDEX_LENGTH)
+            self._retransmit(waiter.missing)
+            retries -= 1
+            delay = min(delay * 2, self.max_retry_backoff)
+        self.responses = self._responseSet(self.receiver.decode(positions))
+        self.unconfirmed = sorted(self._fromDevice(i) for i in waiter.missing)
+        if not complete:
+            logger.error("unable to receive %s poles' response", self.unconfirmed)
+            if force:
+                raise TransferIncompleteError('Failed to get receive %s frames in %ss' % (len(self.unconfirmed), timeout),
+                                              self, self.unconfirmed)
+        if self.target_model is not None:
+            logger.info('transfered to model %s', self.target_model.index)
+        self.delta_model = None
+        self.current_model = self.target_model
+        self.target_model = None
+        return self.unconfirmed
+
+    def _retransmit(self, pole_ids):
+        pole_ids = set(pole_ids)
+        batch = self.transfer_batch
+        command_frames = batch.commandFrames(k for k, pole_id in enumerate(batch.ids) if pole_id in pole_ids)
+        if not command_frames:
+            return
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('retransmitting to poles %s', sorted(self._fromDevice(c.id) for c in command_frames))
+        self.frames_retransmitted += len(command_frames)
+        self.transmitBatch(command_frames, batch.chunk_size, supersede=True)
+
+    receiver = None
+    transfer_waiter = None
+    transfer_batch = None
+    unconfirmed = None
+    retries = 3
+    retry_backoff = 0.05
+    max_retry_backoff = 1.0
+    frames_retransmitted = 0
+
+    def startReceiver(self, capacity=4096):
+        """Start reading responses in the background, return the ResponseReceiver."""
+        if self.receiver is None:
+            self.receiver = self.handle.acquireReceiver(capacity)
+            self._router = self.handle.router
+            self._router.add(self.inflight)
+            self.receiver.addListener(self.metrics.onResponses)
+            if self.acceptance is not None:
+                self.receiver.addListener(self.acceptance.onResponses)
+            self.receiver.addErrorListener(self._onBusError)
+            if self.capture is not None:
+                self.receiver.addListener(self._captureResponses)
+            self._receive_cursor = self.receiver.head
+        return self.receiver
+
+    def stopReceiver(self):
+        if self.receiver is not None:
+            self._router.remove(self.inflight)
+            self.receiver.removeListener(self.metrics.onResponses)
+            if self.acceptance is not None:
+                self.receiver.removeListener(self.acceptance.onResponses)
+            self.receiver.removeErrorListener(self._onBusError)
+            if self.capture is not None:
+                self.receiver.removeListener(self._captureResponses)
+            self.handle.releaseReceiver()
+            self.receiver = None
+
+    def configureFilter(self, pole_ids=None):
+        """Accept only the extended frames of `pole_ids` in hardware.
+
+        The comparator and mask are computed from the device ids of the poles
+        under the current PoleMap, call it again after rewiring a pole or
+        changing a pole id. The interface is reopened with the new
+        configuration when it changes, the receiver and capture resume on it.
+
+        Args:
+            pole_ids: Pole ids on the bus, the ones of the last call if None.
+
+        Raises:
+            ValueError: Other controllers use the interface with its current configuration.
+        """
+        if pole_ids is not None:
+            self.pole_ids = list(pole_ids)
+        if self.pole_ids is None:
+            raise ValueError('no pole ids to filter on')
+        self._reconfigure(AcceptanceFilter.fromPoles(self.pole_ids, self.pole_map))
+        return self.acceptance
+
+    def clearFilter(self):
+        """Accept every extended frame again."""
+        self.pole_ids = None
+        self._reconfigure(None)
+
+    def _setAcceptance(self, acceptance):
+        if acceptance is None:
+            self.AttrValueList[6], self.AttrValueList[7] = 0, NC_CAN_MASK_XTD_DONTCARE
+        else:
+            self.AttrValueList[6], self.AttrValueList[7] = acceptance.comparator, acceptance.mask
+        if self.receiver is not None:
+            if self.acceptance is not None:
+                self.receiver.removeListener(self.acceptance.onResponses)
+            if acceptance is not None:
+                self.receiver.addListener(acceptance.onResponses)
+        self.acceptance = acceptance
+
+    def _reconfigure(self, acceptance):
+        previous = self.acceptance
+        config = tuple(self.AttrValueList)
+        self._setAcceptance(acceptance)
+        if tuple(self.AttrValueList) == config:
+            return
+        self.flush()
+        receiving = self.receiver is not None
+        self.stopReceiver()
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            self.scheduler.capture = None
+        self.registry.release(self.handle)
+        try:
+            self.handle = self.registry.acquire(self.interface.value, self.AttrIdList, self.AttrValueList)
+        except ValueError:
+            self._setAcceptance(previous)
+            self.handle = self.registry.acquire(self.interface.value, self.AttrIdList, self.AttrValueList)
+            raise
+        finally:
+            self.objHandle = self.handle.objHandle
+            self.capture = capture
+            if capture is not None:
+                self.scheduler.capture = capture
+            if receiving or capture is not None:
+                self.startReceiver()
+        if acceptance is None:
+            logger.info('%s accepts all extended ids', self.interface.value)
+        else:
+            logger.info('%s accepts extended ids %x/%x', self.interface.value, acceptance.comparator, acceptance.mask)
+
+    capture = None
+
+    def startCapture(self, filename, capacity=65536):
+        """Record every frame sent and received to a capture file, return its CaptureWriter."""
+        self.stopCapture()
+        self.capture = CaptureWriter(filename, capacity)
+        self.scheduler.capture = self.capture
+        if self.receiver is not None:
+            self.receiver.addListener(self._captureResponses)
+        else:
+            self.startReceiver()
+        return self.capture
+
+    def stopCapture(self):
+        if self.capture is None:
+            return
+        if self.receiver is not None:
+            self.receiver.removeListener(self._captureResponses)
+        self.scheduler.capture = None
+        self.capture.close()
+        self.capture = None
+
+    def _captureResponses(self, start, stop, decoded):
+        # The reader reads into a contiguous slice of the ring, still untouched while listeners run.
+        position = start % self.receiver.capacity
+        self.capture.append(RECEIVED, self.receiver.array[position:position + stop - start])
+
+    def receive(self, length=100, timeout=0, force=False):
+        """Return the responses received since the last call.
+
+        With a timeout, wait until at least `length` responses are there or the
+        timeout passed, raising CanError in the latter case if `force` is set.
+        """
+        receiver = self.startReceiver()
+        start = self._receive_cursor
+        complete = True
+        if timeout:
+            complete = receiver.expectCount(start, length).wait(timeout)
+        stop = receiver.head
+        self._receive_cursor = stop
+        self.received_frames = self._responseSet(receiver.decodeRange(start, stop))
+        logger.debug('received: %s', self.received_frames)
+        if not complete and force:
+            logger.error("unable to receive %s responses, got %s", length, stop - start)
+            raise CanError('Failed to get receive %s frames in %ss' % (length, timeout), self)
+        return self.received_frames
+
+    @property
+    def proxy(self):
+        """The PoleMap, set it to a PoleMap or to [forward, reverse] lists of device ids."""
+        return self.pole_map
+
+    @proxy.setter
+    def proxy(self, proxy):
+        if proxy is not None and not isinstance(proxy, PoleMap):
+            proxy = PoleMap.fromProxy(proxy)
+        self.pole_map = proxy
+
+    def _toDevice(self, pole_id):
+        if self.pole_map is not None:
+            return self.pole_map.toDevice(pole_id)
+        return pole_id
+
+    def _fromDevice(self, pole_id):
+        if self.pole_map is not None:
+            return self.pole_map.fromDevice(pole_id)
+        return pole_id
+
+    def _responseSet(self, decoded):
+        responses = decoded.pole_id >= 0
+        if not responses.all():
+            # Error frames, see canreceiver.dataFramesOnly.
+            decoded = DecodedResponses(*[column[responses] for column in decoded])
+        if self.pole_map is not None:
+            decoded = self.pole_map.mapDecoded(decoded)
+        return ResponseSet.fromDecoded(decoded)
+
+
+_preceives = (NCTYPE_CAN_STRUCT*100)()
+_psends = NCTYPE_CAN_FRAME()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+"""Hardware acceptance filtering of the extended frames of the poles.
+
+With NC_ATTR_CAN_MASK_XTD at NC_CAN_MASK_XTD_DONTCARE the interface queues
+every extended frame on the bus and the reader decodes them all in Python.
+AcceptanceFilter derives NC_ATTR_CAN_COMP_XTD and NC_ATTR_CAN_MASK_XTD from
+the device ids the poles answer with, so the interface drops the frames of
+other nodes itself. A mask bit set to 1 makes the bit of the arbitration id
+match the comparator, the mask keeps the bits all device ids agree on.
+
+One comparator and mask accept a superset of the ids, e.g. 1..120 accepts
+0..127. The frames of ids accepted by the hardware that are no pole's are
+counted in `slipped` by the onResponses listener.
+"""
+import numpy
+
+from nican import NC_ATTR_CAN_COMP_XTD, NC_ATTR_CAN_MASK_XTD
+
+ARBID_XTD_BITS = 0x1FFFFFFF
+
+
+class AcceptanceFilter(object):
+    """Comparator and mask accepting the extended frames of `device_ids`.
+
+    Args:
+        device_ids: Arbitration ids the poles answer with, without NC_FL_CAN_ARBID_XTD.
+    """
+    def __init__(self, device_ids):
+        self.device_ids = numpy.unique(numpy.asarray(list(device_ids), numpy.int64) & ARBID_XTD_BITS)
+        if not len(self.device_ids):
+            raise ValueError('an acceptance filter needs at least one device id')
+        first = int(self.device_ids[0])
+        differing = int(numpy.bitwise_or.reduce(self.device_ids ^ first))
+        self.mask = ~differing & ARBID_XTD_BITS
+        self.comparator = first & self.mask
+        self.resetStats()
+
+    @classmethod
+    def fromPoles(cls, pole_ids, pole_map=None):
+        """Build the filter of `pole_ids`, mapped to device ids by `pole_map` if any."""
+        pole_ids = list(pole_ids)
+        if pole_map is not None:
+            return cls(pole_map.toDeviceArray(pole_ids).tolist())
+        return cls(pole_ids)
+
+    def config(self):
+        """Return the (attribute id, value) pairs to pass to NC_Config."""
+        return [(NC_ATTR_CAN_COMP_XTD, self.comparator), (NC_ATTR_CAN_MASK_XTD, self.mask)]
+
+    def accepts(self, arbitration_id):
+        """Whether the interface accepts an extended frame with `arbitration_id`."""
+        return (arbitration_id & self.mask) == self.comparator
+
+    @property
+    def accepted(self):
+        """Number of arbitration ids the comparator and mask accept."""
+        return 1 << (bin(ARBID_XTD_BITS & ~self.mask).count('1'))
+
+    def resetStats(self):
+        self.frames = 0
+        self.slipped = 0
+
+    def onResponses(self, start, stop, decoded):
+        """ResponseReceiver listener counting the data frames of no pole."""
+        self.frames += int(stop - start)
+        responses = decoded.pole_id >= 0
+        self.slipped += int((responses & ~numpy.in1d(decoded.arbitration_id, self.device_ids)).sum())
+
+    def stats(self):
+        return {
+            'comparator': self.comparator,
+            'mask': self.mask,
+            'accepted_ids': self.accepted,
+            'frames': self.frames,
+            'slipped': self.slipped,
+        }
@@ -0,0 +1,97 @@
+"""Frames/sec of the command frame encoders and the response decoders.
+
+Usage: python benchmarks/bench_codec.py [number of frames]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CanController import *
+
+
+def _hexStringFill(command_frame, vco):
+    # CommandFrame.fillStructure before cancodec, kept as the reference.
+    vco.ArbitrationId = command_frame.id | NC_FL_CAN_ARBID_XTD
+    vco.FrameType = NC_FRMTYPE_DATA
+    vco.DataLength = 8
+    data = vco.Data
+    data[0] = command_frame.id
+    data[1] = command_frame.command_type
+    data[2] = command_frame.command_index
+    array = "%010X"%command_frame.command_data
+    for i in range(5):
+        data[i+3] = int(array[i*2:i*2+2], 16)
+    command_frame.command_buffer = vco
+
+
+def benchHexString(pole_ids, values):
+    for pole_id, value in zip(pole_ids, values):
+        _hexStringFill(SetLengthCommandFrame(pole_id, value), NCTYPE_CAN_STRUCT())
+
+def benchFillStructure(pole_ids, values):
+    for pole_id, value in zip(pole_ids, values):
+        SetLengthCommandFrame(pole_id, value).fillStructure(NCTYPE_CAN_STRUCT())
+
+def benchPoolEncode(pole_ids, values, pool=FramePool(1)):
+    encode = pool.encode
+    for pole_id, value in zip(pole_ids, values):
+        encode(pole_id, COMMAND_TYPE_WRITE, COMMAND_INDEX_LENGTH, value)
+
+def benchPoolEncodeMany(pole_ids, values, pool=FramePool(500)):
+    for start in range(0, len(pole_ids), pool.size):
+        pool.encodeMany(pole_ids[start:start + pool.size], values[start:start + pool.size])
+
+
+def benchResponseData(frames):
+    for frame in frames:
+        ResponseFrame(frame).data
+
+def benchDecodeResponses(frames):
+    decodeResponses(viewFrames(frames, len(frames))).data.tolist()
+
+
+benchmarks = [
+    ('hex string fillStructure', benchHexString),
+    ('CommandFrame.fillStructure', benchFillStructure),
+    ('FramePool.encode', benchPoolEncode),
+    ('FramePool.encodeMany', benchPoolEncodeMany),
+]
+
+# Decoders run on an NCTYPE_CAN_STRUCT array of responses.
+decoders = [
+    ('ResponseFrame.data', benchResponseData),
+    ('decodeResponses', benchDecodeResponses),
+]
+
+def _best(function, args, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        function(*args)
+        elapsed = time.time() - t
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(num_frames=200000, repeat=3):
+    """Return [(name, frames per second)], best of `repeat` runs."""
+    pole_ids = [i % 250 + 1 for i in range(num_frames)]
+    values = [(i * 7) % 600 for i in range(num_frames)]
+    results = []
+    for name, bench in benchmarks:
+        results.append((name, num_frames / _best(bench, (pole_ids, values), repeat)))
+    pool = FramePool(num_frames)
+    pool.encodeMany(pole_ids, values, RESPONSE_OK)
+    for name, bench in decoders:
+        results.append((name, num_frames / _best(bench, (pool.frames,), repeat)))
+    return results
+
+
+if __name__ == '__main__':
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    results = run(num_frames)
+    reference = results[0][1]
+    for name, rate in results:
+        print "%-28s %12.0f frames/s  x%.1f" % (name, rate, rate / reference)
@@ -0,0 +1,80 @@
+"""Models/sec of the model library parsing, serialization and deltas.
+
+Usage: python benchmarks/bench_models.py [number of models] [number of poles]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CanController import *
+from modellibrary import *
+from libraries import generateModels
+
+
+def _best(function, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        function()
+        elapsed = time.time() - t
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(num_models=1000, num_poles=100, repeat=3):
+    """Return [(name, rate, unit)], best of `repeat` runs."""
+    models = generateModels(num_models, num_poles)
+    text = BodyModelData.serializeModels(models)
+    names = models.ordered
+    pairs = min(num_models - 1, 1000)
+    dicts = [BodyModelData(models[name]) for name in names[:pairs + 1]]
+    results = []
+
+    def parse():
+        BodyModelData.parseModelsFromString(text)
+    results.append(('parseModelsFromString', num_models / _best(parse, repeat), 'models/s'))
+
+    def serialize():
+        BodyModelData.serializeModels(models)
+    results.append(('serializeModels', num_models / _best(serialize, repeat), 'models/s'))
+
+    def dictDelta():
+        for i in range(pairs):
+            dicts[i + 1].delta(dicts[i])
+    results.append(('BodyModelData.delta', pairs / _best(dictDelta, repeat), 'deltas/s'))
+
+    def matrixDelta():
+        for i in range(pairs):
+            models.delta(names[i + 1], names[i])
+    results.append(('BodyModels.delta', pairs / _best(matrixDelta, repeat), 'deltas/s'))
+
+    def matrixDeltas():
+        models.deltas(names)
+    results.append(('BodyModels.deltas', (num_models - 1) / _best(matrixDeltas, repeat), 'deltas/s'))
+
+    fd, filename = tempfile.mkstemp(suffix='.npml')
+    os.close(fd)
+    try:
+        saveLibrary(models, filename)
+        library = ModelLibrary(filename)
+        try:
+            def libraryModels():
+                for row in range(pairs):
+                    library.model(row)
+            results.append(('ModelLibrary.model', pairs / _best(libraryModels, repeat), 'models/s'))
+        finally:
+            library.close()
+    finally:
+        os.remove(filename)
+    return results
+
+
+if __name__ == '__main__':
+    num_models = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_poles = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for name, rate, unit in run(num_models, num_poles):
+        print "%-28s %12.0f %s" % (name, rate, unit)
@@ -0,0 +1,55 @@
+"""End-to-end model transfers against the simulated NI-CAN driver.
+
+The simulated bus runs at the configured 125 kbit/s, so the rates measure
+how close the controller gets to the bus limit rather than raw CPU speed.
+
+Usage: python benchmarks/bench_transfer.py [number of poles] [number of transfers]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nican
+from nicansim import SimulatedNican
+from CanController import *
+from libraries import generateModels
+
+
+def run(num_poles=100, num_transfers=10, changed=0.2, latency=0.001):
+    """Return [(name, rate, unit)] of full and delta transfers of `num_poles` poles."""
+    nican.setBackend(SimulatedNican(poles=num_poles, latency=latency, seed=0))
+    controller = RobotController()
+    controller.startReceiver()
+    try:
+        models = generateModels(num_transfers + 1, num_poles, changed)
+        names = models.ordered
+        results = []
+
+        t = time.time()
+        controller.transferToModel(models[names[0]], block=True, force=True)
+        elapsed = time.time() - t
+        results.append(('transfer full model', 1 / elapsed, 'transfers/s'))
+        results.append(('transfer full model frames', num_poles / elapsed, 'frames/s'))
+
+        frames = 0
+        controller.resetBusStats()
+        t = time.time()
+        for name in names[1:]:
+            frames += len(models.delta(name, controller.current_model.index))
+            controller.transferToModel(models[name], block=True, force=True)
+        elapsed = time.time() - t
+        results.append(('transfer delta', num_transfers / elapsed, 'transfers/s'))
+        results.append(('transfer delta frames', frames / elapsed, 'frames/s'))
+        results.append(('transfer delta bus utilisation', controller.busUtilisation(), 'ratio'))
+        return results
+    finally:
+        controller.close()
+
+
+if __name__ == '__main__':
+    num_poles = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    num_transfers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for name, rate, unit in run(num_poles, num_transfers):
+        print "%-32s %10.2f %s" % (name, rate, unit)
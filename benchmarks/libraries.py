@@ -0,0 +1,41 @@
+"""Generated model libraries for the benchmarks.
+
+A library is a random walk: every model moves a fraction of the poles of the
+previous one, like the consecutive frames of a show.
+"""
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CanController import *
+
+# name -> (poles, models)
+SIZES = [
+    ('small', (100, 1000)),
+    ('medium', (300, 10000)),
+    ('large', (500, 50000)),
+]
+
+
+def generateMatrix(num_models, num_poles, changed=0.2, max_length=600, seed=0):
+    """Return a num_models x num_poles int32 matrix of pole lengths."""
+    random = numpy.random.RandomState(seed)
+    matrix = numpy.empty((num_models, num_poles), numpy.int32)
+    matrix[0] = random.randint(50, max_length, num_poles)
+    for row in range(1, num_models):
+        moves = random.random_sample(num_poles) < changed
+        matrix[row] = numpy.where(moves, random.randint(50, max_length, num_poles), matrix[row - 1])
+    return matrix
+
+def generateModels(num_models, num_poles, changed=0.2, seed=0):
+    """Return a BodyModels of `num_models` models of poles 1 to num_poles."""
+    names = [unicode(i) for i in range(1, num_models + 1)]
+    return BodyModels.fromMatrix(names, range(1, num_poles + 1),
+                                 generateMatrix(num_models, num_poles, changed, seed=seed))
+
+def generateText(num_models, num_poles, changed=0.2, seed=0):
+    """Return a generated library in the text format of BodyModelData.serializeModels."""
+    return BodyModelData.serializeModels(generateModels(num_models, num_poles, changed, seed))
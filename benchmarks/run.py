@@ -0,0 +1,101 @@
+"""Run the benchmark suite, save the results as JSON and compare them with a baseline.
+
+Every result is a rate, higher is better. A benchmark regressed when its rate
+dropped below (1 - threshold) times the baseline's.
+
+Usage:
+    python benchmarks/run.py [--size small|medium|large] [--output results.json]
+                             [--baseline baseline.json] [--threshold 0.1]
+
+Exits with status 1 when a benchmark regressed against the baseline.
+"""
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_codec
+import bench_models
+import bench_transfer
+from libraries import SIZES
+
+# Thresholds of the benchmarks timed on the simulated bus, they depend on sleeps and threads.
+THRESHOLDS = {
+    'transfer': 0.25,
+}
+
+
+def runSuite(size='small', repeat=5):
+    """Return the results of every benchmark as a dict of name -> {'value', 'unit'}."""
+    num_poles, num_models = dict(SIZES)[size]
+    results = {}
+    for name, rate in bench_codec.run(repeat=repeat):
+        results['codec.' + name] = {'value': rate, 'unit': 'frames/s'}
+    for name, rate, unit in bench_models.run(num_models, num_poles, repeat):
+        results['models.' + name] = {'value': rate, 'unit': unit}
+    for name, rate, unit in bench_transfer.run(num_poles):
+        results['transfer.' + name] = {'value': rate, 'unit': unit}
+    return {
+        'size': size,
+        'poles': num_poles,
+        'models': num_models,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+
+def compare(results, baseline, threshold=0.1):
+    """Return [(name, value, baseline value, ratio, regressed)] of the benchmarks found in both."""
+    rows = []
+    for name in sorted(results['results']):
+        if name not in baseline['results']:
+            continue
+        value = results['results'][name]['value']
+        reference = baseline['results'][name]['value']
+        limit = THRESHOLDS.get(name.split('.')[0], threshold)
+        ratio = value / reference if reference else float('inf')
+        rows.append((name, value, reference, ratio, ratio < 1 - limit))
+    return rows
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--size', default='small', choices=[name for name, _ in SIZES],
+                      help='generated library size: %s' % ', '.join('%s (%s poles, %s models)' % ((name,) + size)
+                                                                   for name, size in SIZES))
+    parser.add_option('--repeat', type='int', default=5, help='runs per benchmark, the best one counts')
+    parser.add_option('--output', help='write the results to this JSON file')
+    parser.add_option('--baseline', help='compare with the results in this JSON file')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='fraction a rate may drop below the baseline, default 0.1')
+    options, _ = parser.parse_args(argv)
+
+    results = runSuite(options.size, options.repeat)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if not options.baseline:
+        for name in sorted(results['results']):
+            result = results['results'][name]
+            print "%-48s %14.2f %s" % (name, result['value'], result['unit'])
+        return 0
+
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('size') != results['size']:
+        print "warning: baseline size %s, results size %s" % (baseline.get('size'), results['size'])
+    regressions = 0
+    for name, value, reference, ratio, regressed in compare(results, baseline, options.threshold):
+        regressions += regressed
+        print "%-48s %14.2f %14.2f  x%.2f%s" % (name, value, reference, ratio, '  REGRESSION' if regressed else '')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""Encoding of pole commands and decoding of pole responses in NI-CAN frame buffers.
+
+A pole command is an extended frame whose arbitration id is the pole id and
+whose 8 data bytes are the pole id, the command type, the command index and
+the 40 bit big-endian command value. The encoders here write the header
+fields and the data bytes with two struct.pack_into calls per frame, without
+formatting strings or allocating frame objects.
+
+Responses have the same layout with the response status in place of the
+command type. The decoders view a NC_ReadMult buffer as a NumPy structured
+array and return whole columns for all frames of a read.
+"""
+import struct
+from collections import namedtuple
+from ctypes import *
+
+import numpy
+
+from nican import *
+
+_DATA = struct.Struct('>Q')
+_VALUE_MASK = (1 << 40) - 1
+
+
+class _FrameLayout(object):
+    def __init__(self, frame_type):
+        self.size = sizeof(frame_type)
+        self.id_offset = frame_type.ArbitrationId.offset
+        self.data_offset = frame_type.Data.offset
+        # FrameType / IsRemote and DataLength follow ArbitrationId in both structures.
+        self.header = struct.Struct('<IBB')
+        assert frame_type.DataLength.offset == self.id_offset + 5
+
+_layouts = {
+    NCTYPE_CAN_STRUCT: _FrameLayout(NCTYPE_CAN_STRUCT),
+    NCTYPE_CAN_FRAME: _FrameLayout(NCTYPE_CAN_FRAME),
+}
+
+
+def packData(pole_id, command_type, command_index, value):
+    """Return the 8 data bytes of a command as one big-endian integer."""
+    return ((pole_id & 0xFF) << 56) | (command_type << 48) | (command_index << 40) | (value & _VALUE_MASK)
+
+def encodeFrame(frame, pole_id, command_type, command_index, value):
+    """Fill a NCTYPE_CAN_STRUCT or NCTYPE_CAN_FRAME with a pole command."""
+    layout = _layouts[type(frame)]
+    layout.header.pack_into(frame, layout.id_offset, pole_id | NC_FL_CAN_ARBID_XTD, NC_FRMTYPE_DATA, 8)
+    _DATA.pack_into(frame, layout.data_offset, packData(pole_id, command_type, command_index, value))
+
+
+class FramePool(object):
+    """Preallocated frame array reused for every encode.
+
+    Frames returned by encode and encodeMany stay valid until the pool encodes
+    over them again, callers must hand them to the driver before reusing the pool.
+
+    Args:
+        size: Number of frames in the pool.
+        frame_type: NCTYPE_CAN_STRUCT (for NC_WriteMult) or NCTYPE_CAN_FRAME (for NC_Write).
+    """
+    def __init__(self, size, frame_type=NCTYPE_CAN_STRUCT):
+        self.size = size
+        self.frame_type = frame_type
+        self.frames = (frame_type*size)()
+        self._layout = _layouts[frame_type]
+        self._views = {}
+
+    def view(self, num):
+        """Return the first `num` frames of the pool as an array sharing its memory."""
+        frames = self._views.get(num)
+        if frames is None:
+            if num > self.size:
+                raise ValueError("Pool of %s frames can't hold %s frames" % (self.size, num))
+            frames = (self.frame_type*num).from_buffer(self.frames)
+            self._views[num] = frames
+        return frames
+
+    def encode(self, pole_id, command_type, command_index, value, i=0):
+        """Encode one command into frame `i` of the pool and return that frame."""
+        layout = self._layout
+        offset = i * layout.size
+        layout.header.pack_into(self.frames, offset + layout.id_offset,
+                                pole_id | NC_FL_CAN_ARBID_XTD, NC_FRMTYPE_DATA, 8)
+        _DATA.pack_into(self.frames, offset + layout.data_offset,
+                        packData(pole_id, command_type, command_index, value))
+        return self.frames[i]
+
+    def encodeMany(self, pole_ids, values, command_type=COMMAND_TYPE_WRITE, command_index=COMMAND_INDEX_LENGTH):
+        """Encode one command per (pole id, value) pair into the start of the pool.
+
+        Returns:
+            An array of the encoded frames, ready for NC_WriteMult.
+        """
+        num = len(pole_ids)
+        if num != len(values):
+            raise ValueError("Got %s pole ids and %s values" % (num, len(values)))
+        frames = self.view(num)
+        layout = self._layout
+        header = layout.header.pack_into
+        data = _DATA.pack_into
+        buf = self.frames
+        offset = 0
+        size = layout.size
+        id_offset = layout.id_offset
+        data_offset = layout.data_offset
+        command = (command_type << 48) | (command_index << 40)
+        for pole_id, value in zip(pole_ids, values):
+            header(buf, offset + id_offset, pole_id | NC_FL_CAN_ARBID_XTD, NC_FRMTYPE_DATA, 8)
+            data(buf, offset + data_offset, ((pole_id & 0xFF) << 56) | command | (value & _VALUE_MASK))
+            offset += size
+        return frames
+
+    def encodeCommands(self, pole_ids, command_types, command_indexes, values):
+        """Like encodeMany, with a command type and index per command."""
+        num = len(pole_ids)
+        frames = self.view(num)
+        layout = self._layout
+        header = layout.header.pack_into
+        data = _DATA.pack_into
+        buf = self.frames
+        offset = 0
+        size = layout.size
+        id_offset = layout.id_offset
+        data_offset = layout.data_offset
+        for pole_id, command_type, command_index, value in zip(pole_ids, command_types, command_indexes, values):
+            header(buf, offset + id_offset, pole_id | NC_FL_CAN_ARBID_XTD, NC_FRMTYPE_DATA, 8)
+            data(buf, offset + data_offset, packData(pole_id, command_type, command_index, value))
+            offset += size
+        return frames
+
+
+def _canStructDtype():
+    fields = [(name, NCTYPE_CAN_STRUCT.__dict__[name].offset) for name, _ in NCTYPE_CAN_STRUCT._fields_]
+    formats = {'Timestamp': '<u8', 'ArbitrationId': '<u4', 'FrameType': 'u1', 'DataLength': 'u1', 'Data': ('u1', 8)}
+    names = [name for name, _ in fields]
+    offsets = [offset for _, offset in fields]
+    # Payload overlaps Data, it is the 8 data bytes read as one big-endian integer.
+    return numpy.dtype({
+        'names': names + ['Payload'],
+        'formats': [formats[name] for name in names] + ['>u8'],
+        'offsets': offsets + [NCTYPE_CAN_STRUCT.Data.offset],
+        'itemsize': sizeof(NCTYPE_CAN_STRUCT),
+    })
+
+CAN_STRUCT_DTYPE = _canStructDtype()
+
+# timestamp, arbitration_id, frame_type, pole_id, status and command are views
+# of the decoded buffer, data is computed from it.
+DecodedResponses = namedtuple('DecodedResponses',
+        ['timestamp', 'arbitration_id', 'frame_type', 'pole_id', 'status', 'command', 'data'])
+
+
+def viewFrames(frames, num=None):
+    """View a NCTYPE_CAN_STRUCT array as a structured array of CAN_STRUCT_DTYPE, without copying it."""
+    if num is None:
+        num = len(frames)
+    return numpy.frombuffer(frames, CAN_STRUCT_DTYPE, num)
+
+def decodeResponses(array):
+    """Split a structured array of CAN_STRUCT_DTYPE into DecodedResponses columns.
+
+    All columns but data share memory with `array`, they are only valid until
+    the buffer is read into again.
+    """
+    data = array['Data']
+    return DecodedResponses(
+            array['Timestamp'],
+            array['ArbitrationId'] & ~NC_FL_CAN_ARBID_XTD,
+            array['FrameType'],
+            data[:, 0],
+            data[:, 1],
+            data[:, 2],
+            array['Payload'] & _VALUE_MASK)
@@ -0,0 +1,299 @@
+"""Background reader draining an NI-CAN interface into a ring buffer.
+
+ResponseReceiver runs one thread per interface, blocked in NC_WaitForState
+until frames are available, and reads them with NC_ReadMult straight into a
+ring of NCTYPE_CAN_STRUCT. Threads waiting for responses register a waiter
+before sending their commands and are woken as soon as the reader has seen
+everything they expect, or when their deadline passes.
+"""
+import logging
+import threading
+import time
+from ctypes import *
+
+import numpy
+
+from nican import *
+from cancodec import *
+
+logger = logging.getLogger('shiyijian.robot')
+
+_timeout_status = c_int32(CanErrFunctionTimeout).value
+
+# Frames the interface reports bus trouble with, counted by ResponseReceiver.
+ERROR_FRAME_TYPES = (NC_FRMTYPE_COMM_ERR, NC_FRMTYPE_BUS_ERR, NC_FRMTYPE_TRANSCEIVER_ERR)
+# Error listener kind of an error status returned to the reader by the driver.
+READ_ERROR = 'read'
+# pole_id of the frames that are no response, error frames among them.
+NOT_A_RESPONSE = -1
+
+
+def dataFramesOnly(decoded):
+    """Return `decoded` with the pole_id of every frame that is not a data frame set to NOT_A_RESPONSE."""
+    others = decoded.frame_type != NC_FRMTYPE_DATA
+    if not others.any():
+        return decoded
+    pole_id = decoded.pole_id.astype(numpy.int64)
+    pole_id[others] = NOT_A_RESPONSE
+    return decoded._replace(pole_id=pole_id)
+
+
+class Waiter(object):
+    """Something a thread waits for in the frames read by a ResponseReceiver."""
+    def __init__(self):
+        self.deadline = None
+        self.complete = False
+        self.receiver = None
+        self._event = threading.Event()
+
+    def update(self, receiver, start, stop, decoded):
+        """Account frames [start, stop) of the ring, return True when satisfied."""
+        raise NotImplementedError
+
+    def ready(self, receiver):
+        """Return True if satisfied by the frames read before the waiter was added."""
+        return False
+
+    def wait(self, timeout=None):
+        """Block until satisfied or `timeout` seconds passed, return self.complete.
+
+        The deadline is checked by the reader thread, so a waiter is woken at
+        most one reader tick late and is never woken by a polling sleep.
+        """
+        if not self._event.is_set():
+            self.deadline = None if timeout is None else time.time() + timeout
+            if not self.receiver.running:
+                self.receiver.cancel(self)
+        self._event.wait()
+        return self.complete
+
+    def _finish(self, complete):
+        self.complete = complete
+        self._event.set()
+
+
+class ResponseWaiter(Waiter):
+    """Waits for one response from each of a set of poles.
+
+    Args:
+        pole_ids: Pole ids as found in Data[0] of the responses.
+        command: Only count responses to this command index, any if None.
+    """
+    def __init__(self, pole_ids, command=None):
+        super(ResponseWaiter, self).__init__()
+        self.missing = set(pole_ids)
+        self.command = command
+        self.positions = []
+
+    def update(self, receiver, start, stop, decoded):
+        missing = self.missing
+        commands = decoded.command.tolist() if self.command is not None else None
+        for i, pole_id in enumerate(decoded.pole_id.tolist()):
+            if pole_id in missing and (commands is None or commands[i] == self.command):
+                missing.discard(pole_id)
+                self.positions.append(start + i)
+        return not missing
+
+    def ready(self, receiver):
+        return not self.missing
+
+    def responses(self):
+        """Return the DecodedResponses of the frames that satisfied this waiter."""
+        return self.receiver.decode(self.positions)
+
+
+class CountWaiter(Waiter):
+    """Waits until the ring holds `count` frames from position `start` on."""
+    def __init__(self, start, count):
+        super(CountWaiter, self).__init__()
+        self.start = start
+        self.count = count
+
+    def update(self, receiver, start, stop, decoded):
+        return stop - self.start >= self.count
+
+    def ready(self, receiver):
+        return receiver.head - self.start >= self.count
+
+
+class ResponseReceiver(object):
+    """Reads every frame of an opened interface in a background thread.
+
+    Args:
+        objHandle: Handle of the opened NI-CAN interface.
+        capacity: Frames kept in the ring buffer, older frames are overwritten.
+        read_size: Maximum frames per NC_ReadMult.
+        tick: Milliseconds the reader blocks in NC_WaitForState, it bounds
+            how late a waiter's timeout and stop() are noticed.
+    """
+    def __init__(self, objHandle, capacity=4096, read_size=150, tick=10):
+        self.objHandle = objHandle
+        self.capacity = capacity
+        self.read_size = min(read_size, capacity)
+        self.tick = tick
+        self.frames = (NCTYPE_CAN_STRUCT*capacity)()
+        self.array = viewFrames(self.frames)
+        self.head = 0           # total number of frames ever read
+        self.lock = threading.Lock()
+        self.waiters = []
+        self.listeners = []
+        self.error_listeners = []
+        self.error_frames = dict((frame_type, 0) for frame_type in ERROR_FRAME_TYPES)
+        self.read_errors = 0
+        self.last_read_error = None
+        self._failing = False
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='ResponseReceiver')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self.lock:
+            waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter._finish(False)
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def expect(self, pole_ids, command=None):
+        """Register and return a ResponseWaiter, before sending the commands."""
+        return self.add(ResponseWaiter(pole_ids, command))
+
+    def expectCount(self, start, count):
+        """Register and return a CountWaiter for `count` frames from ring position `start` on."""
+        return self.add(CountWaiter(start, count))
+
+    def add(self, waiter):
+        waiter.receiver = self
+        with self.lock:
+            if waiter.ready(self):
+                waiter._finish(True)
+            else:
+                self.waiters.append(waiter)
+        return waiter
+
+    def addListener(self, listener):
+        """Call listener(start, stop, decoded) in the reader thread for every read."""
+        with self.lock:
+            self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        with self.lock:
+            self.listeners.remove(listener)
+
+    def addErrorListener(self, listener):
+        """Call listener(kind, count) in the reader thread for error frames and driver errors.
+
+        `kind` is the frame type of ERROR_FRAME_TYPES and `count` the number
+        of such frames in a read, or READ_ERROR and 1 when the driver returned
+        an error status to the reader, the NicanError is then last_read_error.
+        """
+        with self.lock:
+            self.error_listeners.append(listener)
+
+    def removeErrorListener(self, listener):
+        with self.lock:
+            self.error_listeners.remove(listener)
+
+    def cancel(self, waiter):
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        waiter._finish(waiter.complete)
+
+    def decode(self, positions):
+        """Return DecodedResponses of a copy of the frames at the given ring positions."""
+        with self.lock:
+            positions = numpy.asarray(positions, dtype=numpy.int64)
+            return decodeResponses(self.array[positions % self.capacity])
+
+    def decodeRange(self, start, stop):
+        """Return DecodedResponses of a copy of ring frames [start, stop), skipping overwritten ones."""
+        with self.lock:
+            start = max(start, self.head - self.capacity)
+            return dataFramesOnly(decodeResponses(self.array[numpy.arange(start, stop) % self.capacity]))
+
+    def _run(self):
+        state = c_ulong()
+        actual_size = c_ulong()
+        frame_size = sizeof(NCTYPE_CAN_STRUCT)
+        backend = getBackend()
+        while self._running:
+            try:
+                status = backend.ncWaitForState(self.objHandle, NC_ST_READ_AVAIL | NC_ST_READ_MULT,
+                                                self.tick, byref(state))
+                if status != STATUS_OK and status != _timeout_status:
+                    processStatus(status, "NC_WaitForState")
+                if state.value & (NC_ST_READ_AVAIL | NC_ST_READ_MULT):
+                    # Read straight into the ring until the driver queue is empty.
+                    while True:
+                        start = self.head
+                        pos = start % self.capacity
+                        size = min(self.read_size, self.capacity - pos)
+                        buf = (NCTYPE_CAN_STRUCT*size).from_buffer(self.frames, pos * frame_size)
+                        NC_ReadMult(self.objHandle, sizeof(buf), byref(buf), byref(actual_size))
+                        num = actual_size.value // frame_size
+                        if num:
+                            decoded = decodeResponses(self.array[pos:pos + num])
+                            if decoded.frame_type.any():
+                                decoded = self._errorFrames(decoded)
+                            self._dispatch(start, start + num, decoded)
+                        if num < size:
+                            break
+                self._failing = False
+            except NicanError as e:
+                # The interface is being recovered or needs to be, keep the reader alive.
+                self.read_errors += 1
+                self.last_read_error = e
+                if not self._failing:
+                    logger.warning('reading %s failed: %s', self.objHandle.value, e)
+                    self._failing = True
+                self._notifyErrors(READ_ERROR, 1)
+                time.sleep(self.tick / 1000.0)
+            self._expire()
+
+    def _errorFrames(self, decoded):
+        frame_types = decoded.frame_type.tolist()
+        for frame_type in ERROR_FRAME_TYPES:
+            count = frame_types.count(frame_type)
+            if count:
+                self.error_frames[frame_type] += count
+                self._notifyErrors(frame_type, count)
+        return dataFramesOnly(decoded)
+
+    def _notifyErrors(self, kind, count):
+        with self.lock:
+            listeners = list(self.error_listeners)
+        for listener in listeners:
+            listener(kind, count)
+
+    def _dispatch(self, start, stop, decoded):
+        with self.lock:
+            self.head = stop
+            for listener in self.listeners:
+                listener(start, stop, decoded)
+            done = [w for w in self.waiters if w.update(self, start, stop, decoded)]
+            for waiter in done:
+                self.waiters.remove(waiter)
+        for waiter in done:
+            waiter._finish(True)
+
+    def _expire(self):
+        now = time.time()
+        with self.lock:
+            expired = [w for w in self.waiters if w.deadline is not None and w.deadline <= now]
+            for waiter in expired:
+                self.waiters.remove(waiter)
+        for waiter in expired:
+            waiter._finish(False)
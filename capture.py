@@ -0,0 +1,288 @@
+"""Binary capture of the CAN traffic of a controller, and its replay.
+
+A capture file is a header followed by fixed-size records, all little-endian:
+
+    header      '<4sHHIQ' padded to 32 bytes: magic 'NCAP', version, record
+                size, reserved, number of records
+    records     32 bytes each: the host time (float64 seconds), the
+                direction (SENT or RECEIVED), a pad byte and the
+                NCTYPE_CAN_STRUCT as the driver returned it, hardware
+                Timestamp included
+
+CaptureWriter appends whole frame arrays to the memory-mapped file with one
+numpy assignment per field, growing the file by doubling. ReplayNican is an
+NI-CAN backend that plays the received frames of a capture back through
+NC_ReadMult, with their original timing or as fast as possible:
+
+    nican.setBackend(ReplayNican('incident.ncap'))
+    controller = RobotController()
+    controller.startReceiver()
+"""
+import mmap
+import struct
+import threading
+import time
+
+import numpy
+
+from nican import *
+from cancodec import *
+
+MAGIC = 'NCAP'
+VERSION = 1
+SENT = 0
+RECEIVED = 1
+
+_HEADER = struct.Struct('<4sHHIQ')
+HEADER_SIZE = 32
+RECORD_DTYPE = numpy.dtype({
+    'names': ['host_time', 'direction', 'frame'],
+    'formats': ['<f8', 'u1', CAN_STRUCT_DTYPE],
+    'offsets': [0, 8, 10],
+    'itemsize': 32,
+})
+
+
+class CaptureWriter(object):
+    """Appends frames to a new capture file.
+
+    Args:
+        filename: The file to create, an existing one is overwritten.
+        capacity: Records the file is sized for at first.
+    """
+    def __init__(self, filename, capacity=65536):
+        self.filename = filename
+        self.count = 0
+        self.lock = threading.Lock()
+        self._file = open(filename, 'w+b')
+        self._map = None
+        self._mapRecords(max(1, capacity))
+
+    def append(self, direction, frames, now=None):
+        """Record an NCTYPE_CAN_STRUCT array or CAN_STRUCT_DTYPE array of frames sent or received at `now`."""
+        if not isinstance(frames, numpy.ndarray):
+            frames = viewFrames(frames)
+        if now is None:
+            now = time.time()
+        num = len(frames)
+        with self.lock:
+            if self.count + num > len(self.records):
+                self._mapRecords(max(2 * len(self.records), self.count + num))
+            records = self.records[self.count:self.count + num]
+            records['host_time'] = now
+            records['direction'] = direction
+            records['frame'] = frames
+            self.count += num
+            _HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD_DTYPE.itemsize, 0, self.count)
+
+    def close(self):
+        with self.lock:
+            if self._map is None:
+                return
+            self.records = None
+            self._map.close()
+            self._map = None
+            self._file.truncate(HEADER_SIZE + self.count * RECORD_DTYPE.itemsize)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _mapRecords(self, capacity):
+        # The numpy view must go before the map it points to is closed.
+        self.records = None
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(HEADER_SIZE + capacity * RECORD_DTYPE.itemsize)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD_DTYPE.itemsize, 0, self.count)
+        self.records = numpy.ndarray((capacity,), RECORD_DTYPE, self._map, HEADER_SIZE)
+
+
+class CaptureFile(object):
+    """A capture file mapped in memory, read only.
+
+    Args:
+        filename: File written by CaptureWriter.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, _, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError("%s is not a version %s capture" % (filename, VERSION))
+        self.records = numpy.frombuffer(self._map, RECORD_DTYPE, count, HEADER_SIZE)
+
+    def close(self):
+        self.records = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def sent(self):
+        """Copy of the records of the frames sent by the host."""
+        return self.records[self.records['direction'] == SENT]
+
+    @property
+    def received(self):
+        """Copy of the records of the frames read from the bus."""
+        return self.records[self.records['direction'] == RECEIVED]
+
+
+class _Replay(object):
+    """Progress of the replay on one opened interface."""
+    def __init__(self, start):
+        self.start = start
+        self.position = 0
+
+
+class ReplayNican(NicanBackend):
+    """NI-CAN backend reading the received frames of a capture instead of a bus.
+
+    Every opened interface replays the whole capture from the moment it is
+    opened. Frames written by the host are counted and dropped.
+
+    Args:
+        capture: CaptureFile or capture file name.
+        speed: Replay speed relative to the recording, None replays every
+            frame as soon as it is asked for.
+        clock: Function returning the current time in seconds.
+    """
+    def __init__(self, capture, speed=1.0, clock=time.time):
+        if not isinstance(capture, CaptureFile):
+            capture = CaptureFile(capture)
+        received = capture.received
+        self.frames = received['frame']
+        self.times = received['host_time'] - (received['host_time'][0] if len(received) else 0.0)
+        self.speed = speed
+        self.clock = clock
+        self.frames_written = 0
+        self.config = {}
+        self.replays = {}
+        self.lock = threading.RLock()
+        self._next_handle = 1
+
+    def _due(self, replay, now):
+        """Number of frames of the capture due at `now`."""
+        if self.speed is None:
+            return len(self.frames)
+        return int(numpy.searchsorted(self.times, (now - replay.start) * self.speed, 'right'))
+
+    def done(self, objHandle):
+        """Return True once every frame was read on the interface."""
+        replay = self.replays.get(handleValue(objHandle))
+        return replay is not None and replay.position >= len(self.frames)
+
+    def ncAction(self, objHandle, Opcode, Param):
+        return STATUS_OK if handleValue(objHandle) in self.replays else signedStatus(CanErrBadHandle)
+
+    def ncCloseObject(self, objHandle):
+        with self.lock:
+            if self.replays.pop(handleValue(objHandle), None) is None:
+                return signedStatus(CanErrBadHandle)
+            return STATUS_OK
+
+    def ncConfig(self, objName, NumAttrs, AttrIdList, AttrValueList):
+        with self.lock:
+            for i in range(NumAttrs):
+                self.config[AttrIdList[i]] = AttrValueList[i]
+            return STATUS_OK
+
+    def ncGetAttribute(self, objHandle, AttrId, SizeofAttr, Attr):
+        if AttrId not in self.config:
+            return signedStatus(CanErrBadParam)
+        derefArgument(Attr).value = self.config[AttrId]
+        return STATUS_OK
+
+    def ncOpenObject(self, objName, objHandle):
+        with self.lock:
+            handle = self._next_handle
+            self._next_handle += 1
+            self.replays[handle] = _Replay(self.clock())
+            derefArgument(objHandle).value = handle
+            return STATUS_OK
+
+    def ncRead(self, objHandle, SizeofData, Data):
+        return self._read(objHandle, frameArray(Data, sizeof(NCTYPE_CAN_STRUCT), NCTYPE_CAN_STRUCT), None)
+
+    def ncReadMult(self, objHandle, SizeofData, Data, ActualDataSize):
+        return self._read(objHandle, frameArray(Data, SizeofData, NCTYPE_CAN_STRUCT), ActualDataSize)
+
+    def _read(self, objHandle, frames, actual_size):
+        with self.lock:
+            replay = self.replays.get(handleValue(objHandle))
+            if replay is None:
+                return signedStatus(CanErrBadHandle)
+            start = replay.position
+            num = min(self._due(replay, self.clock()) - start, len(frames))
+            if num:
+                viewFrames(frames, num)[:] = self.frames[start:start + num]
+            replay.position = start + num
+        if actual_size is None:
+            return STATUS_OK if num else CanWarnOldData
+        derefArgument(actual_size).value = num * sizeof(NCTYPE_CAN_STRUCT)
+        return STATUS_OK
+
+    def ncReset(self, objName, Param):
+        with self.lock:
+            self.replays.clear()
+            return STATUS_OK
+
+    def ncSetAttribute(self, objHandle, AttrId, SizeofAttr, AttrPtr):
+        self.config[AttrId] = derefArgument(AttrPtr).value
+        return STATUS_OK
+
+    def ncStatusToString(self, Status, SizeofString, ErrorString):
+        text = backend_status_strings.get(c_uint32(Status).value, "Unknown status 0x%08X" % c_uint32(Status).value)
+        derefArgument(ErrorString).value = text[:SizeofString - 1]
+        return STATUS_OK
+
+    def ncWaitForState(self, objHandle, DesiredState, Timeout, CurrentState):
+        deadline = self.clock() + Timeout / 1000.0
+        while True:
+            now = self.clock()
+            with self.lock:
+                replay = self.replays.get(handleValue(objHandle))
+                if replay is None:
+                    return signedStatus(CanErrBadHandle)
+                due = self._due(replay, now)
+                position = replay.position
+            # The write queue is never full, the host's frames are dropped.
+            state = NC_ST_WRITE_SUCCESS
+            if due > position:
+                state |= NC_ST_READ_AVAIL
+            if state & DesiredState:
+                derefArgument(CurrentState).value = state
+                return STATUS_OK
+            if now >= deadline:
+                derefArgument(CurrentState).value = state
+                return signedStatus(CanErrFunctionTimeout)
+            wake_at = deadline
+            if position < len(self.frames):
+                wake_at = min(deadline, replay.start + self.times[position] / self.speed)
+            time.sleep(max(0, wake_at - now))
+
+    def ncWrite(self, objHandle, SizeofData, Data):
+        return self.ncWriteMult(objHandle, sizeof(NCTYPE_CAN_STRUCT), Data)
+
+    def ncWriteMult(self, objHandle, SizeofData, FrameArray):
+        if handleValue(objHandle) not in self.replays:
+            return signedStatus(CanErrBadHandle)
+        self.frames_written += SizeofData // sizeof(NCTYPE_CAN_STRUCT)
+        return STATUS_OK
@@ -0,0 +1,295 @@
+"""Correlation of pole responses with the commands that caused them.
+
+InFlightTable keeps the commands sent and not answered yet in a FIFO per
+(pole id, command index), so any number of commands can be pipelined to a
+pole and every response is matched to its command with one dict lookup.
+Responses without a matching command are counted as late (their command had
+timed out), duplicate (their command was already answered) or unsolicited.
+The controllers sharing an interface each have a table, InFlightRouter
+hands every response read from it to the table that sent its command.
+"""
+import threading
+import time
+from collections import deque
+
+
+class InFlightCommand(object):
+    def __init__(self, pole_id, command_index, value, sent_at, command_type=None):
+        self.pole_id = pole_id
+        self.command_index = command_index
+        self.command_type = command_type
+        self.value = value
+        self.sent_at = sent_at
+        self.answered_at = None
+        self.response_status = None
+        self.response_data = None
+
+    @property
+    def latency(self):
+        """Seconds from sending the command to reading its response, None until answered."""
+        if self.answered_at is None:
+            return None
+        return self.answered_at - self.sent_at
+
+
+class InFlightTable(object):
+    """Commands waiting for their response, keyed by (pole id, command index).
+
+    Args:
+        timeout: Seconds after which an unanswered command is expired.
+    """
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.commands = {}      # (pole id, command index) -> deque of InFlightCommand
+        self.expired = {}       # (pole id, command index) -> deque of expired InFlightCommand
+        self.answered = {}      # (pole id, command index) -> time of the last matched response
+        self.listeners = []
+        self.expire_listeners = []
+        self._last_expire = 0
+        self.resetStats()
+
+    def resetStats(self):
+        self.sent_count = 0
+        self.matched = 0
+        self.timed_out = 0
+        self.late = 0
+        self.duplicates = 0
+        self.unsolicited = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': sum(len(commands) for commands in self.commands.values()),
+                'sent': self.sent_count,
+                'matched': self.matched,
+                'timed_out': self.timed_out,
+                'late': self.late,
+                'duplicates': self.duplicates,
+                'unsolicited': self.unsolicited,
+            }
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(commands) for commands in self.commands.values())
+
+    def addListener(self, listener):
+        """Call listener(command) for every answered InFlightCommand, in the reader thread."""
+        self.listeners.append(listener)
+
+    def addExpireListener(self, listener):
+        """Call listener(command) for every InFlightCommand that timed out."""
+        self.expire_listeners.append(listener)
+
+    def sent(self, command_frames, now=None):
+        """Record CommandFrames about to be written, return their InFlightCommands."""
+        command_frames = list(command_frames)
+        return self.sentMany([c.id for c in command_frames], [c.command_type for c in command_frames],
+                             [c.command_index for c in command_frames], [c.command_data for c in command_frames], now)
+
+    def sentMany(self, pole_ids, command_types, command_indexes, values, now=None, supersede=False):
+        """Like sent, with the commands given as columns, e.g. those of a CommandBatch chunk.
+
+        With `supersede` the commands are sent again: they replace the
+        unanswered commands of their (pole id, command index), whose response
+        then answers the new command.
+        """
+        if now is None:
+            now = time.time()
+        result = []
+        replaced = set()
+        with self.lock:
+            commands = self.commands
+            for pole_id, command_type, command_index, value in zip(pole_ids, command_types, command_indexes, values):
+                key = (pole_id, command_index)
+                if supersede and key not in replaced:
+                    replaced.add(key)
+                    self.sent_count -= len(commands.pop(key, ()))
+                command = InFlightCommand(pole_id, command_index, value, now, command_type)
+                commands.setdefault(key, deque()).append(command)
+                result.append(command)
+            self.sent_count += len(result)
+        return result
+
+    def discard(self, commands):
+        """Forget commands that could not be written."""
+        with self.lock:
+            for command in commands:
+                pending = self.commands.get((command.pole_id, command.command_index))
+                if pending and command in pending:
+                    pending.remove(command)
+                    self.sent_count -= 1
+
+    def unanswered(self):
+        """Return every unanswered command, oldest first."""
+        with self.lock:
+            commands = [command for pending in self.commands.values() for command in pending]
+        commands.sort(key=lambda command: command.sent_at)
+        return commands
+
+    def pending(self, pole_id, command_index):
+        """Return the unanswered commands of a pole, oldest first."""
+        with self.lock:
+            return list(self.commands.get((pole_id, command_index), ()))
+
+    def match(self, pole_id, command_index, status=None, data=None, now=None):
+        """Match a response, return its InFlightCommand or None for late, duplicate and unsolicited ones."""
+        if now is None:
+            now = time.time()
+        key = (pole_id, command_index)
+        with self.lock:
+            command = self._match(key, status, data, now)
+        if command is not None:
+            for listener in self.listeners:
+                listener(command)
+        return command
+
+    def onResponses(self, start, stop, decoded):
+        """ResponseReceiver listener matching every response of a read.
+
+        Only for a table reading its interface alone, the tables of a shared
+        interface are fed by its InFlightRouter.
+        """
+        now = time.time()
+        responses = self.classifyResponses(self.matchResponses(_responses(decoded), now), now)
+        with self.lock:
+            self.unsolicited += len(responses)
+
+    def matchResponses(self, responses, now):
+        """Match (key, status, data) responses to pending commands, return the unmatched ones."""
+        matched = []
+        unmatched = []
+        expired = ()
+        with self.lock:
+            if now - self._last_expire > self.timeout / 10.0:
+                expired = self._expire(now)
+            commands = self.commands
+            for response in responses:
+                if response[0] in commands:
+                    matched.append(self._answer(response[0], response[1], response[2], now))
+                else:
+                    unmatched.append(response)
+        for command in matched:
+            for listener in self.listeners:
+                listener(command)
+        self._expired(expired)
+        return unmatched
+
+    def classifyResponses(self, responses, now):
+        """Count the unmatched responses of expired or answered commands, return the others."""
+        with self.lock:
+            return [response for response in responses if not self._classify(response[0], now)]
+
+    def expire(self, now=None):
+        """Expire the commands older than the timeout, return them."""
+        with self.lock:
+            expired = self._expire(time.time() if now is None else now)
+        self._expired(expired)
+        return expired
+
+    def _expired(self, commands):
+        for command in commands:
+            for listener in self.expire_listeners:
+                listener(command)
+
+    def _match(self, key, status, data, now):
+        if key in self.commands:
+            return self._answer(key, status, data, now)
+        if not self._classify(key, now):
+            self.unsolicited += 1
+        return None
+
+    def _answer(self, key, status, data, now):
+        pending = self.commands[key]
+        command = pending.popleft()
+        if not pending:
+            del self.commands[key]
+        command.answered_at = now
+        command.response_status = status
+        command.response_data = data
+        self.answered[key] = now
+        self.matched += 1
+        return command
+
+    def _classify(self, key, now):
+        # Count a response without pending command as late or duplicate, False if it is neither.
+        expired = self.expired.get(key)
+        if expired:
+            expired.popleft()
+            if not expired:
+                del self.expired[key]
+            self.late += 1
+        elif now - self.answered.get(key, -self.timeout) < self.timeout:
+            self.duplicates += 1
+        else:
+            return False
+        return True
+
+    def _expire(self, now):
+        self._last_expire = now
+        deadline = now - self.timeout
+        result = []
+        for key in list(self.commands.keys()):
+            pending = self.commands[key]
+            while pending and pending[0].sent_at < deadline:
+                command = pending.popleft()
+                self.expired.setdefault(key, deque()).append(command)
+                result.append(command)
+            if not pending:
+                del self.commands[key]
+        # Responses later than ten timeouts are not expected any more.
+        for key in list(self.expired.keys()):
+            expired = self.expired[key]
+            while expired and expired[0].sent_at < deadline - 9 * self.timeout:
+                expired.popleft()
+            if not expired:
+                del self.expired[key]
+        self.timed_out += len(result)
+        return result
+
+
+class InFlightRouter(object):
+    """Feeds the responses read from a shared interface to the InFlightTables of its controllers.
+
+    A response goes to the first table with a pending command for it, else
+    to the first one it is late or a duplicate for. Responses no table sent
+    a command for are counted once, in `unsolicited`.
+    """
+    def __init__(self):
+        self.tables = []
+        self.lock = threading.Lock()
+        self.unsolicited = 0
+
+    def add(self, table):
+        with self.lock:
+            # Replaced, not changed, the reader thread iterates the list without the lock.
+            self.tables = self.tables + [table]
+
+    def remove(self, table):
+        with self.lock:
+            self.tables = [t for t in self.tables if t is not table]
+
+    def resetStats(self):
+        self.unsolicited = 0
+
+    def onResponses(self, start, stop, decoded):
+        """ResponseReceiver listener routing every response of a read."""
+        now = time.time()
+        tables = self.tables
+        responses = _responses(decoded)
+        for table in tables:
+            # Every table is called, matching also expires its old commands.
+            responses = table.matchResponses(responses, now)
+        for table in tables:
+            if not responses:
+                break
+            responses = table.classifyResponses(responses, now)
+        self.unsolicited += len(responses)
+
+
+def _responses(decoded):
+    # (key, status, data) of the responses of DecodedResponses, without the error frames (see canreceiver.dataFramesOnly).
+    return [((pole_id, command_index), status, data)
+            for pole_id, command_index, status, data in zip(decoded.pole_id.tolist(), decoded.command.tolist(),
+                                                            decoded.status.tolist(), decoded.data.tolist())
+            if pole_id >= 0]
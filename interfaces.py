@@ -0,0 +1,242 @@
+"""Process-wide registry of opened NI-CAN interfaces.
+
+NC_Config and NC_OpenObject are slow and the driver allows one open object per
+interface. InterfaceRegistry opens an interface once per configuration and
+hands the same InterfaceHandle to every RobotController using it, counting
+them. A released handle stays open, so the next controller on the same
+interface and configuration reuses it warm; closeIdle() and closeAll(), also
+run at exit, close the handles deterministically.
+
+Controllers sharing a handle also share its ResponseReceiver and its
+TransmitScheduler: two readers on one handle would steal each other's frames
+and two schedulers would each assume the write queue is theirs.
+"""
+import atexit
+import logging
+import threading
+import time
+from ctypes import *
+
+from nican import *
+from canreceiver import ResponseReceiver
+from inflight import InFlightRouter
+from txscheduler import TransmitScheduler
+
+logger = logging.getLogger('shiyijian.robot')
+
+# A full write queue, from a busy bus or from a bus-off.
+_queue_statuses = (c_int32(CanErrFunctionTimeout).value, c_int32(CanErrOverflowWrite).value)
+# The interface itself is in a bad state.
+_recoverable_statuses = (c_int32(CanErrNotStopped).value, c_int32(CanErrBadHandle).value)
+
+
+class InterfaceHandle(object):
+    """An opened interface, shared by the controllers using it.
+
+    Args:
+        name: Interface name, 'CAN0'.
+        config: Tuple of (attribute id, value) pairs passed to NC_Config.
+        backend: NicanBackend the interface is opened with.
+    """
+    def __init__(self, name, config, backend):
+        self.name = name
+        self.config = config
+        self.backend = backend
+        self.objHandle = c_ulong()
+        self.refs = 0
+        self.receiver = None
+        self.receiver_refs = 0
+        self.router = None      # InFlightRouter of the receiver's responses
+        self._scheduler = None
+        self.lock = threading.RLock()
+        self.generation = 0     # recoveries so far, see recover()
+        self.recoveries = {'restart': 0, 'reset': 0}
+        self.recovery_time = 0.0
+
+    @property
+    def opened(self):
+        return bool(self.objHandle.value)
+
+    def open(self):
+        with self.lock:
+            if self.opened:
+                return
+            num = len(self.config)
+            attr_ids = (c_ulong*num)(*[attr for attr, _ in self.config])
+            attr_values = (c_ulong*num)(*[value for _, value in self.config])
+            name = (c_char*7)()
+            name.value = self.name
+            NC_Config(name, num, attr_ids, attr_values)
+            NC_OpenObject(name, byref(self.objHandle))
+
+    def close(self):
+        with self.lock:
+            if self.receiver is not None:
+                self.receiver.stop()
+                self.receiver = None
+                self.router = None
+                self.receiver_refs = 0
+            if self.opened:
+                status = self.backend.ncCloseObject(self.objHandle)
+                if status != STATUS_OK:
+                    logger.warning('NC_CloseObject %s failed with status %x', self.name, c_uint32(status).value)
+                self.objHandle.value = 0
+            self._scheduler = None
+
+    def state(self):
+        """Return the NC_ST_* state bits of the interface, without waiting."""
+        state = c_ulong()
+        self.backend.ncWaitForState(self.objHandle, NC_ST_ERROR | NC_ST_WARNING, 0, byref(state))
+        return state.value
+
+    def needsRecovery(self, error):
+        """Whether the NicanError of a write means the interface must be recovered.
+
+        A write queue that does not drain is a busy bus unless the interface
+        reports NC_ST_ERROR, as it does in bus-off. Other statuses are
+        recovered only if they tell the interface is stopped or gone.
+        """
+        if error.status in _queue_statuses:
+            return bool(self.state() & NC_ST_ERROR)
+        return error.status in _recoverable_statuses
+
+    def recover(self, generation=None):
+        """Bring the interface back after a bus-off or a driver error.
+
+        The interface is stopped and started again with NC_Action. If the
+        driver refuses, the card is reset with NC_Reset and the interface
+        reopened into the same objHandle, so the receiver, the scheduler and
+        the controllers keep using it. Frames in the write queue are lost.
+
+        Args:
+            generation: The `generation` the caller saw failing, nothing is
+                done if the interface was recovered since.
+
+        Returns:
+            True if the interface was recovered by this call.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            t = time.time()
+            try:
+                NC_Action(self.objHandle, NC_OP_STOP, 0)
+                NC_Action(self.objHandle, NC_OP_START, 0)
+                method = 'restart'
+            except NicanError as e:
+                logger.warning('restarting %s failed, resetting it: %s', self.name, e)
+                name = (c_char*7)()
+                name.value = self.name
+                NC_Reset(name, 0)
+                # NC_Reset closed every object of the card.
+                self.objHandle.value = 0
+                self.open()
+                method = 'reset'
+            if self._scheduler is not None:
+                self._scheduler.queue_empty_at = time.time()
+            self.generation += 1
+            self.recoveries[method] += 1
+            self.recovery_time = time.time() - t
+            logger.warning('%s recovered by %s in %.1f ms', self.name, method, self.recovery_time * 1000)
+            return True
+
+    @property
+    def scheduler(self):
+        """TransmitScheduler pacing every write to the interface."""
+        with self.lock:
+            if self._scheduler is None:
+                self._scheduler = TransmitScheduler(self.objHandle, self.attribute(NC_ATTR_BAUD_RATE),
+                                                    self.attribute(NC_ATTR_WRITE_Q_LEN))
+            return self._scheduler
+
+    def attribute(self, attr_id):
+        value = c_ulong()
+        NC_GetAttribute(self.objHandle, attr_id, sizeof(value), byref(value))
+        return value.value
+
+    def acquireReceiver(self, capacity=4096):
+        """Return the interface's running ResponseReceiver, started on first use."""
+        with self.lock:
+            if self.receiver is None:
+                self.receiver = ResponseReceiver(self.objHandle, capacity)
+                self.router = InFlightRouter()
+                self.receiver.addListener(self.router.onResponses)
+                self.receiver.start()
+            self.receiver_refs += 1
+            return self.receiver
+
+    def releaseReceiver(self):
+        """Stop the ResponseReceiver once its last user released it."""
+        with self.lock:
+            self.receiver_refs -= 1
+            if self.receiver_refs <= 0 and self.receiver is not None:
+                self.receiver.stop()
+                self.receiver = None
+                self.router = None
+                self.receiver_refs = 0
+
+
+class InterfaceRegistry(object):
+    """Opened InterfaceHandles keyed by backend, interface name and configuration.
+
+    Args:
+        linger: Keep released handles open for reuse, close them on release if False.
+    """
+    def __init__(self, linger=True):
+        self.linger = linger
+        self.handles = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, name, attr_ids, attr_values):
+        """Return the open InterfaceHandle of `name` configured with the given attributes.
+
+        Raises:
+            ValueError: The interface is in use with another configuration.
+        """
+        backend = getBackend()
+        config = tuple(zip(list(attr_ids), list(attr_values)))
+        key = (id(backend), name, config)
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is None:
+                # The driver opens an interface once, close it if idle with another configuration.
+                for other_key, other in self.handles.items():
+                    if other_key[:2] == key[:2]:
+                        if other.refs:
+                            raise ValueError('%s is in use with another configuration' % name)
+                        other.close()
+                        del self.handles[other_key]
+                handle = self.handles[key] = InterfaceHandle(name, config, backend)
+            handle.open()
+            handle.refs += 1
+            return handle
+
+    def release(self, handle):
+        with self.lock:
+            handle.refs -= 1
+            if handle.refs <= 0:
+                handle.refs = 0
+                if not self.linger:
+                    self._close(handle)
+
+    def closeIdle(self):
+        """Close the handles no controller uses."""
+        with self.lock:
+            for handle in [h for h in self.handles.values() if not h.refs]:
+                self._close(handle)
+
+    def closeAll(self):
+        """Close every handle, in use or not."""
+        with self.lock:
+            for handle in list(self.handles.values()):
+                self._close(handle)
+
+    def _close(self, handle):
+        handle.close()
+        for key, other in self.handles.items():
+            if other is handle:
+                del self.handles[key]
+
+
+registry = InterfaceRegistry()
+atexit.register(registry.closeAll)
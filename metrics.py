@@ -0,0 +1,154 @@
+"""Counters and latency histograms of a RobotController.
+
+The hot paths only increment integers and a histogram bucket, everything is
+aggregated into a plain dict when snapshot() is called.
+"""
+import bisect
+import threading
+import time
+
+from nican import NC_FRMTYPE_COMM_ERR, NC_FRMTYPE_BUS_ERR, NC_FRMTYPE_TRANSCEIVER_ERR
+
+RESPONSE_OK = 1
+
+# Data bytes of every frame of the pole protocol.
+FRAME_DATA_BYTES = 8
+
+
+class LatencyHistogram(object):
+    """Latencies in buckets doubling from 100us, the last bucket holds everything above 13s."""
+    EDGES = [0.0001 * 2 ** k for k in range(18)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.buckets[bisect.bisect_left(self.EDGES, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the `q` percentile, at most the max, None when empty."""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self.EDGES[i], self.max) if i < len(self.EDGES) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else None,
+            'buckets': list(self.buckets),
+        }
+
+
+class ControllerMetrics(object):
+    """Frames, bytes, errors, stall time and per-pole latencies of a RobotController.
+
+    The controller feeds it from its InFlightTable and ResponseReceiver
+    listeners, the TransmitScheduler counts its frames, overflows and stall
+    time while writing them. The controllers sharing an interface share its
+    reader and router: the received frames, the error frames, the read errors,
+    the unsolicited responses and the recoveries are those of the interface.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.frames_sent = 0
+            self.overflows = 0
+            self.stall_time = 0.0
+            self.frames_received = 0
+            self.transmit_errors = 0
+            self.refused = 0
+            self.latencies = {}     # device pole id -> LatencyHistogram
+        self.controller.inflight.resetStats()
+
+    def utilisation(self):
+        """Fraction of the bus time used since reset by the frames sent and their responses."""
+        scheduler = self.controller._scheduler
+        elapsed = time.time() - self.since
+        if scheduler is None or elapsed <= 0:
+            return 0.0
+        return self.frames_sent * scheduler.slot_time / elapsed
+
+    def onCommand(self, command):
+        """InFlightTable listener, called for every answered command."""
+        with self.lock:
+            histogram = self.latencies.get(command.pole_id)
+            if histogram is None:
+                histogram = self.latencies[command.pole_id] = LatencyHistogram()
+            histogram.add(command.latency)
+            if command.response_status != RESPONSE_OK:
+                self.refused += 1
+
+    def onResponses(self, start, stop, decoded):
+        """ResponseReceiver listener, called for every read."""
+        self.frames_received += int(stop - start)
+
+    def transmitError(self):
+        with self.lock:
+            self.transmit_errors += 1
+
+    def snapshot(self):
+        """Return every metric in a dict, latencies in seconds keyed by pole id."""
+        inflight = self.controller.inflight.stats()
+        receiver = self.controller.receiver
+        error_frames = receiver.error_frames if receiver is not None else {}
+        handle = self.controller.handle
+        router = handle.router if handle is not None else None
+        with self.lock:
+            overall = LatencyHistogram()
+            latencies = {}
+            for pole_id, histogram in self.latencies.items():
+                overall.merge(histogram)
+                latencies[self.controller._fromDevice(pole_id)] = histogram.snapshot()
+            return {
+                'frames_sent': self.frames_sent,
+                'bytes_sent': self.frames_sent * FRAME_DATA_BYTES,
+                'frames_received': self.frames_received,
+                'bytes_received': self.frames_received * FRAME_DATA_BYTES,
+                'in_flight': inflight['in_flight'],
+                'errors': {
+                    'transmit': self.transmit_errors,
+                    'write_overflows': self.overflows,
+                    'refused': self.refused,
+                    'timed_out': inflight['timed_out'],
+                    'late': inflight['late'],
+                    'duplicates': inflight['duplicates'],
+                    'unsolicited': router.unsolicited if router is not None else inflight['unsolicited'],
+                    'comm_errors': error_frames.get(NC_FRMTYPE_COMM_ERR, 0),
+                    'bus_errors': error_frames.get(NC_FRMTYPE_BUS_ERR, 0),
+                    'transceiver_errors': error_frames.get(NC_FRMTYPE_TRANSCEIVER_ERR, 0),
+                    'read_errors': receiver.read_errors if receiver is not None else 0,
+                },
+                'recoveries': dict(handle.recoveries) if handle is not None else {},
+                'stall_time': self.stall_time,
+                'utilisation': self.utilisation(),
+                'latency': overall.snapshot(),
+                'pole_latency': latencies,
+            }
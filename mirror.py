@@ -0,0 +1,110 @@
+"""Mirror of the pole lengths and max lengths the poles confirmed.
+
+RobotController.current_model is the model the rig was told to reach, even
+when some poles never answered. PoleMirror only records what a pole
+confirmed: the value of a write command it answered with RESPONSE_OK, or
+the value it returned to a read. A pole's entry does not count while a write
+to it is in flight, and is dropped when such a write times out, when the
+pole is reset, or when it is older than `max_age`. Deltas computed against
+the mirror hold exactly the poles that need a frame.
+
+Entries are keyed by device pole id, they describe the hardware whatever
+the controller's PoleMap.
+"""
+import threading
+import time
+
+from nican import COMMAND_INDEX_LENGTH, COMMAND_INDEX_MAX, COMMAND_TYPE_WRITE
+
+RESPONSE_OK = 1
+
+
+class PoleMirror(object):
+    """Confirmed LENGTH and MAX of the poles, fed by an InFlightTable.
+
+    Args:
+        inflight: The InFlightTable of the controller's commands.
+        max_age: Seconds a confirmed value is trusted, forever if None.
+    """
+    COMMANDS = (COMMAND_INDEX_LENGTH, COMMAND_INDEX_MAX)
+
+    def __init__(self, inflight, max_age=None):
+        self.inflight = inflight
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.values = {}    # (device pole id, command index) -> (value, confirmed at)
+        inflight.addListener(self.onCommand)
+        inflight.addExpireListener(self.onExpired)
+
+    def onCommand(self, command):
+        """InFlightTable listener, records the value an answered command confirmed."""
+        if command.command_index not in self.COMMANDS:
+            return
+        key = (command.pole_id, command.command_index)
+        with self.lock:
+            if command.response_status != RESPONSE_OK:
+                self.values.pop(key, None)
+            elif command.command_type == COMMAND_TYPE_WRITE:
+                self.values[key] = (command.value, command.answered_at)
+            else:
+                self.values[key] = (command.response_data, command.answered_at)
+
+    def onExpired(self, command):
+        """InFlightTable expire listener, the pole may or may not have applied the command."""
+        if command.command_index in self.COMMANDS and command.command_type == COMMAND_TYPE_WRITE:
+            self.invalidate(command.pole_id, command.command_index)
+
+    def invalidate(self, device_id=None, command_index=None):
+        """Forget the values of a pole, of all poles if `device_id` is None."""
+        with self.lock:
+            if device_id is None:
+                self.values.clear()
+            elif command_index is None:
+                for index in self.COMMANDS:
+                    self.values.pop((device_id, index), None)
+            else:
+                self.values.pop((device_id, command_index), None)
+
+    def confirmed(self, device_id, command_index=COMMAND_INDEX_LENGTH, now=None):
+        """Return the confirmed value of a pole, None if unknown, stale or being written."""
+        key = (device_id, command_index)
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        if self.max_age is not None and (time.time() if now is None else now) - entry[1] > self.max_age:
+            return None
+        if self.inflight.commands.get(key):
+            # A command to the pole is unanswered, it may change the value any time.
+            return None
+        return entry[0]
+
+    def lengths(self):
+        """Return the confirmed lengths as a dict of device pole id -> length."""
+        now = time.time()
+        with self.lock:
+            keys = [key for key in self.values if key[1] == COMMAND_INDEX_LENGTH]
+        result = {}
+        for device_id, index in keys:
+            value = self.confirmed(device_id, index, now)
+            if value is not None:
+                result[device_id] = value
+        return result
+
+    def delta(self, model, to_device=None, pending=True):
+        """Return the (pole id, length) pairs of `model` the poles did not confirm.
+
+        Args:
+            model: Dict of pole id -> length.
+            to_device: Maps a pole id of the model to its device id.
+            pending: Whether poles with a write in flight are part of the
+                delta, leave them out when the write is not to be repeated.
+        """
+        now = time.time()
+        result = []
+        for pole_id, length in model.items():
+            device_id = pole_id if to_device is None else to_device(pole_id)
+            if not pending and self.inflight.commands.get((device_id, COMMAND_INDEX_LENGTH)):
+                continue
+            if self.confirmed(device_id, COMMAND_INDEX_LENGTH, now) != length:
+                result.append((pole_id, length))
+        return result
@@ -0,0 +1,124 @@
+"""Binary model library format, opened through mmap.
+
+Layout, all little-endian:
+
+    header      '<4sHHIIQQQ': magic 'NPML', version, reserved, number of
+                models, number of poles, then the offsets of the pole id
+                table, the name table and the matrix
+    pole ids    int32 x poles, the pole id of each matrix column
+    names       uint32 x (models + 1) offsets into the UTF-8 name blob that
+                follows them, name i is blob[offsets[i]:offsets[i + 1]]
+    matrix      int32 x models x poles, 8 byte aligned, one row per model
+
+Opening a library only maps the file and reads the header. A model is read
+from its row without parsing the others; BodyModels.MISSING marks unset poles.
+"""
+import mmap
+import struct
+
+import numpy
+
+from CanController import BodyModelData, BodyModels
+
+MAGIC = 'NPML'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHIIQQQ')
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+def saveLibrary(models, filename, ordered=True):
+    """Write a BodyModels to `filename` in the binary format, rows in models.ordered order if `ordered`."""
+    names = list(models.ordered) if ordered else list(models.names)
+    pole_ids = numpy.asarray(models.pole_ids, '<i4')
+    blobs = [unicode(name).encode('utf-8') for name in names]
+    offsets = numpy.zeros(len(names) + 1, '<u4')
+    numpy.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+    pole_ids_offset = _HEADER.size
+    names_offset = pole_ids_offset + pole_ids.nbytes
+    matrix_offset = _align(names_offset + offsets.nbytes + int(offsets[-1]))
+    f = open(filename, 'wb')
+    try:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(names), len(pole_ids),
+                             pole_ids_offset, names_offset, matrix_offset))
+        f.write(pole_ids.tostring())
+        f.write(offsets.tostring())
+        f.write(''.join(blobs))
+        f.write('\0' * (matrix_offset - f.tell()))
+        # Write one chunk of rows at a time, the library may not fit twice in memory.
+        for start in range(0, len(names), 4096):
+            rows = [models.row(name) for name in names[start:start + 4096]]
+            f.write(numpy.array(rows, '<i4').tostring())
+    finally:
+        f.close()
+
+
+class ModelLibrary(object):
+    """A binary model library mapped in memory.
+
+    Args:
+        filename: File written by saveLibrary.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.num_models, self.num_poles,
+         pole_ids_offset, names_offset, matrix_offset) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %s model library" % (filename, VERSION))
+        self.pole_ids = numpy.frombuffer(self._map, '<i4', self.num_poles, pole_ids_offset)
+        self._name_offsets = numpy.frombuffer(self._map, '<u4', self.num_models + 1, names_offset)
+        self._names_blob = names_offset + self._name_offsets.nbytes
+        self.matrix = numpy.frombuffer(self._map, '<i4', self.num_models * self.num_poles,
+                                       matrix_offset).reshape(self.num_models, self.num_poles)
+        self._rows = None
+
+    def close(self):
+        self.pole_ids = self._name_offsets = self.matrix = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.num_models
+
+    def name(self, row):
+        """Return the index of the model in `row`."""
+        start = self._names_blob + int(self._name_offsets[row])
+        stop = self._names_blob + int(self._name_offsets[row + 1])
+        return self._map[start:stop].decode('utf-8')
+
+    @property
+    def names(self):
+        return [self.name(row) for row in range(self.num_models)]
+
+    def __contains__(self, index):
+        return index in self._nameRows()
+
+    def __getitem__(self, index):
+        return self.model(self._nameRows()[index])
+
+    def model(self, row):
+        """Return the model in `row` as a BodyModelData."""
+        values = self.matrix[row].tolist()
+        model = BodyModelData((pole, value) for pole, value in zip(self.pole_ids.tolist(), values)
+                              if value != BodyModels.MISSING)
+        model.index = self.name(row)
+        return model
+
+    def load(self):
+        """Copy the whole library into a BodyModels."""
+        return BodyModels.fromMatrix(self.names, self.pole_ids, self.matrix)
+
+    def _nameRows(self):
+        # Looking models up by index needs the whole name table, build it once.
+        if self._rows is None:
+            self._rows = dict((name, row) for row, name in enumerate(self.names))
+        return self._rows
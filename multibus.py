@@ -0,0 +1,168 @@
+"""Pole id space sharded across several NI-CAN interfaces.
+
+MultiBusController drives one RobotController per interface, each from its
+own writer thread. The driver calls release the GIL, so the buses are written
+and their responses awaited in parallel, and a model transfer takes about the
+time of the slowest bus instead of the sum of all of them.
+"""
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from CanController import *
+
+
+class Job(object):
+    """A call made by a BusWriter, wait() returns its result or raises its exception."""
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class BusWriter(object):
+    """Thread running the calls submitted for one bus, in order."""
+    def __init__(self, controller):
+        self.controller = controller
+        self.jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='BusWriter %s' % controller.interface.value)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        job = Job(function, args, kwargs)
+        self.jobs.put(job)
+        return job
+
+    def stop(self):
+        self.jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job.run()
+
+
+class MultiBusController(object):
+    """RobotController interface over poles spread on several buses.
+
+    Args:
+        shards: Dict mapping interface name to the pole ids on that bus.
+        controller_class: Called with an interface name to open each bus.
+    """
+    def __init__(self, shards, controller_class=RobotController):
+        self.controllers = {}
+        self.writers = {}
+        self.bus_of = {}
+        for interface, pole_ids in shards.items():
+            controller = controller_class(interface)
+            if hasattr(controller, 'configureFilter'):
+                # Only the frames of the bus's poles are read.
+                controller.configureFilter(pole_ids)
+            self.controllers[interface] = controller
+            self.writers[interface] = BusWriter(controller)
+            for pole_id in pole_ids:
+                if pole_id in self.bus_of:
+                    raise ValueError("Pole %s is on %s and %s" % (pole_id, self.bus_of[pole_id], interface))
+                self.bus_of[pole_id] = interface
+        self.current_model = None
+        self.responses = None
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.stop()
+        for controller in self.controllers.values():
+            controller.close()
+
+    def controller(self, pole_id):
+        """Return the RobotController of the bus pole `pole_id` is on."""
+        return self.controllers[self.bus_of[pole_id]]
+
+    def split(self, delta):
+        """Split a model delta into one BodyModelDeltaData per interface."""
+        deltas = {}
+        for key in delta.keys():
+            interface = self.bus_of.get(key)
+            if interface is None:
+                raise KeyError("Pole %s is on no bus" % key)
+            deltas.setdefault(interface, BodyModelDeltaData())[key] = delta[key]
+        return deltas
+
+    def transferToModel(self, model, block=False, timeout=5, force=False, ignore_previous=False):
+        """Send every bus the lengths of `model` its poles did not confirm, see RobotController.transferToModel."""
+        if ignore_previous or self.current_model is None:
+            logger.info('transfer to model %s', model.index)
+        else:
+            logger.info('transfer from %s to model %s', self.current_model.index, model.index)
+        delta = BodyModelDeltaData()
+        for interface, bus_model in self.split(model).items():
+            delta.update(self.controllers[interface].modelDelta(bus_model, ignore_previous))
+        unconfirmed = self.transferModelDeltaData(delta, block=block, timeout=timeout, force=force)
+        self.current_model = model
+        return unconfirmed
+
+    def transferModelDeltaData(self, delta, block=False, timeout=5, force=False):
+        """Send every bus its part of `delta` in parallel and wait for all of them.
+
+        Returns:
+            With `block`, the sorted ids of the poles of all buses that never confirmed.
+
+        Raises:
+            CanError: The first failure of any bus, after all buses finished.
+        """
+        jobs = []
+        for interface, bus_delta in self.split(delta).items():
+            controller = self.controllers[interface]
+            jobs.append((controller, self.writers[interface].submit(
+                    controller.transferModelDeltaData, bus_delta, block=block, timeout=timeout, force=force)))
+        error = None
+        self.responses = ResponseSet([])
+        unconfirmed = []
+        for controller, job in jobs:
+            try:
+                result = job.wait()
+            except CanError as e:
+                logger.error('transfer on %s failed: %s', controller.interface.value, e)
+                error = error or e
+                result = None
+            if block:
+                unconfirmed.extend(result or ())
+                if controller.responses is not None:
+                    self.responses.update(controller.responses)
+        if error is not None:
+            raise error
+        if block:
+            return sorted(unconfirmed)
+
+    def setPoleLength(self, pole_id, length):
+        return self.controller(pole_id).setPoleLength(pole_id, length)
+
+    def readStatus(self, pole_id, status):
+        return self.controller(pole_id).readStatus(pole_id, status)
+
+    def resetPole(self, pole_id):
+        return self.controller(pole_id).resetPole(pole_id)
+
+    def setPoleMaxLength(self, pole_id, max_length):
+        return self.controller(pole_id).setPoleMaxLength(pole_id, max_length)
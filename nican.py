@@ -1,5 +1,9 @@
+import logging
 import os
 from ctypes import *
+from ctypes import _Pointer
+
+logger = logging.getLogger('shiyijian.robot')
 
 
 # status
@@ -30,7 +34,14 @@ NC_FL_CAN_ARBID_XTD = 0x20000000
 
 # Error
 NICAN_ERROR_BASE = 0xBFF62000
+NICAN_WARN_BASE = 0x3FF62000
+CanErrFunctionTimeout = NICAN_ERROR_BASE | 0x001
+CanErrBadParam = NICAN_ERROR_BASE | 0x004
+CanErrBadHandle = NICAN_ERROR_BASE | 0x024
 CanErrNotStopped = NICAN_ERROR_BASE | 0X007
+CanErrOverflowWrite = NICAN_ERROR_BASE | 0x00A
+CanErrOverflowRead = NICAN_ERROR_BASE | 0x02A
+CanWarnOldData = NICAN_WARN_BASE | 0x009
 
 # NCTYPE_OPCODE values
 NC_OP_START = 0x80000001
@@ -57,9 +68,13 @@ NC_FRMTYPE_DELAY = 0x05    #Adds a delay between 2 timestamped frames.
 NC_FRMTYPE_BUS_ERR = 0x06 
 NC_FRMTYPE_TRANSCEIVER_ERR = 0x07
 
+# Bits of an extended data frame with 8 data bytes, without stuff bits:
+# SOF, 29 bit id, SRR, IDE, RTR, r0/r1, DLC, data, CRC, delimiters, ACK, EOF, IFS.
+EXTENDED_FRAME_BITS = 131
+
 class NCTYPE_CAN_FRAME(Structure):
     _fields_ = [
-            ('ArbitrationId', c_ulong),
+            ('ArbitrationId', c_uint32),
             ('IsRemote', c_ubyte),
             ('DataLength', c_ubyte),
             ('Data', c_ubyte*8),
@@ -69,31 +84,226 @@ class NCTYPE_CAN_STRUCT(Structure):
     _pack_ = 1
     _fields_ = [
             ('Timestamp', c_ulonglong),
-            ('ArbitrationId', c_ulong),
+            ('ArbitrationId', c_uint32),
             ('FrameType', c_ubyte),
             ('DataLength', c_ubyte),
             ('Data', c_ubyte*8),
             ]
 
 _cur_dir = os.path.dirname(os.path.abspath(__file__))
-os.environ['PATH'] = os.path.pathsep.join([_cur_dir, os.environ['PATH']])
 _dll_file = os.path.join(_cur_dir, 'Nican.dll')
-print _dll_file
-nican = windll.LoadLibrary(_dll_file)
+
+
+class NicanBackend(object):
+    """Driver the NC_* functions call into.
+
+    Method names and arguments mirror the exports of Nican.dll and every method
+    returns an NI-CAN status code, so the Nican.dll library object itself is a
+    valid backend.
+    """
+    def ncAction(self, objHandle, Opcode, Param):
+        raise NotImplementedError
+
+    def ncCloseObject(self, objHandle):
+        raise NotImplementedError
+
+    def ncConfig(self, objName, NumAttrs, AttrIdList, AttrValueList):
+        raise NotImplementedError
+
+    def ncCreateNotification(self, objHandle, DesiredState, Timeout, RefData, Callback):
+        raise NotImplementedError
+
+    def ncGetAttribute(self, objHandle, AttrId, SizeofAttr, Attr):
+        raise NotImplementedError
+
+    def ncOpenObject(self, objName, objHandle):
+        raise NotImplementedError
+
+    def ncRead(self, objHandle, SizeofData, Data):
+        raise NotImplementedError
+
+    def ncReadMult(self, objHandle, SizeofData, Data, ActualDataSize):
+        raise NotImplementedError
+
+    def ncReset(self, objName, Param):
+        raise NotImplementedError
+
+    def ncSetAttribute(self, objHandle, AttrId, SizeofAttr, AttrPtr):
+        raise NotImplementedError
+
+    def ncStatusToString(self, Status, SizeofString, ErrorString):
+        raise NotImplementedError
+
+    def ncWaitForState(self, objHandle, DesiredState, Timeout, CurrentState):
+        raise NotImplementedError
+
+    def ncWrite(self, objHandle, SizeofData, Data):
+        raise NotImplementedError
+
+    def ncWriteMult(self, objHandle, SizeofData, FrameArray):
+        raise NotImplementedError
+
+
+# Helpers for NicanBackend implementations in Python, which are called with the
+# same byref() and array arguments as Nican.dll.
+
+backend_status_strings = {
+    CanErrFunctionTimeout: "Function timeout",
+    CanErrBadParam: "Invalid parameter",
+    CanErrBadHandle: "Invalid object handle",
+    CanErrNotStopped: "Object is not stopped",
+    CanErrOverflowWrite: "Write queue overflow",
+    CanErrOverflowRead: "Read queue overflow",
+    CanWarnOldData: "No new data received since last read",
+}
+
+def signedStatus(code):
+    return c_int32(code).value
+
+def derefArgument(arg):
+    """Return the ctypes object behind a byref(), pointer or plain object."""
+    obj = getattr(arg, '_obj', None)
+    if obj is not None:
+        return obj
+    if isinstance(arg, _Pointer):
+        return arg.contents
+    return arg
+
+def handleValue(objHandle):
+    if isinstance(objHandle, (int, long)):
+        return objHandle
+    return derefArgument(objHandle).value
+
+def objectName(objName):
+    if isinstance(objName, Array):
+        return objName.value
+    return objName
+
+def frameArray(arg, size, frame_type):
+    """Return the `size` bytes behind `arg` as an array of `frame_type`."""
+    obj = derefArgument(arg)
+    num = size // sizeof(frame_type)
+    return (frame_type * num).from_address(addressof(obj))
+
+
+# Prototypes of the Nican.dll exports, NCTYPE_STATUS is a signed 32 bit int and
+# the handles, attributes, states and sizes are NCTYPE_UINT32.
+_prototypes = {
+    'ncAction': [c_ulong, c_ulong, c_ulong],
+    'ncCloseObject': [c_ulong],
+    'ncConfig': [c_char_p, c_ulong, POINTER(c_ulong), POINTER(c_ulong)],
+    'ncCreateNotification': [c_ulong, c_ulong, c_ulong, c_void_p, c_void_p],
+    'ncGetAttribute': [c_ulong, c_ulong, c_ulong, c_void_p],
+    'ncOpenObject': [c_char_p, POINTER(c_ulong)],
+    'ncRead': [c_ulong, c_ulong, c_void_p],
+    'ncReadMult': [c_ulong, c_ulong, c_void_p, POINTER(c_ulong)],
+    'ncReset': [c_char_p, c_ulong],
+    'ncSetAttribute': [c_ulong, c_ulong, c_ulong, c_void_p],
+    'ncStatusToString': [c_int32, c_ulong, c_char_p],
+    'ncWaitForState': [c_ulong, c_ulong, c_ulong, POINTER(c_ulong)],
+    'ncWrite': [c_ulong, c_ulong, c_void_p],
+    'ncWriteMult': [c_ulong, c_ulong, c_void_p],
+}
+
+def bindPrototypes(dll):
+    """Declare argtypes and restype of every export, so that calls skip ctypes' argument guessing.
+
+    The function pointers are looked up once here, the library object
+    caches them as attributes.
+    """
+    for name, argtypes in _prototypes.items():
+        function = getattr(dll, name)
+        function.argtypes = argtypes
+        function.restype = c_int32
+    return dll
+
+def loadNicanDll(dll_file=_dll_file):
+    """Load Nican.dll, the backend used on the rig.
+
+    Raises:
+        OSError: Nican.dll can not be loaded on this host.
+    """
+    try:
+        from ctypes import windll
+    except ImportError:
+        raise OSError("Nican.dll is only available on Windows, "
+                      "set NICAN_BACKEND=sim to use the simulated bus")
+    dll_dir = os.path.dirname(dll_file)
+    os.environ['PATH'] = os.path.pathsep.join([dll_dir, os.environ['PATH']])
+    return bindPrototypes(windll.LoadLibrary(dll_file))
+
+_backend = None
+
+def setBackend(backend):
+    """Replace the driver used by all NC_* functions.
+
+    Args:
+        backend: A NicanBackend, or None to load the default one again on next use.
+    """
+    global _backend
+    _backend = backend
+
+def getBackend():
+    """Return the driver used by the NC_* functions, loading it on first use.
+
+    The NICAN_BACKEND environment variable selects the default driver: "dll"
+    (the default) loads Nican.dll, "sim" creates a nicansim.SimulatedNican.
+    """
+    global _backend
+    if _backend is None:
+        name = os.environ.get('NICAN_BACKEND', 'dll')
+        if name == 'sim':
+            import nicansim
+            _backend = nicansim.SimulatedNican()
+        elif name == 'dll':
+            _backend = loadNicanDll()
+        else:
+            raise ValueError("Unknown NICAN_BACKEND %r" % name)
+    return _backend
 
     
+class NicanError(Exception):
+    """A NI-CAN function returned an error status.
+
+    Attributes:
+        status: The signed status code.
+        source: Name of the NC_* function.
+        description: Text of the status from NC_StatusToString.
+    """
+    def __init__(self, status, source, description):
+        super(NicanError, self).__init__(status, source, description)
+        self.status = status
+        self.source = source
+        self.description = description
+
+    @property
+    def code(self):
+        """The status as the unsigned code of the NI-CAN documentation."""
+        return c_uint32(self.status).value
+
+    def __str__(self):
+        return "%s failed with status 0x%08X: %s" % (self.source, self.code, self.description)
+
+_status_strings = {}
+
+def statusToString(status):
+    """Return the NC_StatusToString text of a status code, asking the driver once per code."""
+    status = c_int32(status).value
+    text = _status_strings.get(status)
+    if text is None:
+        error_string = (c_char*1024)()
+        NC_StatusToString(status, sizeof(error_string), error_string)
+        text = _status_strings[status] = error_string.value
+    return text
+
 def processStatus(status, source):
+    """Raise NicanError for an error status, log warnings, do nothing on success."""
     if status == STATUS_OK:
-        print "%s succeed" % source
-    elif status > 0:
-        print "Warning: %s" % source
+        return
+    if status > 0:
+        logger.warning("%s: %s", source, statusToString(status))
     else:
-        print "Error code: %x" % (c_uint32(status).value)
-#         if c_uint32(status).value == CanErrNotStopped:
-#             NC_Reset("CAN1", 0)
-        ErrorString = (c_char*1024)()
-        NC_StatusToString(status, sizeof(ErrorString), (ErrorString))
-        raise Exception("\n%s\nSource = %s\n" % (ErrorString, source))
+        raise NicanError(status, source, statusToString(status))
 
     
 def NC_Action(objHandle, Opcode, Param):
@@ -112,7 +322,7 @@ def NC_Action(objHandle, Opcode, Param):
         An int variable indicate Status returned from all NI-CAN functions.
         Status is zero for success, less than zero for an error, and greater than zero for a warning.
     """
-    status = nican.ncAction(objHandle, Opcode, Param)
+    status = getBackend().ncAction(objHandle, Opcode, Param)
     processStatus(status, "NC_Action")
 
 def NC_CloseObject(objHandle):
@@ -127,7 +337,7 @@ def NC_CloseObject(objHandle):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncCloseObject(objHandle)
+    status = getBackend().ncCloseObject(objHandle)
     processStatus(status, "NC_CloseObject")
                                    
 def NC_Config(objName, NumAttrs, AttrIdList, AttrValueList):
@@ -144,7 +354,7 @@ def NC_Config(objName, NumAttrs, AttrIdList, AttrValueList):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncConfig(objName, NumAttrs, AttrIdList, AttrValueList)
+    status = getBackend().ncConfig(objName, NumAttrs, AttrIdList, AttrValueList)
     processStatus(status, "NC_Config")
     
 def NC_CreateNotification(objHandle, DesiredState, Timeout, RefData, Callback):
@@ -160,7 +370,7 @@ def NC_CreateNotification(objHandle, DesiredState, Timeout, RefData, Callback):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncCreateNotification(objHandle, DesiredState, Timeout, RefData, Callback)
+    status = getBackend().ncCreateNotification(objHandle, DesiredState, Timeout, RefData, Callback)
     processStatus(status, "NC_CreateNotification")
 
 def NC_GetAttribute(objHandle, AttrId, SizeofAttr, Attr):
@@ -175,7 +385,7 @@ def NC_GetAttribute(objHandle, AttrId, SizeofAttr, Attr):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncGetAttribute(objHandle, AttrId, SizeofAttr, Attr)
+    status = getBackend().ncGetAttribute(objHandle, AttrId, SizeofAttr, Attr)
     processStatus(status, "NC_GetAttribute")
                                     
 def NC_OpenObject(objName, objHandle):
@@ -188,7 +398,7 @@ def NC_OpenObject(objName, objHandle):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncOpenObject(objName, objHandle)
+    status = getBackend().ncOpenObject(objName, objHandle)
     processStatus(status, "NC_OpenObject")
 
 def NC_Read(objHandle, SizeofData, Data):
@@ -202,7 +412,7 @@ def NC_Read(objHandle, SizeofData, Data):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncRead(objHandle, SizeofData, Data)
+    status = getBackend().ncRead(objHandle, SizeofData, Data)
     processStatus(status, "NC_Read")
     
 def NC_ReadMult(objHandle, SizeofData, Data, ActualDataSize):
@@ -217,7 +427,7 @@ def NC_ReadMult(objHandle, SizeofData, Data, ActualDataSize):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncReadMult(objHandle, SizeofData, Data, ActualDataSize)
+    status = getBackend().ncReadMult(objHandle, SizeofData, Data, ActualDataSize)
     processStatus(status, "NC_ReadMult")
         
 def NC_Reset(objName, Param):
@@ -230,7 +440,7 @@ def NC_Reset(objName, Param):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncReset(objName, Param)
+    status = getBackend().ncReset(objName, Param)
     processStatus(status, "NC_Reset")
     
 def NC_SetAttribute(objHandle, AttrId, SizeofAttr, AttrPtr):
@@ -245,8 +455,8 @@ def NC_SetAttribute(objHandle, AttrId, SizeofAttr, AttrPtr):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncSetAttribute(objHandle, AttrId, SizeofAttr, AttrPtr)
-    processStatus(status, "NC_GetAttribute")
+    status = getBackend().ncSetAttribute(objHandle, AttrId, SizeofAttr, AttrPtr)
+    processStatus(status, "NC_SetAttribute")
 
 def NC_StatusToString(Status, SizeofString, ErrorString):
     """Convert status code into a descriptive string.
@@ -259,7 +469,7 @@ def NC_StatusToString(Status, SizeofString, ErrorString):
     Returns:
         Same with NC_Action.
     """    
-    nican.ncStatusToString(Status, SizeofString, ErrorString) 
+    getBackend().ncStatusToString(Status, SizeofString, ErrorString) 
 
 def NC_WaitForState(objHandle, DesiredState, Timeout, CurrentState):
     """Wait for one or more states to occur in an object.
@@ -273,7 +483,7 @@ def NC_WaitForState(objHandle, DesiredState, Timeout, CurrentState):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncWaitForState(objHandle, DesiredState, Timeout, CurrentState)
+    status = getBackend().ncWaitForState(objHandle, DesiredState, Timeout, CurrentState)
     processStatus(status, "NC_WaitForState") 
             
 def NC_Write(objHandle, SizeofData, Data):
@@ -287,7 +497,7 @@ def NC_Write(objHandle, SizeofData, Data):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncWrite(objHandle, SizeofData, Data)
+    status = getBackend().ncWrite(objHandle, SizeofData, Data)
     processStatus(status, "NC_Write")
 
 def NC_WriteMult(objHandle, SizeofData, FrameArray):
@@ -301,7 +511,7 @@ def NC_WriteMult(objHandle, SizeofData, FrameArray):
     Returns:
         Same with NC_Action.
     """    
-    status = nican.ncWriteMult(objHandle, SizeofData, FrameArray)
+    status = getBackend().ncWriteMult(objHandle, SizeofData, FrameArray)
     processStatus(status, "NC_WriteMult")
 
 # Ni-CAN attributes
@@ -0,0 +1,485 @@
+"""In-process simulation of an NI-CAN network interface with poles attached.
+
+SimulatedNican implements nican.NicanBackend without any hardware, so that
+nican and CanController can be used on hosts without Nican.dll:
+
+    import nican, nicansim
+    nican.setBackend(nicansim.SimulatedNican(poles=120, latency=0.002))
+
+Every opened interface is an independent bus. Frames written by the host and
+the responses of the poles share the bus and each occupies it for
+EXTENDED_FRAME_BITS / baud rate seconds. A pole answers every command frame
+addressed to it after `latency` (+ up to `jitter`) seconds, unless the command
+is dropped, which happens with probability `drop_rate`. busOff() stops a bus
+the way a bus-off does, until the interface is restarted or reset, busError()
+only reports a bus error frame.
+
+The simulation runs on wall clock time and is evaluated lazily whenever the
+host calls into the backend.
+"""
+import heapq
+import random
+import threading
+import time
+from collections import deque
+from ctypes import *
+
+from nican import *
+
+RESPONSE_OK = 1
+RESPONSE_ERROR = 0
+
+# NCTYPE_CAN_STRUCT.Timestamp is a FILETIME, 100 ns units since 1601-01-01.
+_FILETIME_UNIX_EPOCH = 116444736000000000
+
+
+class SimulatedPole(object):
+    """A pole answering length, max length, id, status and reset commands."""
+    def __init__(self, pole_id, length=0, max_length=600):
+        self.id = pole_id
+        self.length = length
+        self.max_length = max_length
+
+    def handle(self, command_type, command_index, value):
+        """Execute a command, return (response status, response value)."""
+        if command_type == COMMAND_TYPE_READ:
+            if command_index == COMMAND_INDEX_LENGTH:
+                return RESPONSE_OK, self.length
+            if command_index == COMMAND_INDEX_MAX:
+                return RESPONSE_OK, self.max_length
+            if command_index == COMMAND_INDEX_ID:
+                return RESPONSE_OK, self.id
+            if command_index == COMMAND_INDEX_STATUS:
+                return RESPONSE_OK, 0
+            return RESPONSE_ERROR, 0
+        if command_index == COMMAND_INDEX_LENGTH:
+            if value > self.max_length:
+                return RESPONSE_ERROR, value
+            self.length = value
+        elif command_index == COMMAND_INDEX_MAX:
+            self.max_length = value
+        elif command_index == COMMAND_INDEX_ID:
+            self.id = value
+        elif command_index == COMMAND_INDEX_RESET:
+            self.length = 0
+        else:
+            return RESPONSE_ERROR, value
+        return RESPONSE_OK, value
+
+
+class SimulatedInterface(object):
+    """One simulated CAN bus, shared by every handle opened on it."""
+    def __init__(self, name, poles, backend):
+        self.name = name
+        self.backend = backend
+        self.poles = dict((pole.id, pole) for pole in poles)
+        self.config = dict(default_nican_config)
+        self.started = False
+        self.reset()
+
+    def reset(self):
+        self.bus_free_at = 0.0
+        self.last_host_end = 0.0
+        self.tx_queue = deque()     # (queued at, frame bytes) waiting for the bus
+        self.responses = []         # heap of (ready at, seq, frame bytes)
+        self.rx_pending = deque()   # (arrival, frame bytes) still on the bus
+        self.rx_queue = deque()     # (arrival, frame bytes) readable by the host
+        self.seq = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.frames_filtered = 0
+        self.read_overflows = 0
+        self.bus_off = False
+        self.stuck = False          # bus-off only cleared by NC_Reset
+
+    @property
+    def frame_time(self):
+        baud_rate = self.backend.baud_rate or self.config[NC_ATTR_BAUD_RATE]
+        return float(EXTENDED_FRAME_BITS) / baud_rate
+
+    @property
+    def write_q_len(self):
+        return max(1, self.config[NC_ATTR_WRITE_Q_LEN])
+
+    @property
+    def read_q_len(self):
+        # A zero length read queue only keeps the newest frame, like on the real driver.
+        return max(1, self.config[NC_ATTR_READ_Q_LEN])
+
+    def accepts(self, arbitration_id):
+        """Whether the comparator and mask of the interface let a received frame through."""
+        if arbitration_id & NC_FL_CAN_ARBID_XTD:
+            comparator, mask = self.config[NC_ATTR_CAN_COMP_XTD], self.config[NC_ATTR_CAN_MASK_XTD]
+            arbitration_id &= ~NC_FL_CAN_ARBID_XTD
+        else:
+            comparator, mask = self.config[NC_ATTR_CAN_COMP_STD], self.config[NC_ATTR_CAN_MASK_STD]
+        return (arbitration_id & mask) == (comparator & mask)
+
+    def goBusOff(self, now, stuck=False):
+        """Stop the bus until the interface is restarted, or reset if `stuck`."""
+        self.bus_off = True
+        self.stuck = stuck
+        self.busError(now)
+
+    def busError(self, now):
+        # The interface reports a bus error with an error frame, whatever the filters.
+        self.rx_queue.append((now, (0, (0,) * 8, NC_FRMTYPE_BUS_ERR)))
+
+    def restart(self):
+        """NC_OP_START, return the status."""
+        if self.bus_off:
+            if self.stuck:
+                return CanErrNotStopped
+            # The frames queued during the bus-off are lost.
+            self.bus_off = False
+            self.tx_queue.clear()
+            self.responses = []
+            self.bus_free_at = self.last_host_end = 0.0
+        self.started = True
+        return STATUS_OK
+
+    def inject(self, arbitration_id, data, now):
+        """Put a frame of another node on the bus, it is received after `now`."""
+        self.seq += 1
+        heapq.heappush(self.responses, (now, self.seq, (arbitration_id, tuple(data))))
+
+    def writeQueueUsed(self, now):
+        return len(self.tx_queue) + (1 if self.last_host_end > now else 0)
+
+    def queueWrite(self, frames, now):
+        if not self.started:
+            return CanErrNotStopped
+        if self.writeQueueUsed(now) + len(frames) > self.write_q_len:
+            return CanErrOverflowWrite
+        for frame in frames:
+            self.tx_queue.append((now, frame))
+        return STATUS_OK
+
+    def advance(self, now):
+        """Run the bus until `now`."""
+        frame_time = self.frame_time
+        while (self.tx_queue or self.responses) and not self.bus_off:
+            next_host = self.tx_queue[0][0] if self.tx_queue else None
+            next_response = self.responses[0][0] if self.responses else None
+            host_first = next_response is None or (next_host is not None and next_host <= next_response)
+            start = max(self.bus_free_at, next_host if host_first else next_response)
+            if start > now:
+                break
+            end = start + frame_time
+            self.bus_free_at = end
+            if host_first:
+                frame = self.tx_queue.popleft()[1]
+                self.last_host_end = end
+                self.frames_sent += 1
+                self.deliver(frame, end)
+            else:
+                frame = heapq.heappop(self.responses)[2]
+                self.rx_pending.append((end, frame))
+        while self.rx_pending and self.rx_pending[0][0] <= now:
+            frame = self.rx_pending.popleft()
+            if not self.accepts(frame[1][0]):
+                self.frames_filtered += 1
+                continue
+            self.rx_queue.append(frame)
+            self.frames_received += 1
+            if len(self.rx_queue) > self.read_q_len:
+                self.rx_queue.popleft()
+                self.read_overflows += 1
+
+    def nextEvent(self, now):
+        """Time of the next change of state after `now`, None when the bus is idle."""
+        times = []
+        if self.rx_pending:
+            times.append(self.rx_pending[0][0])
+        if self.tx_queue:
+            times.append(max(self.bus_free_at, self.tx_queue[0][0]))
+        if self.responses:
+            times.append(max(self.bus_free_at, self.responses[0][0]))
+        times.append(self.last_host_end)
+        times = [t for t in times if t > now]
+        return min(times) if times else None
+
+    def deliver(self, frame, now):
+        arbitration_id, data = frame
+        pole = self.poles.get(data[0])
+        if pole is None or data[0] != arbitration_id & ~NC_FL_CAN_ARBID_XTD:
+            return
+        backend = self.backend
+        if backend.drop_rate and backend.random.random() < backend.drop_rate:
+            self.frames_dropped += 1
+            return
+        value = 0
+        for byte in data[3:8]:
+            value = (value << 8) | byte
+        old_id = pole.id
+        status, value = pole.handle(data[1], data[2], value)
+        if pole.id != old_id:
+            del self.poles[old_id]
+            self.poles[pole.id] = pole
+        response = [old_id, status, data[2]]
+        response.extend((value >> shift) & 0xFF for shift in (32, 24, 16, 8, 0))
+        ready = now + backend.latency
+        if backend.jitter:
+            ready += backend.random.random() * backend.jitter
+        self.seq += 1
+        heapq.heappush(self.responses, (ready, self.seq, (arbitration_id, tuple(response))))
+
+    def state(self, now):
+        state = 0
+        if not self.started:
+            state |= NC_ST_STOPPED
+        if self.bus_off:
+            state |= NC_ST_ERROR
+        if self.rx_queue:
+            state |= NC_ST_READ_AVAIL
+            if len(self.rx_queue) >= max(1, self.read_q_len // 2):
+                state |= NC_ST_READ_MULT
+        if not self.tx_queue and self.last_host_end <= now:
+            state |= NC_ST_WRITE_SUCCESS
+        return state
+
+    def pop(self, frame):
+        arrival, received = self.rx_queue.popleft()
+        arbitration_id, data = received[:2]
+        frame.Timestamp = int(arrival * 10000000) + _FILETIME_UNIX_EPOCH
+        frame.ArbitrationId = arbitration_id
+        frame.FrameType = received[2] if len(received) > 2 else NC_FRMTYPE_DATA
+        frame.DataLength = len(data)
+        frame.Data[:] = data
+
+
+class SimulatedNican(NicanBackend):
+    """NI-CAN backend driving simulated poles.
+
+    Args:
+        poles: Number of poles (ids 1..poles) or list of pole ids on every
+            interface, or a dict mapping interface name to either of those.
+        latency: Seconds a pole needs to answer a command.
+        jitter: Random extra latency, uniform in [0, jitter) seconds.
+        drop_rate: Probability that a command is lost and never answered.
+        baud_rate: Overrides NC_ATTR_BAUD_RATE of every interface.
+        seed: Seed of the random generator used for drops and jitter.
+        clock: Function returning the current time in seconds.
+    """
+    def __init__(self, poles=100, latency=0.001, jitter=0.0, drop_rate=0.0,
+                 baud_rate=None, seed=None, clock=time.time):
+        self.pole_ids = poles
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.baud_rate = baud_rate
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.interfaces = {}
+        self.handles = {}
+        self.lock = threading.RLock()
+        self._next_handle = 1
+        self._notifications = {}
+
+    def interface(self, name):
+        """Return the SimulatedInterface called `name`, creating it if needed."""
+        interface = self.interfaces.get(name)
+        if interface is None:
+            pole_ids = self.pole_ids
+            if isinstance(pole_ids, dict):
+                pole_ids = pole_ids.get(name, ())
+            if isinstance(pole_ids, (int, long)):
+                pole_ids = range(1, pole_ids + 1)
+            interface = SimulatedInterface(name, [SimulatedPole(i) for i in pole_ids], self)
+            self.interfaces[name] = interface
+        return interface
+
+    def busOff(self, name, stuck=False):
+        """Put bus `name` in bus-off, restarting the interface recovers it unless `stuck`."""
+        with self.lock:
+            interface = self.interface(name)
+            now = self.clock()
+            interface.advance(now)
+            interface.goBusOff(now, stuck)
+
+    def busError(self, name):
+        """Report a bus error on bus `name` that does not take it bus-off."""
+        with self.lock:
+            interface = self.interface(name)
+            now = self.clock()
+            interface.advance(now)
+            interface.busError(now)
+
+    def inject(self, name, arbitration_id, data, delay=0.0):
+        """Send a frame from another node on bus `name` in `delay` seconds."""
+        with self.lock:
+            interface = self.interface(name)
+            now = self.clock()
+            interface.advance(now)
+            interface.inject(arbitration_id, data, now + delay)
+
+    def _interface(self, objHandle):
+        return self.handles.get(handleValue(objHandle))
+
+    def _advanced(self, objHandle):
+        interface = self._interface(objHandle)
+        if interface is not None:
+            interface.advance(self.clock())
+        return interface
+
+    def ncAction(self, objHandle, Opcode, Param):
+        with self.lock:
+            interface = self._advanced(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            if Opcode == NC_OP_START:
+                return signedStatus(interface.restart())
+            elif Opcode == NC_OP_STOP:
+                interface.started = False
+            elif Opcode == NC_OP_RESET:
+                interface.started = False
+                interface.reset()
+            else:
+                return signedStatus(CanErrBadParam)
+            return STATUS_OK
+
+    def ncCloseObject(self, objHandle):
+        with self.lock:
+            handle = handleValue(objHandle)
+            if self.handles.pop(handle, None) is None:
+                return signedStatus(CanErrBadHandle)
+            self._notifications.pop(handle, None)
+            return STATUS_OK
+
+    def ncConfig(self, objName, NumAttrs, AttrIdList, AttrValueList):
+        with self.lock:
+            interface = self.interface(objectName(objName))
+            for i in range(NumAttrs):
+                interface.config[AttrIdList[i]] = AttrValueList[i]
+            return STATUS_OK
+
+    def ncCreateNotification(self, objHandle, DesiredState, Timeout, RefData, Callback):
+        with self.lock:
+            interface = self._interface(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            handle = handleValue(objHandle)
+            if not DesiredState:
+                self._notifications.pop(handle, None)
+                return STATUS_OK
+            token = object()
+            self._notifications[handle] = token
+        thread = threading.Thread(target=self._notify,
+                                  args=(handle, token, DesiredState, Timeout, RefData, Callback))
+        thread.daemon = True
+        thread.start()
+        return STATUS_OK
+
+    def _notify(self, handle, token, desired, timeout, ref_data, callback):
+        while self._notifications.get(handle) is token:
+            state = c_ulong()
+            status = self.ncWaitForState(handle, desired, timeout, byref(state))
+            if self._notifications.get(handle) is not token:
+                break
+            desired = callback(handle, state.value, status, ref_data)
+            if not desired:
+                with self.lock:
+                    if self._notifications.get(handle) is token:
+                        del self._notifications[handle]
+                break
+
+    def ncGetAttribute(self, objHandle, AttrId, SizeofAttr, Attr):
+        with self.lock:
+            interface = self._interface(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            if AttrId not in interface.config:
+                return signedStatus(CanErrBadParam)
+            derefArgument(Attr).value = interface.config[AttrId]
+            return STATUS_OK
+
+    def ncOpenObject(self, objName, objHandle):
+        with self.lock:
+            interface = self.interface(objectName(objName))
+            handle = self._next_handle
+            self._next_handle += 1
+            self.handles[handle] = interface
+            derefArgument(objHandle).value = handle
+            if interface.config.get(NC_ATTR_START_ON_OPEN):
+                interface.started = True
+            return STATUS_OK
+
+    def ncRead(self, objHandle, SizeofData, Data):
+        with self.lock:
+            interface = self._advanced(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            if not interface.rx_queue:
+                return CanWarnOldData
+            interface.pop(derefArgument(Data))
+            return STATUS_OK
+
+    def ncReadMult(self, objHandle, SizeofData, Data, ActualDataSize):
+        with self.lock:
+            interface = self._advanced(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            frames = frameArray(Data, SizeofData, NCTYPE_CAN_STRUCT)
+            num = min(len(frames), len(interface.rx_queue))
+            for i in range(num):
+                interface.pop(frames[i])
+            derefArgument(ActualDataSize).value = num * sizeof(NCTYPE_CAN_STRUCT)
+            return STATUS_OK
+
+    def ncReset(self, objName, Param):
+        with self.lock:
+            interface = self.interface(objectName(objName))
+            for handle in [h for h, i in self.handles.items() if i is interface]:
+                del self.handles[handle]
+                self._notifications.pop(handle, None)
+            interface.started = False
+            interface.reset()
+            return STATUS_OK
+
+    def ncSetAttribute(self, objHandle, AttrId, SizeofAttr, AttrPtr):
+        with self.lock:
+            interface = self._interface(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            interface.config[AttrId] = derefArgument(AttrPtr).value
+            return STATUS_OK
+
+    def ncStatusToString(self, Status, SizeofString, ErrorString):
+        text = backend_status_strings.get(c_uint32(Status).value, "Unknown status 0x%08X" % c_uint32(Status).value)
+        derefArgument(ErrorString).value = text[:SizeofString - 1]
+        return STATUS_OK
+
+    def ncWaitForState(self, objHandle, DesiredState, Timeout, CurrentState):
+        deadline = self.clock() + Timeout / 1000.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                interface = self._advanced(objHandle)
+                if interface is None:
+                    return signedStatus(CanErrBadHandle)
+                state = interface.state(now)
+                next_event = interface.nextEvent(now)
+            if state & DesiredState:
+                derefArgument(CurrentState).value = state
+                return STATUS_OK
+            if now >= deadline:
+                derefArgument(CurrentState).value = state
+                return signedStatus(CanErrFunctionTimeout)
+            # Without scheduled events only another thread can change the state.
+            wake_at = min(deadline, next_event if next_event is not None else now + 0.001)
+            time.sleep(max(0, wake_at - now))
+
+    def ncWrite(self, objHandle, SizeofData, Data):
+        return self._write(objHandle, [derefArgument(Data)])
+
+    def ncWriteMult(self, objHandle, SizeofData, FrameArray):
+        return self._write(objHandle, frameArray(FrameArray, SizeofData, NCTYPE_CAN_STRUCT))
+
+    def _write(self, objHandle, frames):
+        with self.lock:
+            interface = self._advanced(objHandle)
+            if interface is None:
+                return signedStatus(CanErrBadHandle)
+            frames = [(frame.ArbitrationId, tuple(frame.Data)) for frame in frames]
+            return signedStatus(interface.queueWrite(frames, self.clock()))
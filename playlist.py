@@ -0,0 +1,124 @@
+"""Precomputed transitions for replaying sequences of models.
+
+A show runs the same model transitions over and over. TransitionCache keeps
+the delta and the encoded CommandBatch of each (from, to) pair it was asked
+for, least recently used first out, and Playlist plans all transitions of a
+sequence up front so that playing it only costs bus time.
+
+The batches hold device pole ids, the cache empties itself when the
+controller's PoleMap is replaced or rewired. A cached transition only holds
+the poles that change between its models, RobotController.transferTransition
+adds the poles its PoleMirror has no confirmation for.
+"""
+from collections import OrderedDict
+
+from CanController import *
+
+
+class Transition(object):
+    """The move from model `from_index` (None: unknown state) to model `to_index`."""
+    def __init__(self, from_index, to_index, model, delta, batch):
+        self.from_index = from_index
+        self.to_index = to_index
+        self.model = model
+        self.delta = delta
+        self.batch = batch
+
+    def __len__(self):
+        return len(self.batch)
+
+
+class TransitionCache(object):
+    """LRU cache of Transitions of a BodyModels library.
+
+    Args:
+        controller: RobotController the batches are encoded for.
+        models: BodyModels the indices refer to.
+        max_frames: Bound on the total number of frames of the cached transitions.
+        chunk_size: Frames per NC_WriteMult, defaults to the controller's write queue length.
+    """
+    def __init__(self, controller, models, max_frames=100000, chunk_size=None):
+        self.controller = controller
+        self.models = models
+        self.max_frames = max_frames
+        self.chunk_size = chunk_size
+        self.transitions = OrderedDict()
+        self.frames = 0
+        self.hits = 0
+        self.misses = 0
+        self._pole_map = self._poleMapVersion()
+
+    def get(self, from_index, to_index):
+        pole_map = self._poleMapVersion()
+        if pole_map != self._pole_map:
+            self.clear()
+            self._pole_map = pole_map
+        key = (from_index, to_index)
+        transition = self.transitions.pop(key, None)
+        if transition is None:
+            self.misses += 1
+            transition = self._compute(from_index, to_index)
+            self.frames += len(transition)
+        else:
+            self.hits += 1
+        self.transitions[key] = transition
+        while self.frames > self.max_frames and len(self.transitions) > 1:
+            _, evicted = self.transitions.popitem(last=False)
+            self.frames -= len(evicted)
+        return transition
+
+    def clear(self):
+        self.transitions.clear()
+        self.frames = 0
+
+    def _poleMapVersion(self):
+        pole_map = self.controller.pole_map
+        return None if pole_map is None else (id(pole_map), pole_map.version)
+
+    def _compute(self, from_index, to_index):
+        model = self.models[to_index]
+        if from_index is None:
+            delta = model
+        else:
+            delta = self.models.delta(to_index, from_index)
+        if self.chunk_size is None:
+            self.chunk_size = self.controller.getWriteQueueLength()
+        batch = self.controller.deltaBatch(delta, self.chunk_size)
+        return Transition(from_index, to_index, model, delta, batch)
+
+
+class Playlist(object):
+    """An ordered sequence of model indices played on a RobotController.
+
+    Args:
+        controller: The RobotController playing the sequence.
+        models: BodyModels the indices refer to.
+        indices: Model indices in play order, models.ordered if None.
+        cache: TransitionCache to share between playlists, a new one if None.
+    """
+    def __init__(self, controller, models, indices=None, cache=None):
+        self.controller = controller
+        self.models = models
+        self.indices = list(models.ordered if indices is None else indices)
+        self.cache = cache or TransitionCache(controller, models)
+
+    def transitions(self, from_index=None):
+        """Return the transitions of one play starting at model `from_index`."""
+        result = []
+        for index in self.indices:
+            result.append(self.cache.get(from_index, index))
+            from_index = index
+        return result
+
+    def plan(self, from_index=None):
+        """Encode every transition ahead of playing, return the number of frames of one play."""
+        return sum(len(transition) for transition in self.transitions(from_index))
+
+    def play(self, loops=1, block=True, timeout=5, force=False):
+        """Play the sequence `loops` times from the controller's current model."""
+        for _ in range(loops):
+            current = self.controller.current_model
+            for transition in self.transitions(None if current is None else current.index):
+                self.controller.transferTransition(transition, block=block, timeout=timeout, force=force)
+                if not block:
+                    self.controller.current_model = transition.model
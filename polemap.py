@@ -0,0 +1,106 @@
+"""Mapping between the pole ids of the models and the ids the poles answer to.
+
+A rewired rig addresses pole 12 of the models as device 57. PoleMap keeps
+both directions as arrays indexed by id, a scalar lookup is one list index
+and a whole batch of frames or decoded responses is mapped with one numpy
+indexing step. Ids outside the map are left as they are.
+
+The tables are replaced as a whole by rewire(), so threads using the map
+while a pole is rewired see either the old or the new mapping, never half
+of each. `version` counts the changes, for whoever caches mapped frames.
+"""
+import threading
+
+import numpy
+
+from nican import NC_FL_CAN_ARBID_XTD
+from cancodec import viewFrames
+
+
+class PoleMap(object):
+    """Bidirectional pole id <-> device id map.
+
+    Args:
+        mapping: Dict of pole id -> device id, poles not in it keep their id.
+    """
+    def __init__(self, mapping=None):
+        self.lock = threading.Lock()
+        self.version = 0
+        self._setMapping(dict(mapping or {}))
+
+    @classmethod
+    def fromProxy(cls, proxy):
+        """Build a PoleMap from the [forward, reverse] lists of RobotController.proxy.
+
+        proxy[0][pole_id - 1] is the device id of a pole, the reverse list is
+        implied by the forward one.
+        """
+        return cls((i + 1, device_id) for i, device_id in enumerate(proxy[0]))
+
+    @property
+    def mapping(self):
+        return dict(self._mapping)
+
+    def rewire(self, pole_id, device_id):
+        """Make `pole_id` answer to `device_id`, the pole that had that device id takes the old one."""
+        with self.lock:
+            mapping = dict(self._mapping)
+            old_device = mapping.get(pole_id, pole_id)
+            for other, device in mapping.items():
+                if device == device_id and other != pole_id:
+                    mapping[other] = old_device
+                    break
+            else:
+                if device_id not in mapping and device_id != pole_id:
+                    # device_id was the identity mapped pole device_id.
+                    mapping[device_id] = old_device
+            mapping[pole_id] = device_id
+            self._setMapping(mapping)
+
+    def update(self, mapping):
+        """Replace the whole mapping."""
+        with self.lock:
+            self._setMapping(dict(mapping))
+
+    def toDevice(self, pole_id):
+        forward = self._tables[0]
+        return forward[pole_id] if 0 <= pole_id < len(forward) else pole_id
+
+    def fromDevice(self, device_id):
+        reverse = self._tables[1]
+        return reverse[device_id] if 0 <= device_id < len(reverse) else device_id
+
+    def toDeviceArray(self, pole_ids):
+        return self._map(self._tables[2], pole_ids)
+
+    def fromDeviceArray(self, device_ids):
+        return self._map(self._tables[3], device_ids)
+
+    def mapFrames(self, frames, num=None):
+        """Rewrite the pole ids of an NCTYPE_CAN_STRUCT array of commands to device ids, in place."""
+        array = viewFrames(frames, num)
+        device_ids = self.toDeviceArray(array['ArbitrationId'] & ~NC_FL_CAN_ARBID_XTD)
+        array['ArbitrationId'] = device_ids | NC_FL_CAN_ARBID_XTD
+        array['Data'][:, 0] = device_ids & 0xFF
+        return frames
+
+    def mapDecoded(self, decoded):
+        """Return DecodedResponses with the device ids of pole_id mapped back to pole ids."""
+        return decoded._replace(pole_id=self.fromDeviceArray(decoded.pole_id))
+
+    def _map(self, table, ids):
+        ids = numpy.asarray(ids)
+        inside = (ids >= 0) & (ids < len(table))
+        return numpy.where(inside, table[numpy.where(inside, ids, 0)], ids)
+
+    def _setMapping(self, mapping):
+        size = max([256] + [i + 1 for i in mapping.keys() + mapping.values()])
+        forward = numpy.arange(size, dtype=numpy.int64)
+        reverse = numpy.arange(size, dtype=numpy.int64)
+        for pole_id, device_id in mapping.items():
+            forward[pole_id] = device_id
+            reverse[device_id] = pole_id
+        self._mapping = mapping
+        # One assignment, readers never see the tables of two versions.
+        self._tables = (forward.tolist(), reverse.tolist(), forward, reverse)
+        self.version += 1
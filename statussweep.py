@@ -0,0 +1,160 @@
+"""Reading the status of every pole in one pipelined pass.
+
+StatusSweep sends the ReadStatusCommandFrames of all poles in chunks and
+keeps at most `window` of them unanswered, so the bus stays busy without the
+responses of one chunk waiting behind the commands of the next. The answers
+land in a structured array indexed by pole id, one int64 field per status,
+NO_RESPONSE where a pole did not answer:
+
+    sweep = StatusSweep(controller, range(1, 121), ('LENGTH', 'MAX'))
+    states = sweep.sweep()
+    print states['LENGTH'][12], states['MAX'][12]
+
+StatusPoller repeats a sweep at a fixed rate in a background thread.
+"""
+import logging
+import threading
+import time
+
+import numpy
+
+from CanController import *
+
+logger = logging.getLogger('shiyijian.robot')
+
+NO_RESPONSE = -1
+
+
+class StatusSweep(object):
+    """Reads `statuses` of `pole_ids` through a RobotController.
+
+    Args:
+        controller: The RobotController, its receiver is started if needed.
+        pole_ids: Pole ids to read, before the controller's proxy is applied.
+        statuses: Names of COMMAND_INDEX_DICT to read from every pole.
+        window: Read commands allowed in flight.
+    """
+    def __init__(self, controller, pole_ids, statuses=('LENGTH',), window=64):
+        self.controller = controller
+        self.pole_ids = sorted(pole_ids)
+        self.statuses = list(statuses)
+        self.window = max(2, window)
+        self.dtype = numpy.dtype([(status, numpy.int64) for status in self.statuses])
+        self._pole_map = None
+        self._encode()
+
+    def _encode(self):
+        self._poles = numpy.zeros(256, numpy.int64)
+        command_frames = []
+        for pole_id in self.pole_ids:
+            device_id = self.controller._toDevice(pole_id)
+            # Responses carry the device id in Data[0], map it back to the pole.
+            self._poles[device_id & 0xFF] = pole_id
+            for status in self.statuses:
+                command_frames.append(ReadStatusCommandFrame(device_id, status))
+        chunk_size = max(1, self.window // 2)
+        self.chunks = [command_frames[i:i + chunk_size] for i in range(0, len(command_frames), chunk_size)]
+        pole_map = self.controller.pole_map
+        self._pole_map = None if pole_map is None else (id(pole_map), pole_map.version)
+
+    def newStates(self):
+        """Return an array indexed by pole id with every status set to NO_RESPONSE."""
+        states = numpy.empty(self.pole_ids[-1] + 1 if self.pole_ids else 0, self.dtype)
+        for status in self.statuses:
+            states[status] = NO_RESPONSE
+        return states
+
+    def sweep(self, timeout=1):
+        """Read every pole, return the states array.
+
+        Args:
+            timeout: Seconds the whole sweep may take, poles that did not
+                answer by then are left at NO_RESPONSE.
+        """
+        pole_map = self.controller.pole_map
+        if self._pole_map != (None if pole_map is None else (id(pole_map), pole_map.version)):
+            # A pole was rewired since the frames were encoded.
+            self._encode()
+        receiver = self.controller.startReceiver()
+        states = self.newStates()
+        deadline = time.time() + timeout
+        # Chunk i is sent once chunk i - 2 is answered, so at most `window` commands are in flight.
+        previous = []
+        for chunk in self.chunks:
+            waiters = self._expect(receiver, chunk)
+            self.controller.transmitBatch(chunk)
+            for status, waiter in previous:
+                waiter.wait(max(0.0, deadline - time.time()))
+                self._gather(states, status, waiter)
+            previous = waiters
+        for status, waiter in previous:
+            waiter.wait(max(0.0, deadline - time.time()))
+            self._gather(states, status, waiter)
+        return states
+
+    def _expect(self, receiver, chunk):
+        waiters = []
+        for status in self.statuses:
+            command = COMMAND_INDEX_DICT[status]
+            pole_ids = [c.id for c in chunk if c.command_index == command]
+            if pole_ids:
+                waiters.append((status, receiver.expect(pole_ids, command)))
+        return waiters
+
+    def _gather(self, states, status, waiter):
+        decoded = waiter.responses()
+        ok = decoded.status == RESPONSE_OK
+        if waiter.missing:
+            logger.warning('no %s from poles %s', status,
+                           sorted(self.controller._fromDevice(i) for i in waiter.missing))
+        states[status][self._poles[decoded.pole_id[ok]]] = decoded.data[ok]
+
+
+class StatusPoller(object):
+    """Runs a StatusSweep `rate` times per second in a background thread.
+
+    Args:
+        sweep: The StatusSweep to run.
+        rate: Sweeps per second, the poller runs back to back when a sweep
+            takes longer than 1 / rate.
+        callback: Called with every new states array, in the poller thread.
+    """
+    def __init__(self, sweep, rate=5, callback=None):
+        self.sweep = sweep
+        self.rate = rate
+        self.callback = callback
+        self.states = None
+        self.updated_at = None
+        self.sweeps = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='StatusPoller')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        next_sweep = time.time()
+        while self._running:
+            try:
+                states = self.sweep.sweep(timeout=interval)
+            except CanError as e:
+                logger.error('status sweep failed: %s', e)
+            else:
+                self.states = states
+                self.updated_at = time.time()
+                self.sweeps += 1
+                if self.callback is not None:
+                    self.callback(states)
+            next_sweep = max(next_sweep + interval, time.time())
+            time.sleep(max(0.0, next_sweep - time.time()))
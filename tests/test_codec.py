@@ -0,0 +1,65 @@
+"""Pole commands encoded by cancodec decode to the same fields."""
+import unittest
+
+import numpy
+
+from nican import *
+from cancodec import FramePool, decodeResponses, encodeFrame, packData, viewFrames
+
+RESPONSE_OK = 1
+
+
+class CodecTest(unittest.TestCase):
+    def assertDecodes(self, frames, pole_ids, command_types, command_indexes, values):
+        decoded = decodeResponses(viewFrames(frames))
+        self.assertEqual(list(decoded.arbitration_id), pole_ids)
+        self.assertEqual(list(decoded.frame_type), [NC_FRMTYPE_DATA] * len(pole_ids))
+        self.assertEqual(list(decoded.pole_id), [pole_id & 0xFF for pole_id in pole_ids])
+        self.assertEqual(list(decoded.status), command_types)
+        self.assertEqual(list(decoded.command), command_indexes)
+        self.assertEqual(list(decoded.data), values)
+
+    def testEncodeFrame(self):
+        frames = (NCTYPE_CAN_STRUCT*2)()
+        encodeFrame(frames[0], 7, COMMAND_TYPE_WRITE, COMMAND_INDEX_LENGTH, 350)
+        encodeFrame(frames[1], 300, COMMAND_TYPE_READ, COMMAND_INDEX_MAX, 0)
+        self.assertEqual(frames[0].ArbitrationId, 7 | NC_FL_CAN_ARBID_XTD)
+        self.assertEqual(frames[0].DataLength, 8)
+        self.assertEqual(bytearray(frames[0].Data), bytearray.fromhex('%016X' % packData(7, COMMAND_TYPE_WRITE, COMMAND_INDEX_LENGTH, 350)))
+        self.assertDecodes(frames, [7, 300], [COMMAND_TYPE_WRITE, COMMAND_TYPE_READ],
+                           [COMMAND_INDEX_LENGTH, COMMAND_INDEX_MAX], [350, 0])
+
+    def testEncodeMany(self):
+        pool = FramePool(8)
+        pole_ids = [1, 2, 120]
+        values = [0, 600, (1 << 40) - 1]
+        frames = pool.encodeMany(pole_ids, values)
+        self.assertEqual(len(frames), 3)
+        self.assertDecodes(frames, pole_ids, [COMMAND_TYPE_WRITE] * 3, [COMMAND_INDEX_LENGTH] * 3, values)
+        # The same frames as one encode per command.
+        single = FramePool(8)
+        for i, (pole_id, value) in enumerate(zip(pole_ids, values)):
+            single.encode(pole_id, COMMAND_TYPE_WRITE, COMMAND_INDEX_LENGTH, value, i)
+        self.assertEqual(buffer(single.view(3))[:], buffer(frames)[:])
+        self.assertRaises(ValueError, pool.encodeMany, pole_ids, values[:2])
+        self.assertRaises(ValueError, pool.encodeMany, range(9), range(9))
+
+    def testEncodeCommands(self):
+        pool = FramePool(4)
+        frames = pool.encodeCommands([3, 4], [COMMAND_TYPE_READ, COMMAND_TYPE_WRITE],
+                                     [COMMAND_INDEX_STATUS, COMMAND_INDEX_RESET], [0, 1])
+        self.assertDecodes(frames, [3, 4], [COMMAND_TYPE_READ, COMMAND_TYPE_WRITE],
+                           [COMMAND_INDEX_STATUS, COMMAND_INDEX_RESET], [0, 1])
+
+    def testDecodeResponses(self):
+        # A response has the response status in place of the command type.
+        frames = FramePool(2).encodeMany([5, 6], [123, 456], RESPONSE_OK)
+        decoded = decodeResponses(viewFrames(frames))
+        self.assertEqual(list(decoded.status), [RESPONSE_OK] * 2)
+        self.assertEqual(list(decoded.data), [123, 456])
+        self.assertEqual(decoded.data.dtype.kind, 'u')
+        self.assertTrue(numpy.all(decoded.command == COMMAND_INDEX_LENGTH))
+
+
+if __name__ == '__main__':
+    unittest.main()
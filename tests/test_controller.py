@@ -0,0 +1,156 @@
+"""RobotController transfers on a SimulatedNican bus."""
+import time
+import unittest
+
+import nican
+import nicansim
+from CanController import *
+from interfaces import InterfaceRegistry
+
+POLES = 20
+
+
+def model(lengths, index):
+    return BodyModelData(dict((pole_id, lengths(pole_id)) for pole_id in range(1, POLES + 1)), index=index)
+
+
+class SimulatedBusTest(unittest.TestCase):
+    """Every test runs a controller on a bus of its own."""
+    drop_rate = 0.0
+
+    def setUp(self):
+        self.sim = nicansim.SimulatedNican(poles=POLES, latency=0.001, drop_rate=self.drop_rate, seed=1)
+        nican.setBackend(self.sim)
+        self.registry = InterfaceRegistry()
+        self.controller = RobotController('CAN0', registry=self.registry)
+        self.controller.startReceiver()
+        self.poles = self.sim.interfaces['CAN0'].poles
+
+    def tearDown(self):
+        self.controller.close()
+        self.registry.closeAll()
+        nican.setBackend(None)
+
+    def lengths(self):
+        return dict((pole_id, pole.length) for pole_id, pole in self.poles.items())
+
+    def waitFor(self, condition, timeout=2):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+
+class TransferTest(SimulatedBusTest):
+    def testBlockingTransfer(self):
+        target = model(lambda pole_id: 100 + pole_id, 'a')
+        self.assertEqual(self.controller.transferToModel(target, block=True), [])
+        self.assertEqual(self.lengths(), dict(target))
+        self.assertEqual(self.controller.current_model, target)
+        self.assertEqual(self.controller.metrics.snapshot()['frames_sent'], POLES)
+
+    def testDeltaTransfer(self):
+        self.controller.transferModelDeltaData(BodyModelDeltaData({1: 10, 2: 20}), block=True)
+        self.assertEqual(sorted(self.controller.responses.keys()), [1, 2])
+        self.assertEqual(self.lengths()[2], 20)
+
+
+class RetryTest(SimulatedBusTest):
+    drop_rate = 0.2
+
+    def testRetriesDroppedCommands(self):
+        target = model(lambda pole_id: 200 + pole_id, 'a')
+        self.assertEqual(self.controller.transferToModel(target, block=True, timeout=3), [])
+        self.assertEqual(self.lengths(), dict(target))
+        self.assertTrue(self.controller.frames_retransmitted > 0)
+
+    def testUnconfirmedPoles(self):
+        self.sim.drop_rate = 1.0
+        self.controller.retries = 1
+        delta = BodyModelDeltaData({1: 10, 2: 20})
+        self.assertEqual(self.controller.transferModelDeltaData(delta, block=True, timeout=0.5), [1, 2])
+        self.controller.transferModelDeltaData(delta)
+        try:
+            self.controller.waitForModelTransfer(timeout=0.5, force=True)
+        except TransferIncompleteError as e:
+            self.assertEqual(e.unconfirmed, [1, 2])
+        else:
+            self.fail('TransferIncompleteError not raised')
+
+
+class WriteCombiningTest(SimulatedBusTest):
+    def testLastCommandWins(self):
+        combiner = self.controller.enableWriteCombining(delay=0.05)
+        for k in range(3):
+            for pole_id in range(1, 6):
+                self.controller.setPoleLength(pole_id, 100 * k + pole_id)
+        self.assertEqual(len(combiner), 5)
+        self.assertEqual(combiner.coalesced, 10)
+        self.assertTrue(self.waitFor(lambda: combiner.flushes == 1))
+        self.assertTrue(self.waitFor(lambda: self.lengths()[5] == 205))
+        self.assertEqual([self.lengths()[pole_id] for pole_id in range(1, 6)], [201, 202, 203, 204, 205])
+        self.assertEqual(self.controller.metrics.snapshot()['frames_sent'], 5)
+
+    def testStagedWritesGoFirst(self):
+        self.controller.enableWriteCombining(delay=0.5)
+        self.controller.setPoleLength(3, 333)
+        self.controller.readStatus(3, 'LENGTH')
+        # The read is answered after the staged write.
+        self.controller.receive(2, timeout=1, force=True)
+        self.assertEqual(self.controller.received_frames[3].data, 333)
+
+
+class MirrorTest(SimulatedBusTest):
+    def testDeltaOfConfirmedLengths(self):
+        target = model(lambda pole_id: 200, 'a')
+        self.controller.transferToModel(target, block=True)
+        self.assertEqual(dict(self.controller.modelDelta(target)), {})
+        # A pole that lost its length is sent again.
+        self.poles[4].length = 0
+        self.controller.resetPole(4)
+        self.assertEqual(dict(self.controller.modelDelta(target)), {4: 200})
+        self.assertEqual(dict(self.controller.modelDelta(target, ignore_previous=True)), dict(target))
+
+    def testStagedWriteIsUndone(self):
+        target = model(lambda pole_id: 200, 'a')
+        self.controller.transferToModel(target, block=True)
+        self.controller.enableWriteCombining(delay=0.5)
+        self.controller.setPoleLength(5, 300)
+        self.assertEqual(self.controller.transferToModel(target, block=True), [])
+        self.assertEqual(self.lengths()[5], 200)
+
+
+class RecoveryTest(SimulatedBusTest):
+    def testBusOff(self):
+        self.sim.busOff('CAN0')
+        self.assertTrue(self.waitFor(lambda: self.controller.handle.recoveries['restart'] > 0))
+        target = model(lambda pole_id: 300, 'a')
+        self.assertEqual(self.controller.transferToModel(target, block=True), [])
+        self.assertEqual(self.lengths(), dict(target))
+
+    def testBusOffDuringTransfer(self):
+        target = model(lambda pole_id: 400, 'a')
+        self.controller.transferToModel(target)
+        self.sim.busOff('CAN0')
+        self.assertEqual(self.controller.waitForModelTransfer(timeout=3), [])
+        self.assertEqual(self.lengths(), dict(target))
+
+    def testBusErrorDoesNotRestart(self):
+        self.sim.busError('CAN0')
+        self.assertTrue(self.waitFor(lambda: self.controller.metrics.snapshot()['errors']['bus_errors'] > 0))
+        self.assertEqual(self.controller.handle.recoveries, {'restart': 0, 'reset': 0})
+
+    def testTransmitErrorCause(self):
+        self.controller.auto_recover = False
+        self.sim.busOff('CAN0', stuck=True)
+        try:
+            self.controller.transferModelDeltaData(BodyModelDeltaData(model(lambda pole_id: 10, 'a')))
+        except BatchTransferError as e:
+            self.assertTrue(isinstance(e.cause, NicanError))
+            self.assertEqual(e.batch.pending, range(e.chunk, len(e.batch.sent)))
+        else:
+            self.fail('BatchTransferError not raised')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""BodyModels keeps the mapping API of the dict of BodyModelData it replaced."""
+import copy
+import unittest
+
+from CanController import BodyModelData, BodyModelDeltaData, BodyModels
+
+
+def library():
+    models = BodyModels()
+    models['a'] = BodyModelData({1: 100, 2: 200, 3: 300}, index='a')
+    models['b'] = BodyModelData({1: 100, 2: 250, 3: 350}, index='b')
+    models['c'] = BodyModelData({1: 110, 2: 250}, index='c')
+    return models
+
+
+class BodyModelsMappingTest(unittest.TestCase):
+    def setUp(self):
+        self.models = library()
+
+    def testItems(self):
+        models = self.models
+        self.assertEqual(len(models), 3)
+        self.assertEqual(models.keys(), ['a', 'b', 'c'])
+        self.assertEqual(list(models), ['a', 'b', 'c'])
+        self.assertTrue('b' in models)
+        self.assertFalse('z' in models)
+        self.assertEqual(dict(models['a']), {1: 100, 2: 200, 3: 300})
+        self.assertEqual(models['a'].index, 'a')
+        self.assertEqual(dict(models['c']), {1: 110, 2: 250})
+        self.assertEqual([dict(model) for model in models.values()], [dict(models[i]) for i in 'abc'])
+        self.assertEqual([i for i, _ in models.items()], ['a', 'b', 'c'])
+        self.assertEqual(models.get('z'), None)
+        self.assertEqual(models.get('z', 1), 1)
+        self.assertRaises(KeyError, models.__getitem__, 'z')
+
+    def testReplaceKeepsOrder(self):
+        self.models['a'] = BodyModelData({1: 1, 4: 4})
+        self.assertEqual(self.models.keys(), ['a', 'b', 'c'])
+        self.assertEqual(dict(self.models['a']), {1: 1, 4: 4})
+        self.assertEqual(dict(self.models['b']), {1: 100, 2: 250, 3: 350})
+
+    def testDelete(self):
+        del self.models['a']
+        self.assertEqual(self.models.keys(), ['b', 'c'])
+        self.assertEqual(dict(self.models['c']), {1: 110, 2: 250})
+        self.assertRaises(KeyError, self.models.__delitem__, 'a')
+
+    def testPopIsDetached(self):
+        model = self.models.pop('a')
+        self.assertEqual(dict(model), {1: 100, 2: 200, 3: 300})
+        self.assertEqual(model.index, 'a')
+        self.assertFalse('a' in self.models)
+        model[1] = 9
+        del model[2]
+        self.assertEqual(dict(model), {1: 9, 3: 300})
+        self.assertEqual(self.models.pop('a', 0), 0)
+        self.assertRaises(KeyError, self.models.pop, 'a')
+
+    def testRowWritesGoThrough(self):
+        model = self.models['b']
+        model[2] = 260
+        model[4] = 400
+        del model[3]
+        self.assertEqual(dict(self.models['b']), {1: 100, 2: 260, 4: 400})
+        self.assertEqual(dict(self.models['a']), {1: 100, 2: 200, 3: 300})
+
+    def testRowOfRemovedModel(self):
+        model = self.models['a']
+        del self.models['a']
+        self.assertRaises(KeyError, model.__setitem__, 1, 9)
+        self.assertEqual(model[1], 100)
+
+    def testCopiesAreDetached(self):
+        for copied in (copy.copy(self.models['b']), copy.deepcopy(self.models['b'])):
+            self.assertEqual(type(copied), BodyModelData)
+            self.assertEqual(copied.index, 'b')
+            copied[2] = 1
+            self.assertEqual(self.models['b'][2], 250)
+
+    def testDeltas(self):
+        models = self.models
+        self.assertEqual(dict(models['b'].delta(models['a'])), {2: 250, 3: 350})
+        self.assertEqual(dict(models.delta('c', 'b')), {1: 110})
+        self.assertTrue(isinstance(models.delta('c', 'b'), BodyModelDeltaData))
+        # The same as the deltas of detached models.
+        self.assertEqual(dict(models.delta('c', 'b')), dict(copy.copy(models['c']).delta(copy.copy(models['b']))))
+        self.assertEqual([dict(delta) for delta in models.deltas(['a', 'b', 'c'])], [{2: 250, 3: 350}, {1: 110}])
+
+    def testTextRoundTrip(self):
+        text = BodyModelData.serializeModels(self.models)
+        models = BodyModelData.parseModelsFromString(text)
+        self.assertEqual(models.keys(), ['a', 'b', 'c'])
+        for i in models:
+            self.assertEqual(dict(models[i]), dict(self.models[i]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""Streaming smooth moves between two models.
+
+transferToModel makes every pole jump to its new length. For a smooth move
+the intermediate poses are generated and streamed at a fixed update rate,
+as a pipeline of generators:
+
+    poses = interpolate(controller.current_model, model, duration=2.0, rate=50)
+    TrajectoryStreamer(controller, rate=50).stream(changes(poses, quantum=1))
+
+interpolate() yields the pose of every step, changes() only the poles whose
+quantized length moved since the previous step, and TrajectoryStreamer
+writes each step in its time slot. When the bus can not keep up, because
+the write queue still holds more than one step of frames or the slot of a
+step has passed, the step is merged into the next one instead of being
+queued: intermediate poses are dropped, the move ends on time and at the
+exact target.
+"""
+import logging
+import time
+
+import numpy
+
+from CanController import *
+
+logger = logging.getLogger('shiyijian.robot')
+
+
+def linear(u):
+    return u
+
+
+def smoothstep(u):
+    """Ease in and out, the poles start and stop with zero speed."""
+    return u * u * (3 - 2 * u)
+
+
+def interpolate(from_model, to_model, duration, rate=50, easing=smoothstep):
+    """Yield (pole_ids, lengths) arrays of the poses from `from_model` to `to_model`.
+
+    Args:
+        from_model: Dict of pole id -> length the move starts at, poles
+            missing from it start at their target.
+        to_model: Dict of pole id -> length the move ends at.
+        duration: Seconds the move takes.
+        rate: Poses per second.
+        easing: Maps the fraction of the duration elapsed to the fraction of
+            the distance travelled, both in [0, 1].
+
+    The lengths are floats, the last pose is `to_model` exactly.
+    """
+    pole_ids = numpy.array(sorted(to_model.keys()), numpy.int64)
+    end = numpy.array([to_model[i] for i in pole_ids.tolist()], numpy.float64)
+    start = numpy.array([from_model.get(i, to_model[i]) for i in pole_ids.tolist()], numpy.float64)
+    distance = end - start
+    steps = max(1, int(round(duration * rate)))
+    for k in range(1, steps):
+        yield pole_ids, start + distance * easing(float(k) / steps)
+    yield pole_ids, end
+
+
+def changes(poses, quantum=1):
+    """Yield a dict of pole id -> length per pose, with the poles whose quantized length changed.
+
+    Args:
+        poses: Iterable of (pole_ids, lengths) arrays, as yielded by interpolate.
+        quantum: Length step of the poles, lengths are rounded to a multiple
+            of it. Integral lengths, the end poses, are kept exactly.
+
+    The first pose yields every pole.
+    """
+    previous = None
+    for pole_ids, lengths in poses:
+        rounded = numpy.rint(lengths)
+        quantized = numpy.where(lengths == rounded, rounded, numpy.rint(lengths / quantum) * quantum).astype(numpy.int64)
+        if previous is None or previous[0] is not pole_ids and not numpy.array_equal(previous[0], pole_ids):
+            changed = numpy.ones(len(pole_ids), bool)
+        else:
+            changed = quantized != previous[1]
+        previous = (pole_ids, quantized)
+        yield dict(zip(pole_ids[changed].tolist(), quantized[changed].tolist()))
+
+
+class TrajectoryStreamer(object):
+    """Writes a stream of pose changes through a RobotController, one step per time slot.
+
+    Args:
+        controller: The RobotController the poles are set through.
+        rate: Steps per second, the rate the poses were generated for.
+    """
+    def __init__(self, controller, rate=50):
+        self.controller = controller
+        self.rate = rate
+        self.chunk_size = None
+        self.pool = None
+        self.resetStats()
+
+    def resetStats(self):
+        self.steps = 0
+        self.steps_sent = 0
+        self.steps_deferred = 0
+        self.frames = 0
+
+    def backlog(self):
+        """Seconds of frames still in the write queue."""
+        scheduler = self.controller._scheduler
+        if scheduler is None:
+            return 0.0
+        return max(0.0, scheduler.queue_empty_at - time.time())
+
+    def stream(self, steps):
+        """Send every step of `steps`, dicts of pole id -> length, at the streamer's rate.
+
+        Returns:
+            The dict of pole id -> length last sent to every pole.
+        """
+        self.controller.startReceiver()
+        if self.chunk_size is None:
+            self.chunk_size = self.controller.getWriteQueueLength()
+        period = 1.0 / self.rate
+        start = time.time()
+        pending = {}
+        sent = {}
+        for k, step in enumerate(steps):
+            self.steps += 1
+            pending.update(step)
+            slot = start + k * period
+            now = time.time()
+            if now >= slot + period:
+                # The slot of the step has passed, its poses are merged into the next step.
+                self.steps_deferred += 1
+                continue
+            if now < slot:
+                time.sleep(slot - now)
+            if self.backlog() > period:
+                # The queue still holds more than a step of frames, let it drain.
+                self.steps_deferred += 1
+                continue
+            self._send(pending, sent)
+            pending = {}
+        if pending:
+            time.sleep(self.backlog())
+            self._send(pending, sent)
+        return sent
+
+    def _send(self, pending, sent):
+        if not pending:
+            return
+        if self.pool is None or self.pool.size < len(pending):
+            # The first step holds every pole, the pool is reused by the next ones.
+            self.pool = FramePool(len(pending))
+        batch = self.controller.transmitBatch(self.controller.deltaBatch(pending, self.chunk_size, self.pool))
+        self.steps_sent += 1
+        self.frames += len(batch)
+        sent.update(pending)
+
+    def transfer(self, model, duration, quantum=1, easing=smoothstep, block=False, timeout=5):
+        """Move smoothly from the controller's current model to `model`.
+
+        Without a current model the poles jump to `model`. The controller's
+        current_model is `model` afterwards, like after transferToModel.
+        """
+        controller = self.controller
+        current = controller.current_model
+        if current is None:
+            logger.info('stream to model %s', model.index)
+            current = model
+        else:
+            logger.info('stream from %s to model %s', current.index, model.index)
+        self.stream(changes(interpolate(current, model, duration, self.rate, easing), quantum))
+        controller.current_model = model
+        if block:
+            # The final lengths decide where the poles end, confirm them like a transfer does.
+            controller.transferToModel(model, block=True, timeout=timeout)
+        return model
@@ -0,0 +1,126 @@
+"""Paced writing of frames into the small NI-CAN write queue.
+
+The write queue only holds NC_ATTR_WRITE_Q_LEN frames. TransmitScheduler
+predicts when the bus frees a queue slot from the baud rate and the size of
+an extended 8 byte frame, and writes the next frames exactly then: the queue
+stays full without overflowing it and without a driver round trip per frame.
+When the prediction is early the driver reports an overflow, the scheduler
+then waits for NC_ST_WRITE_SUCCESS and resynchronises on the empty queue.
+"""
+import threading
+import time
+from ctypes import *
+
+from nican import *
+from capture import SENT
+
+_overflow_status = c_int32(CanErrOverflowWrite).value
+
+
+class TransmitScheduler(object):
+    """Writes NCTYPE_CAN_STRUCT arrays of one interface at the bus rate.
+
+    Args:
+        objHandle: Handle of the opened interface.
+        baud_rate: Bit rate of the bus, NC_ATTR_BAUD_RATE.
+        write_q_len: Frames the write queue holds, NC_ATTR_WRITE_Q_LEN.
+        response_ratio: Frames the poles put on the bus per frame sent, 1 when
+            every command is answered.
+        timeout: Milliseconds to wait for the write queue to drain before giving up.
+    """
+    def __init__(self, objHandle, baud_rate, write_q_len, response_ratio=1.0, timeout=100):
+        self.objHandle = objHandle
+        self.baud_rate = baud_rate
+        self.write_q_len = max(1, write_q_len)
+        self.response_ratio = response_ratio
+        self.timeout = timeout
+        self.queue_empty_at = 0.0
+        self.capture = None     # CaptureWriter recording every frame written
+        # The controllers sharing the interface write from several threads, one write at a time.
+        self.lock = threading.Lock()
+        self.resetStats()
+
+    @property
+    def frame_time(self):
+        """Seconds an extended frame with 8 data bytes occupies the bus."""
+        return float(EXTENDED_FRAME_BITS) / self.baud_rate
+
+    @property
+    def slot_time(self):
+        """Seconds between two frames leaving the write queue, responses included."""
+        return self.frame_time * (1 + self.response_ratio)
+
+    @property
+    def frame_rate(self):
+        """Frames per second the scheduler can send."""
+        return 1.0 / self.slot_time
+
+    def resetStats(self):
+        with self.lock:
+            self.since = time.time()
+            self.frames_sent = 0
+            self.overflows = 0
+            self.stall_time = 0.0
+
+    def utilisation(self, frames_received=0):
+        """Fraction of the bus time used since resetStats by the frames sent and `frames_received`."""
+        elapsed = time.time() - self.since
+        if elapsed <= 0:
+            return 0.0
+        return (self.frames_sent + frames_received) * self.frame_time / elapsed
+
+    def write(self, frames, timeout=None, counters=None):
+        """Write an NCTYPE_CAN_STRUCT array, blocking only while the write queue is full.
+
+        Args:
+            frames: The frames to write.
+            timeout: Overrides the scheduler's timeout for this write.
+            counters: Object whose frames_sent, overflows and stall_time count
+                this write along with the scheduler's, the ControllerMetrics of
+                the writing controller.
+        """
+        backend = getBackend()
+        frame_size = sizeof(NCTYPE_CAN_STRUCT)
+        sent = 0
+        num = len(frames)
+        with self.lock:
+            while sent < num:
+                now = time.time()
+                slot_time = self.slot_time
+                queued = max(0.0, self.queue_empty_at - now) / slot_time
+                room = self.write_q_len - int(queued + 0.999999)
+                if room <= 0:
+                    # Sleep until the frame ahead of the queue leaves it.
+                    delay = self.queue_empty_at - (self.write_q_len - 1) * slot_time - now
+                    self.stall_time += delay
+                    if counters is not None:
+                        counters.stall_time += delay
+                    time.sleep(delay)
+                    continue
+                count = min(room, num - sent)
+                chunk = (NCTYPE_CAN_STRUCT*count).from_buffer(frames, sent * frame_size)
+                status = backend.ncWriteMult(self.objHandle, sizeof(chunk), byref(chunk))
+                if status == _overflow_status:
+                    self.overflows += 1
+                    stall_time = self._waitForEmptyQueue(self.timeout if timeout is None else timeout)
+                    if counters is not None:
+                        counters.overflows += 1
+                        counters.stall_time += stall_time
+                    continue
+                processStatus(status, "NC_WriteMult")
+                if self.capture is not None:
+                    self.capture.append(SENT, chunk, now)
+                self.queue_empty_at = max(now, self.queue_empty_at) + count * slot_time
+                self.frames_sent += count
+                if counters is not None:
+                    counters.frames_sent += count
+                sent += count
+
+    def _waitForEmptyQueue(self, timeout):
+        state = c_ulong()
+        t = time.time()
+        NC_WaitForState(self.objHandle, NC_ST_WRITE_SUCCESS, timeout, byref(state))
+        now = time.time()
+        self.stall_time += now - t
+        self.queue_empty_at = now
+        return now - t
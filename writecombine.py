@@ -0,0 +1,96 @@
+"""Write combining of pole commands.
+
+A control loop often sets the same pole several times within one tick. The
+WriteCombiner of a RobotController stages write commands per (device pole id,
+command index), a later command replacing the staged one, and sends what is
+staged as one batch when the oldest staged command is `delay` seconds old,
+on flush(), or before any command that must not overtake the staged ones.
+The poles end at the same positions with fewer frames on the bus.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('shiyijian.robot')
+
+
+class WriteCombiner(object):
+    """Stages the write commands of a RobotController.
+
+    Args:
+        controller: The RobotController sending the flushed batches.
+        delay: Seconds a staged command may wait before the stage is flushed.
+    """
+    def __init__(self, controller, delay=0.01):
+        self.controller = controller
+        self.delay = delay
+        self.staged = OrderedDict()     # (device pole id, command index) -> CommandFrame
+        self.deadline = None
+        self.lock = threading.Lock()
+        # Held while a stage is sent, commands that must follow it wait for it.
+        self.send_lock = threading.RLock()
+        self.resetStats()
+        self._staged_event = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='WriteCombiner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def resetStats(self):
+        self.commands = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.frames_flushed = 0
+
+    def stage(self, command_frame):
+        """Stage a write command, replacing the staged command of the same pole and index."""
+        key = (command_frame.id, command_frame.command_index)
+        with self.lock:
+            self.commands += 1
+            if self.staged.pop(key, None) is not None:
+                self.coalesced += 1
+            self.staged[key] = command_frame
+            if self.deadline is None:
+                self.deadline = time.time() + self.delay
+                self._staged_event.set()
+
+    def __len__(self):
+        return len(self.staged)
+
+    def flush(self):
+        """Send the staged commands in staging order, return their number."""
+        with self.send_lock:
+            with self.lock:
+                if not self.staged:
+                    return 0
+                command_frames = self.staged.values()
+                self.staged = OrderedDict()
+                self.deadline = None
+            self.flushes += 1
+            self.frames_flushed += len(command_frames)
+            self.controller.transmitBatch(command_frames)
+            return len(command_frames)
+
+    def close(self):
+        """Flush and stop the deadline thread."""
+        self._running = False
+        self._staged_event.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            self._staged_event.wait()
+            if not self._running:
+                break
+            self._staged_event.clear()
+            deadline = self.deadline
+            if deadline is None:
+                continue
+            time.sleep(max(0.0, deadline - time.time()))
+            try:
+                self.flush()
+            except Exception as e:
+                # transmitBatch counted the error, keep flushing the next stages.
+                logger.error('Failed to flush staged commands: %s', e)